@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Планировщик микро-батчей для конкурентных запросов генерации.
+
+Запросы с одинаковым ключом совместимости (шаги, guidance, размер, набор
+ControlNet) собираются в течение короткого окна и отдаются одной функции
+run_batch, которая выполняет общий цикл денойзинга; результаты раздаются
+обратно вызывающим через Future. Модуль не зависит от PyTorch.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRequest:
+    """Запрос в очереди планировщика: данные для run_batch, число сэмплов и Future результата."""
+
+    def __init__(self, key: Hashable, payload: Any, size: int):
+        self.key = key
+        self.payload = payload
+        self.size = max(1, int(size))
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatchScheduler:
+    """Собирает совместимые запросы в батчи и выполняет их в одном потоке-диспетчере.
+
+    run_batch(key, payloads) получает данные запросов одного ключа и возвращает
+    список результатов в том же порядке. Батч закрывается, когда сэмплов набралось
+    max_batch_size или старейший запрос ждет дольше max_wait_ms. should_wait()
+    позволяет не ждать окно, когда других запросов не предвидится (например,
+    единственный запрос в обработке). Метрики — в stats.
+    """
+
+    def __init__(self, run_batch: Callable[[Hashable, List[Any]], List[Any]], max_batch_size: int = 4,
+                 max_wait_ms: float = 30.0, should_wait: Optional[Callable[[], bool]] = None):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.should_wait = should_wait
+        self._queues: "OrderedDict[Hashable, Deque[BatchRequest]]" = OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.stats = {
+            "batches": 0, "requests": 0, "samples": 0,
+            "mean_fill_rate": 0.0, "mean_queue_delay_ms": 0.0, "max_queue_delay_ms": 0.0
+        }
+        self._fill_sum = 0.0
+        self._delay_sum = 0.0
+        self._thread = threading.Thread(target=self._dispatch_loop, name="micro-batch", daemon=True)
+        self._thread.start()
+
+    def submit(self, key: Hashable, payload: Any, size: int = 1) -> Future:
+        """Ставит запрос в очередь; Future вернет результат run_batch для этого запроса."""
+        request = BatchRequest(key, payload, size)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Планировщик батчей остановлен")
+            self._queues.setdefault(key, deque()).append(request)
+            self._condition.notify_all()
+        return request.future
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Останавливает диспетчер; уже поставленные запросы дорабатываются."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            self._thread.join()
+
+    def _oldest_key(self) -> Optional[Hashable]:
+        oldest_key, oldest_time = None, None
+        for key, queue in self._queues.items():
+            if queue and (oldest_time is None or queue[0].enqueued_at < oldest_time):
+                oldest_key, oldest_time = key, queue[0].enqueued_at
+        return oldest_key
+
+    def _take_batch(self) -> Optional[List[BatchRequest]]:
+        """Ждет готовый батч (полный или по истечении окна) и снимает его с очереди."""
+        with self._condition:
+            while True:
+                key = self._oldest_key()
+                if key is None:
+                    if self._closed:
+                        return None
+                    self._condition.wait()
+                    continue
+                queue = self._queues[key]
+                queued_samples = sum(request.size for request in queue)
+                deadline = queue[0].enqueued_at + self.max_wait
+                remaining = deadline - time.perf_counter()
+                wait_allowed = self.should_wait() if self.should_wait is not None else True
+                if queued_samples < self.max_batch_size and remaining > 0 and wait_allowed and not self._closed:
+                    self._condition.wait(timeout=remaining)
+                    continue
+
+                batch = [queue.popleft()]
+                samples = batch[0].size
+                while queue and samples + queue[0].size <= self.max_batch_size:
+                    samples += queue[0].size
+                    batch.append(queue.popleft())
+                if not queue:
+                    del self._queues[key]
+                return batch
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._record(batch)
+            try:
+                results = self.run_batch(batch[0].key, [request.payload for request in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"run_batch вернул {len(results)} результатов на {len(batch)} запросов")
+            except Exception as e:
+                logger.error(f"❌ Ошибка выполнения батча из {len(batch)} запросов: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+    def _record(self, batch: List[BatchRequest]) -> None:
+        now = time.perf_counter()
+        samples = sum(request.size for request in batch)
+        delays_ms = [(now - request.enqueued_at) * 1000 for request in batch]
+        with self._condition:
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(batch)
+            self.stats["samples"] += samples
+            self._fill_sum += min(1.0, samples / self.max_batch_size)
+            self._delay_sum += sum(delays_ms)
+            self.stats["mean_fill_rate"] = round(self._fill_sum / self.stats["batches"], 4)
+            self.stats["mean_queue_delay_ms"] = round(self._delay_sum / self.stats["requests"], 2)
+            self.stats["max_queue_delay_ms"] = round(max(self.stats["max_queue_delay_ms"], max(delays_ms)), 2)
+        if len(batch) > 1:
+            logger.info(f"📦 Микро-батч: {len(batch)} запросов, {samples} сэмплов, "
+                        f"ожидание до {max(delays_ms):.1f} мс")
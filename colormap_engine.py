@@ -0,0 +1,912 @@
+#!/usr/bin/env python3
+"""
+Векторизованный NumPy-движок генерации colormap без зависимости от PyTorch.
+
+Colormap строится как карта меток uint8 (0 — прозрачный фон, i + 1 — i-й цвет),
+из которой RGBA colormap и L-хинт получаются одной выборкой по палитре.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Фон colormap: прозрачный белый, как в исходной PIL-реализации
+TRANSPARENT_RGBA = (255, 255, 255, 0)
+
+# Ширина пустых полей по краям (2.5% от размера)
+MARGIN_FRACTION = 0.025
+
+# Ограничение числа гранул в одном батче (память на маски гранул)
+GRANULE_BATCH_LIMIT = 16384
+
+# Версия формата атласа гранул: менять при изменении растеризации гранул
+GRANULE_ATLAS_FORMAT = 1
+
+# RGB-расстояние, дальше которого пиксель не считается ни одним из целевых цветов (оценка точности)
+FIDELITY_COLOR_TOLERANCE = 100.0
+
+# Уровни пирамиды colormap (ширина): хинт, превью, легенда, сетка латентов SDXL
+PYRAMID_LEVELS = (1024, 512, 256, 128)
+
+logger = logging.getLogger(__name__)
+
+
+def compute_work_area(size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """Возвращает (margin_x, margin_y, work_width, work_height) для холста size."""
+    width, height = size
+    margin_x = int(width * MARGIN_FRACTION)
+    margin_y = int(height * MARGIN_FRACTION)
+    return margin_x, margin_y, width - 2 * margin_x, height - 2 * margin_y
+
+
+def luma(rgb: Sequence[int]) -> int:
+    """Яркость цвета для L-хинта (та же формула, что и в попиксельной реализации)."""
+    r, g, b = rgb
+    return int(0.299 * r + 0.587 * g + 0.114 * b)
+
+
+def build_palette(rgb_colors: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Строит LUT палитры: RGBA (N+1, 4) и L (N+1,), индекс 0 — прозрачный фон."""
+    rgba_lut = np.empty((len(rgb_colors) + 1, 4), dtype=np.uint8)
+    luma_lut = np.zeros(len(rgb_colors) + 1, dtype=np.uint8)
+    rgba_lut[0] = TRANSPARENT_RGBA
+    for idx, rgb in enumerate(rgb_colors, start=1):
+        rgba_lut[idx] = (rgb[0], rgb[1], rgb[2], 255)
+        luma_lut[idx] = luma(rgb)
+    return rgba_lut, luma_lut
+
+
+class LabelMap:
+    """Палитровое представление colormap: карта меток uint8 и маленькая палитра.
+
+    Метка 0 — прозрачный фон, метка i — i-й цвет палитры (RGB, яркость, альфа).
+    RGBA colormap, L-хинт, легенда и статистика цветов выводятся из меток
+    через LUT лениво, поэтому в памяти постоянно живет только 1 байт на пиксель.
+    """
+
+    def __init__(self, labels: np.ndarray, rgb_colors: Sequence[Sequence[int]]):
+        self.labels = labels
+        self.rgb_colors = [tuple(int(c) for c in rgb[:3]) for rgb in rgb_colors]
+        self.rgba_lut, self.luma_lut = build_palette(self.rgb_colors)
+        self._rgba: Optional[Image.Image] = None
+        self._hint: Optional[Image.Image] = None
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.labels.shape[1], self.labels.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.labels.nbytes + self.rgba_lut.nbytes + self.luma_lut.nbytes
+
+    @property
+    def rgba(self) -> Image.Image:
+        """RGBA colormap (строится при первом обращении)."""
+        if self._rgba is None:
+            self._rgba = Image.fromarray(self.rgba_lut[self.labels], "RGBA")
+        return self._rgba
+
+    @property
+    def hint(self) -> Image.Image:
+        """L-хинт: яркость цвета на цветных пикселях, 0 на фоне."""
+        if self._hint is None:
+            self._hint = Image.fromarray(self.luma_lut[self.labels], "L")
+        return self._hint
+
+    def view(self) -> "LabelMap":
+        """Новая карта поверх тех же меток и палитры без отрендеренных RGBA/хинта
+        (кэш раздает такие копии, чтобы изображения запроса не оседали в кэше)."""
+        return LabelMap(self.labels, self.rgb_colors)
+
+    def rgb(self, background: Tuple[int, int, int] = (255, 255, 255)) -> Image.Image:
+        """RGB colormap без альфы: фон (метка 0) заливается цветом background (init-изображение img2img)."""
+        rgb_lut = self.rgba_lut[:, :3].copy()
+        rgb_lut[0] = background
+        return Image.fromarray(rgb_lut[self.labels], "RGB")
+
+    def pixel_counts(self) -> np.ndarray:
+        """Число пикселей каждой метки (индекс 0 — фон)."""
+        return np.bincount(self.labels.ravel(), minlength=len(self.rgb_colors) + 1)
+
+    def to_indexed_image(self) -> Image.Image:
+        """Индексированное (P) изображение с палитрой; индекс 0 прозрачен."""
+        image = Image.fromarray(self.labels, "P")
+        image.putpalette([channel for rgba in self.rgba_lut for channel in rgba[:3]])
+        image.info["transparency"] = 0
+        return image
+
+    def save(self, path: str, **params) -> None:
+        """Сохраняет карту как индексированный PNG (в ~4 раза меньше данных, чем RGBA)."""
+        self.to_indexed_image().save(path, transparency=0, **params)
+
+    def resized(self, size: Tuple[int, int]) -> "LabelMap":
+        """Карта меток другого размера (ближайший сосед, палитра та же)."""
+        labels = np.asarray(Image.fromarray(self.labels, "L").resize(size, Image.Resampling.NEAREST))
+        return LabelMap(labels, self.rgb_colors)
+
+
+def render_label_map(labels: np.ndarray, rgb_colors: Sequence[Sequence[int]]) -> Tuple[Image.Image, Image.Image]:
+    """Преобразует карту меток в RGBA colormap и L-хинт через LUT палитры."""
+    label_map = LabelMap(labels, rgb_colors)
+    return label_map.rgba, label_map.hint
+
+
+def allocate_quotas(proportions: Sequence[float], total: int) -> np.ndarray:
+    """Делит total пикселей между цветами методом наибольшего остатка.
+
+    Квоты пропорциональны proportions (нормализуются внутри) и в сумме дают
+    ровно total; при нулевой сумме пропорций все квоты нулевые.
+    """
+    weights = np.asarray(proportions, dtype=np.float64)
+    quotas = np.zeros(weights.size, dtype=np.int64)
+    weight_sum = weights.sum()
+    if weights.size == 0 or weight_sum <= 0:
+        return quotas
+    exact = weights / weight_sum * total
+    quotas[:] = np.floor(exact)
+    shortfall = int(total - quotas.sum())
+    if shortfall > 0:
+        order = np.argsort(-(exact - quotas), kind="stable")
+        quotas[order[:shortfall]] += 1
+    return quotas
+
+
+def build_random_label_map(proportions: Sequence[float], size: Tuple[int, int],
+                           rng: np.random.Generator) -> np.ndarray:
+    """Строит карту меток случайного паттерна с точными квотами пикселей.
+
+    Рабочая область заполняется целиком: метки цветов повторяются по квотам
+    allocate_quotas и перемешиваются одной перестановкой на месте (массив uint8
+    размером с рабочую область, без списка координат).
+    """
+    width, height = size
+    margin_x, margin_y, work_width, work_height = compute_work_area(size)
+    labels = np.zeros((height, width), dtype=np.uint8)
+    if work_width <= 0 or work_height <= 0:
+        return labels
+    quotas = allocate_quotas(proportions, work_width * work_height)
+    if quotas.sum() == 0:
+        return labels
+    flat = np.repeat(np.arange(1, quotas.size + 1, dtype=np.uint8), quotas)
+    rng.shuffle(flat)
+    labels[margin_y:margin_y + work_height, margin_x:margin_x + work_width] = flat.reshape(work_height, work_width)
+    return labels
+
+
+def _assign_in_order(proportions: Sequence[float], size: Tuple[int, int], order_fn) -> np.ndarray:
+    """Раздает пиксели рабочей области цветам по квотам в порядке order_fn(work_width, work_height).
+
+    Первые quotas[0] пикселей порядка получают первый цвет, следующие — второй
+    и т.д., поэтому квоты allocate_quotas выполняются всегда и точно.
+    """
+    width, height = size
+    margin_x, margin_y, work_width, work_height = compute_work_area(size)
+    labels = np.zeros((height, width), dtype=np.uint8)
+    if work_width <= 0 or work_height <= 0:
+        return labels
+    quotas = allocate_quotas(proportions, work_width * work_height)
+    if quotas.sum() == 0:
+        return labels
+    order = order_fn(work_width, work_height)
+    flat = np.zeros(work_width * work_height, dtype=np.uint8)
+    bounds = np.concatenate(([0], np.cumsum(quotas)))
+    for color_idx in range(quotas.size):
+        flat[order[bounds[color_idx]:bounds[color_idx + 1]]] = color_idx + 1
+    labels[margin_y:margin_y + work_height, margin_x:margin_x + work_width] = flat.reshape(work_height, work_width)
+    return labels
+
+
+def build_grid_label_map(proportions: Sequence[float], size: Tuple[int, int],
+                         rng: np.random.Generator) -> np.ndarray:
+    """Точечный (grid) паттерн: равномерная выборка без возвращения по свободным пикселям.
+
+    Цвета по очереди занимают случайные свободные пиксели, как и раньше, но
+    без повторных попыток: порядок выборки — одна перестановка рабочей области.
+    """
+    return _assign_in_order(proportions, size, lambda w, h: rng.permutation(w * h))
+
+
+def build_stripe_label_map(proportions: Sequence[float], size: Tuple[int, int]) -> np.ndarray:
+    """Строит карту вертикальных полос на весь холст (без полей).
+
+    Ширины полос — allocate_quotas по столбцам, поэтому полосы покрывают
+    холст без пустых столбцов при любом округлении долей.
+    """
+    width, height = size
+    widths = allocate_quotas(proportions, width)
+    row = np.zeros(width, dtype=np.uint8)
+    filled = int(widths.sum())
+    row[:filled] = np.repeat(np.arange(1, widths.size + 1, dtype=np.uint8), widths)
+    return np.repeat(row[np.newaxis, :], height, axis=0)
+
+
+def radial_weights(work_width: int, work_height: int) -> np.ndarray:
+    """Веса пикселей радиального паттерна (плоский массив рабочей области).
+
+    Прежний сэмплер брал равномерные угол и радиус в круге max_radius,
+    что дает плотность ~1/r. Пиксели вне круга он не заполнял никогда;
+    здесь они получают вес в 1000 раз меньше края круга и занимаются
+    последними, чтобы квоты выполнялись целиком.
+    """
+    center_x = work_width // 2
+    center_y = work_height // 2
+    max_radius = max(1, min(work_width, work_height) // 2)
+    ys, xs = np.ogrid[:work_height, :work_width]
+    radius = np.sqrt((xs - center_x) ** 2 + (ys - center_y) ** 2)
+    weights = 1.0 / np.maximum(radius, 0.5)
+    weights[radius > max_radius] = 1e-3 / max_radius
+    return weights.ravel()
+
+
+def build_radial_label_map(proportions: Sequence[float], size: Tuple[int, int],
+                           rng: np.random.Generator) -> np.ndarray:
+    """Радиальный паттерн: взвешенная по расстоянию выборка без возвращения.
+
+    Порядок выборки строится ключами Эфраимидиса–Спиракиса (Exp(1) / вес),
+    поэтому первые цвета тяготеют к центру так же, как при полярном
+    сэмплировании, а стоимость не зависит от заполненности холста.
+    """
+    def weighted_order(work_width: int, work_height: int) -> np.ndarray:
+        keys = rng.standard_exponential(work_width * work_height) / radial_weights(work_width, work_height)
+        return np.argsort(keys)
+
+    return _assign_in_order(proportions, size, weighted_order)
+
+
+def sample_granule_sizes(rng: np.random.Generator, count: int, min_size: int, max_size: int,
+                         variation: float, calibration: Dict[str, float]) -> np.ndarray:
+    """Векторный аналог _generate_variable_granule_size из scripts/benchmark_colormap.py."""
+    base_size = rng.integers(min_size, max_size + 1, size=count)
+    variation_factor = 1.0 + (rng.random(count) - 0.5) * variation * 2
+    variable_size = (base_size * variation_factor).astype(np.int64)
+    return np.clip(variable_size, calibration["min_granule_size"], calibration["max_granule_size"])
+
+
+def granule_offsets(reach: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Смещения (dx, dy) квадратного окна [-reach, reach]² в плоском виде."""
+    span = np.arange(-reach, reach + 1, dtype=np.int64)
+    dy, dx = np.meshgrid(span, span, indexing="ij")
+    return dx.ravel(), dy.ravel()
+
+
+def simple_granule_masks(rng: np.random.Generator, count: int, size: int,
+                         organic_factor: float) -> np.ndarray:
+    """Маски простых органических гранул (искаженный круг) на окне [-size, size]².
+
+    Как и в _draw_simple_organic_granule (scripts/benchmark_colormap.py), порог
+    радиуса искажается независимо для каждого пикселя.
+    """
+    dx, dy = granule_offsets(size)
+    base_radius = size // 2
+    distance = np.sqrt(dx * dx + dy * dy).astype(np.float32)
+    in_box = (np.abs(dx) <= base_radius) & (np.abs(dy) <= base_radius)
+    distortion = 1.0 + (rng.random((count, dx.size), dtype=np.float32) - 0.5) * (organic_factor * 0.3)
+    return in_box[None, :] & (distance[None, :] <= base_radius * distortion)
+
+
+def complex_granule_masks(rng: np.random.Generator, count: int, size: int,
+                          organic_factor: float) -> np.ndarray:
+    """Маски сложных органических гранул (многоугольник + ray casting) на окне [-size, size]².
+
+    Векторный аналог _draw_complex_organic_granule/_point_in_complex_shape:
+    вершины со случайным радиусом, чет-нечетный тест по ребрам и случайное
+    исключение части внутренних пикселей.
+    """
+    dx, dy = granule_offsets(size)
+    num_points = max(3, size // 2)
+    angles = 2 * math.pi * np.arange(num_points) / num_points
+    radius_variation = 1.0 + (rng.random((count, num_points)) - 0.5) * organic_factor
+    point_radius = (size // 2) * radius_variation
+    # int() в исходной реализации отбрасывает дробную часть к нулю
+    px = np.trunc(point_radius * np.cos(angles)[None, :]).astype(np.int64)
+    py = np.trunc(point_radius * np.sin(angles)[None, :]).astype(np.int64)
+
+    x = dx[None, :]
+    y = dy[None, :]
+    inside = np.zeros((count, dx.size), dtype=bool)
+    for i in range(num_points):
+        p1x, p1y = px[:, i:i + 1], py[:, i:i + 1]
+        j = (i + 1) % num_points
+        p2x, p2y = px[:, j:j + 1], py[:, j:j + 1]
+        crosses = (y > np.minimum(p1y, p2y)) & (y <= np.maximum(p1y, p2y)) & (x <= np.maximum(p1x, p2x))
+        denom = np.where(p1y != p2y, p2y - p1y, 1)
+        xinters = (y - p1y) * (p2x - p1x) / denom + p1x
+        inside ^= crosses & ((p1x == p2x) | (x <= xinters))
+
+    excluded = rng.random((count, dx.size), dtype=np.float32) < organic_factor * 0.2
+    return inside & ~excluded
+
+
+class GranuleAtlas:
+    """Атлас заранее растеризованных органических гранул.
+
+    Для каждого размера от min_granule_size до max_granule_size хранит
+    variants масок простой и сложной формы на окне [-size, size]²,
+    построенных с параметрами granule_calibration. Генераторы штампуют
+    готовые маски вместо растеризации каждой гранулы заново.
+    """
+
+    def __init__(self, masks: Dict[Tuple[bool, int], np.ndarray], variants: int):
+        self.masks = masks
+        self.variants = variants
+
+    @classmethod
+    def build(cls, calibration: Dict[str, float], variants: int, seed: int = 0) -> "GranuleAtlas":
+        """Растеризует variants масок каждого размера и типа формы."""
+        rng = np.random.default_rng(seed)
+        organic_factor = calibration["organic_factor"]
+        masks = {}
+        for size in range(calibration["min_granule_size"], calibration["max_granule_size"] + 1):
+            window = 2 * size + 1
+            masks[(False, size)] = simple_granule_masks(rng, variants, size, organic_factor).reshape(variants, window, window)
+            masks[(True, size)] = complex_granule_masks(rng, variants, size, organic_factor).reshape(variants, window, window)
+        return cls(masks, variants)
+
+    @staticmethod
+    def cache_key(calibration: Dict[str, float], variants: int, seed: int = 0) -> str:
+        """Ключ кэша: хеш параметров калибровки, числа вариантов и формата."""
+        payload = json.dumps({"calibration": calibration, "variants": variants, "seed": seed,
+                              "format": GRANULE_ATLAS_FORMAT}, sort_keys=True)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def load_or_build(cls, calibration: Dict[str, float], variants: int,
+                      cache_dir: Optional[str] = None, seed: int = 0) -> "GranuleAtlas":
+        """Загружает атлас из кэша на диске или строит и сохраняет его.
+
+        Ошибки чтения/записи кэша не критичны: атлас тогда строится в памяти.
+        """
+        if not cache_dir:
+            return cls.build(calibration, variants, seed)
+        path = os.path.join(cache_dir, f"granule_atlas_{cls.cache_key(calibration, variants, seed)}.npz")
+        if os.path.exists(path):
+            try:
+                atlas = cls.load(path)
+                logger.info(f"✅ Атлас гранул загружен из кэша: {path}")
+                return atlas
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка чтения кэша атласа гранул {path}: {e}")
+        atlas = cls.build(calibration, variants, seed)
+        try:
+            atlas.save(path)
+            logger.info(f"💾 Атлас гранул сохранен в кэш: {path} ({atlas.nbytes / 1024:.0f} KB)")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить атлас гранул в {path}: {e}")
+        return atlas
+
+    def save(self, path: str) -> None:
+        """Атомарно сохраняет маски атласа в .npz."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {f"{'complex' if complex_shape else 'simple'}_{size}": masks
+                  for (complex_shape, size), masks in self.masks.items()}
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "GranuleAtlas":
+        """Загружает атлас, сохраненный через save()."""
+        masks = {}
+        with np.load(path) as data:
+            for name in data.files:
+                family, size = name.split("_")
+                masks[(family == "complex", int(size))] = data[name].astype(bool)
+        variants = next(iter(masks.values())).shape[0]
+        return cls(masks, variants)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(masks.nbytes for masks in self.masks.values())
+
+    def has(self, complex_shape: bool, size: int) -> bool:
+        return (complex_shape, size) in self.masks
+
+    def sample(self, rng: np.random.Generator, complex_shape: bool, size: int, count: int) -> np.ndarray:
+        """Случайные маски count гранул в плоском виде (count, (2*size+1)²)."""
+        masks = self.masks[(complex_shape, size)]
+        variant_idx = rng.integers(0, masks.shape[0], size=count)
+        return masks[variant_idx].reshape(count, -1)
+
+
+def _rasterize_granules(rng: np.random.Generator, centers_x: np.ndarray, centers_y: np.ndarray,
+                        sizes: np.ndarray, is_complex: np.ndarray, work_width: int, work_height: int,
+                        organic_factor: float, atlas: Optional[GranuleAtlas] = None
+                        ) -> Tuple[np.ndarray, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]]:
+    """Растеризует батч гранул группами по (размер, тип формы).
+
+    При наличии атласа маски берутся из него, иначе растеризуются заново.
+    Возвращает число пикселей каждой гранулы (в пределах рабочей области)
+    и список групп (индексы гранул, x, y) с координатами закрашиваемых пикселей.
+    """
+    counts = np.zeros(sizes.size, dtype=np.int64)
+    groups = []
+    for size in np.unique(sizes):
+        size = int(size)
+        dx, dy = granule_offsets(size)
+        for complex_shape in (False, True):
+            idx = np.flatnonzero((sizes == size) & (is_complex == complex_shape))
+            if idx.size == 0:
+                continue
+            if atlas is not None and atlas.has(complex_shape, size):
+                masks = atlas.sample(rng, complex_shape, size, idx.size)
+            elif complex_shape:
+                masks = complex_granule_masks(rng, idx.size, size, organic_factor)
+            else:
+                masks = simple_granule_masks(rng, idx.size, size, organic_factor)
+            xs = centers_x[idx, None] + dx[None, :]
+            ys = centers_y[idx, None] + dy[None, :]
+            masks &= (xs >= 0) & (xs < work_width) & (ys >= 0) & (ys < work_height)
+            counts[idx] = masks.sum(axis=1)
+            granule_idx = np.broadcast_to(idx[:, None], masks.shape)[masks]
+            groups.append((granule_idx, xs[masks], ys[masks]))
+    return counts, groups
+
+
+def build_granular_label_map(pixel_quotas: Sequence[int], size: Tuple[int, int],
+                             granule_params: Dict[str, float], calibration: Dict[str, float],
+                             rng: np.random.Generator, atlas: Optional[GranuleAtlas] = None) -> np.ndarray:
+    """Строит карту меток гранулярного паттерна (резиновая крошка) батчами NumPy.
+
+    Семантика совпадает с попиксельной реализацией: цвета размещаются по
+    очереди, центры гранул выбираются среди еще свободных пикселей рабочей
+    области, гранула закрашивается целиком (поверх соседей), а цвет
+    завершается на грануле, после которой набрана его квота pixel_quotas[i].
+    Маски гранул штампуются из atlas (если передан) с отсечением по полям.
+    """
+    width, height = size
+    margin_x, margin_y, work_width, work_height = compute_work_area(size)
+    labels = np.zeros((height, width), dtype=np.uint8)
+    work = labels[margin_y:margin_y + work_height, margin_x:margin_x + work_width]
+    if work_width <= 0 or work_height <= 0:
+        return labels
+
+    min_size = granule_params["min_size"]
+    max_size = granule_params["max_size"]
+    variation = granule_params["variation"]
+    organic_factor = calibration["organic_factor"]
+    form_complexity = calibration["form_complexity"]
+
+    # Начальная оценка площади гранулы, уточняется по факту после каждого батча
+    mean_area = max(1.0, math.pi * ((min_size + max_size) / 4.0) ** 2)
+
+    for color_idx, quota in enumerate(pixel_quotas):
+        label = color_idx + 1
+        remaining = int(quota)
+        while remaining > 0:
+            free = np.flatnonzero(work.ravel() == 0)
+            if free.size == 0:
+                return labels
+            count = min(GRANULE_BATCH_LIMIT, free.size, max(1, math.ceil(remaining / mean_area)))
+            centers = rng.choice(free, size=count, replace=False)
+            centers_y, centers_x = np.divmod(centers, work_width)
+            sizes = sample_granule_sizes(rng, count, min_size, max_size, variation, calibration)
+            is_complex = rng.random(count) < form_complexity
+
+            counts, groups = _rasterize_granules(rng, centers_x, centers_y, sizes, is_complex,
+                                                 work_width, work_height, organic_factor, atlas)
+            # Отсекаем гранулы после той, на которой квота цвета набрана
+            cumulative = np.cumsum(counts)
+            keep = min(count, int(np.searchsorted(cumulative, remaining)) + 1)
+            for granule_idx, xs, ys in groups:
+                selected = granule_idx < keep
+                work[ys[selected], xs[selected]] = label
+
+            placed = int(cumulative[keep - 1])
+            remaining -= placed
+            if placed > 0:
+                mean_area = max(1.0, placed / keep)
+    return labels
+
+
+def downsample_label_map(label_map: LabelMap, size: Tuple[int, int], rng: np.random.Generator) -> LabelMap:
+    """Уменьшает карту меток с сохранением долей меток (включая фон).
+
+    При целом коэффициенте f каждый блок f×f получает метку случайного своего
+    пикселя (вероятность метки равна ее площади в блоке), после чего часть
+    смешанных блоков переназначается так, чтобы число блоков каждой метки
+    точно совпало с allocate_quotas от счетчиков исходной карты. Однородные
+    блоки (внутренности гранул и полос) не меняются. Нецелый коэффициент —
+    ближайший сосед.
+    """
+    width, height = size
+    source_width, source_height = label_map.size
+    if (width, height) == (source_width, source_height):
+        return label_map
+    if source_width % width or source_height % height or source_width // width != source_height // height:
+        return label_map.resized(size)
+
+    factor = source_width // width
+    block_count = width * height
+    blocks = (label_map.labels.reshape(height, factor, width, factor)
+              .transpose(0, 2, 1, 3).reshape(block_count, factor * factor))
+    picked = blocks[np.arange(block_count), rng.integers(0, factor * factor, block_count)]
+
+    label_count = len(label_map.rgb_colors) + 1
+    targets = allocate_quotas(label_map.pixel_counts(), block_count)
+    current = np.bincount(picked, minlength=label_count)
+    for over in np.flatnonzero(current > targets):
+        for under in np.flatnonzero(current < targets):
+            moves = min(current[over] - targets[over], targets[under] - current[under])
+            if moves <= 0:
+                continue
+            candidates = np.flatnonzero((picked == over) & (blocks == under).any(axis=1))
+            if candidates.size == 0:
+                continue
+            chosen = rng.choice(candidates, size=min(int(moves), candidates.size), replace=False)
+            picked[chosen] = under
+            current[over] -= chosen.size
+            current[under] += chosen.size
+    return LabelMap(picked.reshape(height, width), label_map.rgb_colors)
+
+
+def build_label_pyramid(label_map: LabelMap, levels: Sequence[int] = PYRAMID_LEVELS,
+                        rng: Optional[np.random.Generator] = None) -> Dict[int, LabelMap]:
+    """Пирамида карты меток за один проход: {ширина уровня: LabelMap}.
+
+    Каждый уровень уменьшается от исходной карты (ошибки не накапливаются);
+    исходная карта входит в пирамиду под своей шириной, уровни шире нее
+    пропускаются.
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    base_width, base_height = label_map.size
+    pyramid = {base_width: label_map}
+    for level in sorted(levels, reverse=True):
+        if level >= base_width:
+            continue
+        level_height = max(1, round(base_height * level / base_width))
+        pyramid[level] = downsample_label_map(label_map, (level, level_height), rng)
+    return pyramid
+
+
+def count_opaque_colors(colormap: Any, alpha_threshold: int = 128) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Уникальные непрозрачные цвета colormap и число их пикселей.
+
+    Принимает LabelMap (счетчики меток без построения RGBA) или PIL-изображение
+    RGBA/RGB/L (упакованный ключ 0xRRGGBB + np.unique). Цвета возвращаются в
+    порядке первого появления; третий элемент — общее число пикселей.
+    """
+    if isinstance(colormap, LabelMap):
+        counts = colormap.pixel_counts()[1:]
+        present = np.flatnonzero(counts)
+        rgb = np.asarray(colormap.rgb_colors, dtype=np.uint8).reshape(-1, 3)[present]
+        return rgb, counts[present].astype(np.int64), colormap.labels.size
+
+    array = np.asarray(colormap)
+    total = array.shape[0] * array.shape[1]
+    if array.ndim == 2:
+        pixels = np.repeat(array.reshape(-1, 1), 3, axis=1)
+    elif array.shape[2] == 4:
+        pixels = array[:, :, :3][array[:, :, 3] > alpha_threshold]
+    elif array.shape[2] == 3:
+        pixels = array.reshape(-1, 3)
+    else:
+        raise ValueError(f"Неподдерживаемый формат colormap: {array.shape}")
+    if pixels.size == 0:
+        return np.zeros((0, 3), dtype=np.uint8), np.zeros(0, dtype=np.int64), total
+
+    pixels = pixels.astype(np.uint32)
+    keys = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+    unique_keys, first_index, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first_index, kind="stable")
+    unique_keys = unique_keys[order]
+    rgb = np.stack([(unique_keys >> 16) & 255, (unique_keys >> 8) & 255, unique_keys & 255], axis=1).astype(np.uint8)
+    return rgb, counts[order].astype(np.int64), total
+
+
+def cluster_colors(rgb: np.ndarray, counts: np.ndarray, tolerance: int = 10,
+                   max_clusters: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Жадно объединяет цвета, отличающиеся не более чем на tolerance по каждому каналу.
+
+    Семантика исходного попиксельного валидатора: цвет попадает в первый ранее
+    найденный кластер в пределах допуска, иначе открывает новый. Обход идет по
+    уникальным цветам, а не по пикселям. При max_clusters обход останавливается,
+    как только кластеров стало больше (вердикт уже известен).
+    """
+    representatives: List[np.ndarray] = []
+    cluster_counts: List[int] = []
+    rgb = rgb.astype(np.int16)
+    for color, count in zip(rgb, counts):
+        if representatives:
+            close = np.all(np.abs(np.asarray(representatives) - color) <= tolerance, axis=1)
+            if close.any():
+                cluster_counts[int(np.argmax(close))] += int(count)
+                continue
+        representatives.append(color)
+        cluster_counts.append(int(count))
+        if max_clusters is not None and len(representatives) > max_clusters:
+            break
+    return (np.asarray(representatives, dtype=np.uint8).reshape(-1, 3),
+            np.asarray(cluster_counts, dtype=np.int64))
+
+
+def analyze_colormap_colors(colormap: Any, targets: Sequence[Dict[str, Any]], tolerance: int = 10,
+                            alpha_threshold: int = 128) -> Dict[str, Any]:
+    """Структурированный отчет о цветах colormap относительно ожидаемых.
+
+    targets — список {"name", "rgb", "proportion"}. Карта валидна, если число
+    кластеров цветов (допуск tolerance) не меньше половины и не больше удвоенного
+    числа ожидаемых цветов. Для каждого ожидаемого цвета отчет содержит долю
+    его пикселей среди непрозрачных рядом с целевой долей.
+    """
+    rgb, counts, total = count_opaque_colors(colormap, alpha_threshold)
+    expected_count = len(targets)
+    opaque = int(counts.sum())
+    _, cluster_counts = cluster_colors(rgb, counts, tolerance, max_clusters=2 * expected_count)
+    found_count = int(cluster_counts.size)
+
+    per_color = []
+    target_sum = sum(float(target.get("proportion", 0)) for target in targets)
+    for target in targets:
+        target_rgb = np.asarray(target["rgb"][:3], dtype=np.int16)
+        within = np.all(np.abs(rgb.astype(np.int16) - target_rgb) <= tolerance, axis=1) if rgb.size else np.zeros(0, bool)
+        pixels = int(counts[within].sum())
+        share = pixels / opaque if opaque else 0.0
+        target_share = float(target.get("proportion", 0)) / target_sum if target_sum > 0 else 0.0
+        per_color.append({
+            "name": target["name"],
+            "rgb": [int(c) for c in target["rgb"][:3]],
+            "target": round(target_share, 4),
+            "share": round(share, 4),
+            "delta": round(share - target_share, 4),
+            "pixels": pixels
+        })
+
+    if opaque == 0:
+        reason = "transparent"
+    elif found_count < expected_count * 0.5:
+        reason = "too_few_colors"
+    elif found_count > expected_count * 2:
+        reason = "too_many_colors"
+    else:
+        reason = None
+    return {
+        "valid": reason is None,
+        "reason": reason,
+        "expected_count": expected_count,
+        "found_count": found_count,
+        "opaque_pixels": opaque,
+        "total_pixels": int(total),
+        "tolerance": tolerance,
+        "colors": per_color
+    }
+
+
+def measure_color_fidelity(image: Image.Image, targets: Sequence[Dict[str, Any]],
+                           sample_size: int = 256, tolerance: float = FIDELITY_COLOR_TOLERANCE) -> Dict[str, Any]:
+    """Цветовая точность сгенерированного изображения относительно целевых цветов.
+
+    targets — список {"name", "rgb", "proportion"}. Пиксели уменьшенной копии
+    (ближайший сосед, без смешивания цветов на границах гранул) относятся к
+    ближайшему целевому цвету, если он ближе tolerance, иначе — к «чужим» цветам
+    (off_target, целевая доля 0); доли сравниваются с целевыми. fidelity —
+    1 минус половина суммы |доля − цель| с учетом off_target (1.0 — пропорции
+    совпали, изображение в чужих цветах — около 0), mean_color_error — среднее
+    RGB-расстояние пикселя до ближайшего целевого цвета.
+    """
+    if not targets:
+        return {"fidelity": None, "mean_color_error": None, "off_target": None, "colors": []}
+    sample = image.convert("RGB").resize((sample_size, sample_size), Image.Resampling.NEAREST)
+    pixels = np.asarray(sample, dtype=np.float32).reshape(-1, 3)
+    palette = np.asarray([target["rgb"][:3] for target in targets], dtype=np.float32)
+    distances = ((pixels[:, None, :] - palette[None, :, :]) ** 2).sum(axis=2)
+    nearest = distances.argmin(axis=1)
+    # Пиксели дальше tolerance от всех целевых цветов идут в отдельную корзину с индексом len(targets)
+    nearest[distances.min(axis=1) > tolerance ** 2] = len(targets)
+    counts = np.bincount(nearest, minlength=len(targets) + 1)
+    shares = counts[:len(targets)] / len(nearest)
+    off_target = float(counts[len(targets)]) / len(nearest)
+    target_sum = sum(float(target.get("proportion", 0)) for target in targets)
+
+    per_color = []
+    for target, share in zip(targets, shares):
+        target_share = float(target.get("proportion", 0)) / target_sum if target_sum > 0 else 1.0 / len(targets)
+        per_color.append({
+            "name": target["name"],
+            "target": round(target_share, 4),
+            "share": round(float(share), 4),
+            "delta": round(float(share) - target_share, 4)
+        })
+    total_delta = sum(abs(float(share) - color["target"]) for color, share in zip(per_color, shares)) + off_target
+    return {
+        "fidelity": round(max(0.0, 1.0 - total_delta / 2), 4),
+        "mean_color_error": round(float(np.sqrt(distances.min(axis=1)).mean()), 2),
+        "off_target": round(off_target, 4),
+        "colors": per_color
+    }
+
+
+def colormap_cache_key(colors: Sequence[Dict[str, Any]], size: Tuple[int, int], pattern_type: str,
+                       granule_size: str, seed: int, engine: Optional[Dict[str, Any]] = None) -> str:
+    """Ключ кэша colormap: нормализованные цвета и доли, размер, паттерн, гранулы, seed и параметры
+    движка engine (калибровка гранул, атлас): дисковый кэш переживает перезапуск, и карты,
+    построенные с другим атласом или калибровкой, не должны из него отдаваться."""
+    total_proportion = sum(color.get("proportion", 0) for color in colors)
+    normalized = [(str(color.get("name", "white")).upper(),
+                   round(color.get("proportion", 0) / max(1e-8, total_proportion), 6))
+                  for color in colors]
+    engine = {"atlas_format": GRANULE_ATLAS_FORMAT, "margin": MARGIN_FRACTION, **(engine or {})}
+    payload = json.dumps([normalized, list(size), pattern_type, granule_size, seed, engine], sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class ColormapCache:
+    """LRU-кэш карт меток colormap между запросами с бюджетом в байтах.
+
+    Первый уровень — в памяти процесса; при заданном disk_dir записи
+    дублируются на диск (.npz) и поднимаются обратно в память при промахе.
+    Кэш хранит только метки и палитру и отдает каждому вызывающему свою
+    LabelMap.view(): RGBA и хинт, отрендеренные запросом, живут вместе с
+    запросом и не раздувают память кэша сверх max_bytes.
+    Счетчики hits/misses/evictions/disk_hits лежат в stats.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.current_bytes = 0
+        self._entries: "OrderedDict[str, LabelMap]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "disk_hits": 0, "entries": 0, "bytes": 0}
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"colormap_{key}.npz")
+
+    def get(self, key: str) -> Optional[LabelMap]:
+        """Возвращает свою копию закэшированной карты или None (промах)."""
+        with self._lock:
+            label_map = self._entries.get(key)
+            if label_map is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return label_map.view()
+        label_map = self._load_from_disk(key)
+        with self._lock:
+            if label_map is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.stats["disk_hits"] += 1
+        self._store(key, label_map)
+        return label_map.view()
+
+    def put(self, key: str, label_map: LabelMap) -> None:
+        """Сохраняет карту в памяти (с вытеснением по LRU) и на диске, если он включен."""
+        self._store(key, label_map)
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                path = self._disk_path(key)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, labels=label_map.labels, palette=np.array(label_map.rgb_colors, dtype=np.uint8).reshape(-1, 3))
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось сохранить colormap в дисковый кэш: {e}")
+
+    def _store(self, key: str, label_map: LabelMap) -> None:
+        label_map = label_map.view()
+        nbytes = label_map.nbytes
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._entries[key] = label_map
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+            self.stats["entries"] = len(self._entries)
+            self.stats["bytes"] = self.current_bytes
+
+    def _load_from_disk(self, key: str) -> Optional[LabelMap]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return LabelMap(data["labels"], [tuple(rgb) for rgb in data["palette"]])
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка чтения дискового кэша colormap {path}: {e}")
+            return None
+
+
+class ColormapArtifact:
+    """Colormap одного запроса: строится один раз, из него берутся все производные.
+
+    Хранит палитровую карту меток; RGBA colormap, L-хинт и уровни пирамиды
+    (легенда — уровень 256) выводятся из нее лениво, каждый уровень — только
+    при обращении к нему. Один и тот же объект
+    используется для хинта ControlNet, валидации, сохранения colormap, легенды
+    и generation_data.json.
+    """
+
+    LEGEND_SIZE = 256
+
+    def __init__(self, colors: List[Dict[str, Any]], label_map: LabelMap,
+                 seed: Optional[int], pattern_type: str, granule_size: str, generation_seconds: float):
+        self.colors = colors
+        self.label_map = label_map
+        self.seed = seed
+        self.pattern_type = pattern_type
+        self.granule_size = granule_size
+        self.generation_seconds = generation_seconds
+        self.generations = 1
+        self.rebuilt = False
+        self.validation: Optional[Dict[str, Any]] = None
+        self._levels: Dict[int, LabelMap] = {}
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.label_map.size
+
+    @property
+    def colormap(self) -> Image.Image:
+        return self.label_map.rgba
+
+    @property
+    def hint(self) -> Image.Image:
+        return self.label_map.hint
+
+    @property
+    def pyramid(self) -> Dict[int, LabelMap]:
+        """Пирамида как build_label_pyramid(): исходная карта и уровни PYRAMID_LEVELS уже нее
+        (строит недостающие)."""
+        base_width = self.size[0]
+        return {base_width: self.label_map,
+                **{width: self.level(width) for width in PYRAMID_LEVELS if width < base_width}}
+
+    def level(self, width: int) -> LabelMap:
+        """Уровень заданной ширины с сохранением долей: строится при первом обращении
+        из исходной карты (ширина исходной — сама исходная карта)."""
+        base_width, base_height = self.size
+        if width == base_width:
+            return self.label_map
+        if width not in self._levels:
+            height = max(1, round(base_height * width / base_width))
+            self._levels[width] = downsample_label_map(self.label_map, (width, height), np.random.default_rng(self.seed))
+        return self._levels[width]
+
+    @property
+    def legend(self) -> LabelMap:
+        """Легенда LEGEND_SIZE×LEGEND_SIZE — уровень пирамиды."""
+        return self.level(self.LEGEND_SIZE)
+
+    def replace(self, label_map: LabelMap, generation_seconds: float) -> None:
+        """Заменяет карту после принудительной пересборки (провал валидации)."""
+        self.label_map = label_map
+        self.generation_seconds += generation_seconds
+        self.generations += 1
+        self.rebuilt = True
+        self._levels = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Описание карты для generation_data.json."""
+        counts = self.label_map.pixel_counts()
+        return {
+            "colors": self.colors,
+            "seed": self.seed,
+            "pattern_type": self.pattern_type,
+            "granule_size": self.granule_size,
+            "size": list(self.size),
+            "palette": [list(rgb) for rgb in self.label_map.rgb_colors],
+            "pixel_counts": counts[1:].tolist(),
+            "transparent_pixels": int(counts[0]),
+            "generations": self.generations,
+            "rebuilt": self.rebuilt,
+            "generation_ms": round(self.generation_seconds * 1000, 1),
+            "validation": self.validation
+        }
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Пул ControlNet: модели загружаются заранее (в setup или фоновым потоком сразу
+после него), а pipeline-варианты строятся один раз и делят UNet, VAE и
+текстовые энкодеры базового pipeline.
+
+Модуль не импортирует diffusers/PyTorch: загрузка модели и сборка pipeline
+передаются функциями load_model(source) и build_pipeline(controlnet), поэтому
+пул можно проверять на заглушках.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Состояния модели в пуле
+STATE_PENDING = "pending"
+STATE_LOADING = "loading"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+
+
+def parse_controlnet_specs(value: str) -> Dict[str, str]:
+    """Разбирает спецификацию вида 'name=source,name2=source2' (source — repo id или путь)."""
+    specs: Dict[str, str] = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        name, source = item.split("=", 1)
+        if name.strip() and source.strip():
+            specs[name.strip()] = source.strip()
+    return specs
+
+
+class ControlNetPool:
+    """Заранее загруженные ControlNet и собранные из них pipeline.
+
+    specs — {имя: источник}. preload() загружает все модели (или фоном при
+    background=True); model(name) ждет загрузку при необходимости, pipeline(names)
+    возвращает pipeline с одной моделью или списком моделей (multi-ControlNet),
+    собранный один раз на набор имен. status()/is_ready() сообщают готовность.
+    """
+
+    def __init__(self, specs: Dict[str, str], load_model: Callable[[str], Any],
+                 build_pipeline: Callable[[Union[Any, List[Any]]], Any]):
+        self.specs = dict(specs)
+        self.load_model = load_model
+        self.build_pipeline = build_pipeline
+        self._models: Dict[str, Any] = {}
+        self._states: Dict[str, str] = {name: STATE_PENDING for name in self.specs}
+        self._errors: Dict[str, str] = {}
+        self._load_seconds: Dict[str, float] = {}
+        self._pipelines: Dict[Tuple[str, ...], Any] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def preload(self, names: Optional[Sequence[str]] = None, background: bool = False,
+                pipelines: Sequence[Sequence[str]] = ()) -> Optional[threading.Thread]:
+        """Загружает модели (все по умолчанию) и собирает pipeline для наборов pipelines;
+        при background — в отдельном потоке."""
+        names = list(names) if names is not None else list(self.specs)
+
+        def run() -> None:
+            for name in names:
+                self._load(name)
+            for pipeline_names in pipelines:
+                try:
+                    self.pipeline(pipeline_names)
+                except Exception as e:
+                    logger.error(f"❌ Не удалось собрать ControlNet pipeline {list(pipeline_names)}: {e}")
+
+        if not background:
+            run()
+            return None
+        self._thread = threading.Thread(target=run, name="controlnet-preload", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def _load(self, name: str) -> None:
+        with self._condition:
+            if self._states.get(name) != STATE_PENDING:
+                return
+            self._states[name] = STATE_LOADING
+        start_time = time.perf_counter()
+        try:
+            model = self.load_model(self.specs[name])
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить ControlNet '{name}' ({self.specs[name]}): {e}")
+            with self._condition:
+                self._states[name] = STATE_FAILED
+                self._errors[name] = str(e)
+                self._condition.notify_all()
+            return
+        elapsed = time.perf_counter() - start_time
+        with self._condition:
+            self._models[name] = model
+            self._states[name] = STATE_READY
+            self._load_seconds[name] = round(elapsed, 2)
+            self._condition.notify_all()
+        logger.info(f"✅ ControlNet '{name}' загружен в пул за {elapsed:.1f} с")
+
+    def model(self, name: str, wait: bool = True, timeout: Optional[float] = None) -> Optional[Any]:
+        """Модель по имени; незагруженная модель грузится здесь же (или ожидается у фонового потока)."""
+        if name not in self.specs:
+            return None
+        with self._condition:
+            state = self._states[name]
+        if state == STATE_PENDING:
+            logger.warning(f"⚠️ ControlNet '{name}' не был предзагружен, загружаем на пути запроса")
+            self._load(name)
+        with self._condition:
+            if wait:
+                self._condition.wait_for(lambda: self._states[name] in (STATE_READY, STATE_FAILED), timeout=timeout)
+            return self._models.get(name)
+
+    def pipeline(self, names: Union[str, Sequence[str]], wait: bool = True) -> Optional[Any]:
+        """Pipeline для набора ControlNet (порядок имен = порядок изображений и весов); строится один раз."""
+        key = (names,) if isinstance(names, str) else tuple(names)
+        with self._condition:
+            cached = self._pipelines.get(key)
+        if cached is not None:
+            return cached
+        models = [self.model(name, wait=wait) for name in key]
+        if not models or any(model is None for model in models):
+            return None
+        pipe = self.build_pipeline(models[0] if len(models) == 1 else models)
+        with self._condition:
+            return self._pipelines.setdefault(key, pipe)
+
+    def is_ready(self, names: Optional[Sequence[str]] = None) -> bool:
+        """Все указанные (или все) модели загружены."""
+        names = list(names) if names is not None else list(self.specs)
+        with self._condition:
+            return all(self._states.get(name) == STATE_READY for name in names)
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Ждет окончания загрузки всех моделей (успешной или нет); True, если все готовы."""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: all(state in (STATE_READY, STATE_FAILED) for state in self._states.values()), timeout=timeout
+            )
+        return self.is_ready()
+
+    def status(self) -> Dict[str, Any]:
+        """Готовность пула для логов и health-check."""
+        with self._condition:
+            return {
+                "ready": all(state == STATE_READY for state in self._states.values()),
+                "models": dict(self._states),
+                "load_seconds": dict(self._load_seconds),
+                "errors": dict(self._errors),
+                "pipelines": ["+".join(key) for key in self._pipelines]
+            }
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Постобработка декодированных изображений на устройстве.
+
+При output_type="pil" diffusers переносит float-тензоры на CPU, денормализует
+их в NumPy и строит PIL, а превью затем уменьшается LANCZOS на CPU. Здесь
+клэмп, перевод в uint8 и уменьшение превью выполняются на GPU, а на хост через
+закрепленную (pinned) память копируются только байты uint8 — в 4 раза меньше
+float32. Изображения pipeline приходят с output_type="pt" (диапазон [0, 1]).
+"""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+
+def to_uint8_hwc(images: torch.Tensor) -> torch.Tensor:
+    """[0, 1] (B, 3, H, W) -> uint8 (B, H, W, 3) на том же устройстве (округление как в numpy_to_pil)."""
+    return images.float().mul(255).round().clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+
+
+def downsample(images: torch.Tensor, size: int) -> torch.Tensor:
+    """Уменьшает (B, 3, H, W) до size×size бикубикой с антиалиасингом (замена LANCZOS на CPU)."""
+    if tuple(images.shape[-2:]) == (size, size):
+        return images
+    resized = F.interpolate(images.float(), size=(size, size), mode="bicubic", antialias=True, align_corners=False)
+    return resized.clamp(0, 1)
+
+
+def to_host(*tensors: torch.Tensor) -> List[np.ndarray]:
+    """Копирует тензоры на хост: с CUDA — асинхронно в закрепленные буферы и одна синхронизация."""
+    if not tensors or tensors[0].device.type != "cuda":
+        return [tensor.cpu().numpy() for tensor in tensors]
+    host_tensors = []
+    for tensor in tensors:
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host.copy_(tensor, non_blocking=True)
+        host_tensors.append(host)
+    torch.cuda.current_stream(tensors[0].device).synchronize()
+    return [host.numpy() for host in host_tensors]
+
+
+def postprocess(images: torch.Tensor, preview_size: Optional[int] = None) -> List[Tuple[Image.Image, Optional[Image.Image]]]:
+    """Изображения pipeline (output_type="pt") -> пары (финал, превью preview_size×preview_size или None).
+    PIL строится из uint8-буферов хоста без промежуточного float на CPU."""
+    with torch.no_grad():
+        device_buffers = [to_uint8_hwc(images)]
+        if preview_size:
+            device_buffers.append(to_uint8_hwc(downsample(images, preview_size)))
+        host_buffers = to_host(*device_buffers)
+    finals = host_buffers[0]
+    previews = host_buffers[1] if preview_size else None
+    return [
+        (Image.fromarray(finals[index], "RGB"),
+         Image.fromarray(previews[index], "RGB") if previews is not None else None)
+        for index in range(finals.shape[0])
+    ]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Манифест заранее слитого чекпоинта SDXL (LoRA в UNet, токены TI в токенизаторах
+и эмбеддингах), который собирает scripts/build_fused_checkpoint.py.
+
+Манифест хранит отпечатки исходных файлов LoRA/TI и параметры сборки: setup
+загружает слитый чекпоинт, только если он собран из тех же файлов с тем же весом
+LoRA, иначе идет старым путем (базовая модель + LoRA + TI). Модуль не зависит от PyTorch.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "fused_manifest.json"
+MANIFEST_VERSION = 1
+
+# Сколько байт с начала и конца файла входит в отпечаток (весь файл хэшировать на старте долго)
+FINGERPRINT_CHUNK_BYTES = 1024 * 1024
+
+# Вес LoRA: общий для рантайм-пути (fuse_lora в Predictor.setup) и сборки слитого чекпоинта.
+# 1.0 — вес, с которым LoRA всегда вливалась в рантайме (fuse_lora() по умолчанию)
+LORA_SCALE = 1.0
+
+
+def file_fingerprint(path: str) -> Optional[str]:
+    """Отпечаток файла: размер и SHA-1 первого и последнего мегабайта; None, если файла нет."""
+    if not os.path.isfile(path):
+        return None
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode("ascii"))
+    with open(path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_CHUNK_BYTES))
+        if size > FINGERPRINT_CHUNK_BYTES:
+            f.seek(max(FINGERPRINT_CHUNK_BYTES, size - FINGERPRINT_CHUNK_BYTES))
+            digest.update(f.read(FINGERPRINT_CHUNK_BYTES))
+    return f"{size}:{digest.hexdigest()}"
+
+
+def write_manifest(checkpoint_dir: str, sources: Dict[str, str], **extra: Any) -> Dict[str, Any]:
+    """Записывает манифест: пути и отпечатки исходников плюс параметры сборки (extra)."""
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "sources": {name: {"path": path, "fingerprint": file_fingerprint(path)} for name, path in sources.items()},
+        **extra
+    }
+    with open(os.path.join(checkpoint_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def read_manifest(checkpoint_dir: str) -> Optional[Dict[str, Any]]:
+    """Манифест слитого чекпоинта или None (нет чекпоинта, поврежден, другая версия формата)."""
+    path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Манифест слитого чекпоинта не читается ({path}): {e}")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def stale_sources(manifest: Dict[str, Any], sources: Dict[str, str]) -> List[str]:
+    """Имена исходников, которые изменились с момента сборки (пустой список — чекпоинт актуален).
+    Отсутствующий на диске исходник не считается изменением: в образе могут лежать только слитые веса."""
+    recorded = manifest.get("sources", {})
+    stale = []
+    for name, path in sources.items():
+        fingerprint = file_fingerprint(path)
+        if name not in recorded or (fingerprint is not None and fingerprint != recorded[name].get("fingerprint")):
+            stale.append(name)
+    return stale
+
+
+def stale_parameters(manifest: Dict[str, Any], **expected: Any) -> List[str]:
+    """Имена параметров сборки, которые в манифесте отличаются от ожидаемых (или не записаны):
+    например, чекпоинт, слитый с другим lora_scale, дает другие изображения, чем рантайм-путь."""
+    return [name for name, value in expected.items() if manifest.get(name) != value]
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Расписание classifier-free guidance: когда отключать безусловную ветку UNet.
+
+Каждый шаг с CFG прогоняет UNet на удвоенном батче (условная и безусловная
+ветки). На поздних шагах вклад guidance мал, поэтому после доли шагов
+cutoff_fraction или когда относительная разница ветвей
+||cond − uncond|| / ||cond|| падает ниже delta_threshold безусловная ветка
+отключается и оставшиеся шаги идут на половинном батче. Модуль не зависит
+от PyTorch: решение принимается по номеру шага и измеренной разнице.
+"""
+
+import math
+from typing import Any, Dict, Optional
+
+# Раньше этой доли шагов порог разницы ветвей не срабатывает (ранние шаги задают композицию)
+DELTA_MIN_FRACTION = 0.25
+
+
+class GuidanceSchedule:
+    """Условие отключения безусловной ветки CFG.
+
+    cutoff_fraction — доля шагов (0, 1], после которой ветка отключается;
+    delta_threshold — порог относительной разницы ветвей (срабатывает не раньше
+    min_fraction шагов). Без обоих условий — полный CFG на всех шагах.
+    Строковое представление совпадает со спецификацией parse_guidance_schedule().
+    """
+
+    def __init__(self, cutoff_fraction: Optional[float] = None, delta_threshold: Optional[float] = None,
+                 min_fraction: float = DELTA_MIN_FRACTION):
+        if cutoff_fraction is not None and not 0.0 < cutoff_fraction <= 1.0:
+            raise ValueError(f"Доля шагов CFG должна быть в (0, 1]: {cutoff_fraction}")
+        if delta_threshold is not None and delta_threshold <= 0.0:
+            raise ValueError(f"Порог разницы ветвей CFG должен быть положительным: {delta_threshold}")
+        self.cutoff_fraction = cutoff_fraction
+        self.delta_threshold = delta_threshold
+        self.min_fraction = min_fraction
+
+    @property
+    def enabled(self) -> bool:
+        """Есть ли условие отключения (иначе полный CFG)."""
+        return self.cutoff_fraction is not None or self.delta_threshold is not None
+
+    @property
+    def needs_delta(self) -> bool:
+        """Нужен ли замер разницы ветвей на каждом шаге."""
+        return self.delta_threshold is not None
+
+    def cutoff_step(self, total_steps: int) -> Optional[int]:
+        """Шаг (с 1), после которого ветка отключается по доле шагов; None — условия нет."""
+        if self.cutoff_fraction is None:
+            return None
+        return max(1, math.ceil(self.cutoff_fraction * total_steps))
+
+    def should_truncate(self, step: int, total_steps: int, delta: Optional[float] = None) -> bool:
+        """Отключать ли безусловную ветку после шага step (с 1) из total_steps."""
+        if step >= total_steps:
+            return False
+        cutoff_step = self.cutoff_step(total_steps)
+        if cutoff_step is not None and step >= cutoff_step:
+            return True
+        return (self.delta_threshold is not None and delta is not None
+                and step >= self.min_fraction * total_steps and delta < self.delta_threshold)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"schedule": str(self), "cutoff_fraction": self.cutoff_fraction, "delta_threshold": self.delta_threshold}
+
+    def __str__(self) -> str:
+        parts = []
+        if self.cutoff_fraction is not None:
+            parts.append(f"cutoff:{self.cutoff_fraction:g}")
+        if self.delta_threshold is not None:
+            parts.append(f"delta:{self.delta_threshold:g}")
+        return ",".join(parts) or "full"
+
+
+def parse_guidance_schedule(spec: str) -> GuidanceSchedule:
+    """'full' | 'cutoff:0.6' | 'delta:0.05' | 'cutoff:0.6,delta:0.05' -> GuidanceSchedule."""
+    spec = (spec or "").strip().lower()
+    if spec in ("", "full"):
+        return GuidanceSchedule()
+    options: Dict[str, float] = {}
+    for part in spec.split(","):
+        name, _, value = part.strip().partition(":")
+        if name not in ("cutoff", "delta") or not value:
+            raise ValueError(f"Неизвестное расписание CFG: '{spec}' (ожидается full, cutoff:<доля>, delta:<порог>)")
+        try:
+            options[name] = float(value)
+        except ValueError:
+            raise ValueError(f"Некорректное значение в расписании CFG: '{part}'") from None
+    return GuidanceSchedule(options.get("cutoff"), options.get("delta"))
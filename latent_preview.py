@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Дешевые превью шагов денойзинга из латентов.
+
+Каждые N шагов текущие латенты переводятся в маленькое RGB-изображение
+линейной проекцией 4 латентных каналов SDXL в RGB (или переданным легким
+декодером, например TAESD) без полного VAE, сохраняются в JPEG и ставятся в
+очередь, из которой predict() отдает их клиенту, пока UNet продолжает работу.
+Модуль не импортирует PyTorch: проекция работает на массивах NumPy.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Iterator, Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Линейная проекция латентов SDXL (4 канала, масштаб pipeline) в RGB [-1, 1]
+SDXL_LATENT_RGB_FACTORS = np.array([
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+], dtype=np.float32)
+SDXL_LATENT_RGB_BIAS = np.array([0.1084, -0.0175, -0.0011], dtype=np.float32)
+
+
+def latents_to_rgb(latents: np.ndarray, factors: np.ndarray = SDXL_LATENT_RGB_FACTORS,
+                   bias: np.ndarray = SDXL_LATENT_RGB_BIAS) -> Image.Image:
+    """Латенты одного сэмпла (C, H, W) -> RGB-изображение H×W линейной проекцией каналов."""
+    latents = np.asarray(latents, dtype=np.float32)
+    rgb = np.tensordot(latents, factors, axes=([0], [0])) + bias
+    rgb = np.clip((rgb + 1.0) * 127.5, 0, 255).astype(np.uint8)
+    return Image.fromarray(rgb, "RGB")
+
+
+class LatentPreviewer:
+    """Превью запроса: decode(latent) -> Image, JPEG в output_dir и очередь путей.
+
+    add(step, latent, variant) вызывается из callback pipeline на шагах, где
+    should_preview() истинно (каждые every_n_steps, кроме последнего);
+    stream(future) отдает пути по мере появления, пока идет генерация, и
+    дочитывает очередь после ее завершения.
+    """
+
+    def __init__(self, every_n_steps: int, output_dir: str,
+                 decode: Optional[Callable[[Any], Image.Image]] = None,
+                 max_size: int = 256, quality: int = 70):
+        self.every_n_steps = max(0, int(every_n_steps))
+        self.output_dir = output_dir
+        self.decode = decode or latents_to_rgb
+        self.max_size = max_size
+        self.quality = quality
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._lock = threading.Lock()
+        self.stats = {"previews": 0, "seconds": 0.0}
+
+    def should_preview(self, step: int, total_steps: int) -> bool:
+        """Нужно ли превью после шага step (с 1) из total_steps."""
+        return self.every_n_steps > 0 and step < total_steps and step % self.every_n_steps == 0
+
+    def add(self, step: int, latent: Any, variant: int = 0) -> Optional[str]:
+        """Декодирует латент сэмпла в превью, сохраняет JPEG и ставит путь в очередь."""
+        start_time = time.perf_counter()
+        try:
+            image = self.decode(latent)
+            if max(image.size) > self.max_size:
+                image.thumbnail((self.max_size, self.max_size), Image.Resampling.BILINEAR)
+            path = os.path.join(self.output_dir, f"step_{step:03d}_{variant}.jpg")
+            image.save(path, "JPEG", quality=self.quality)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось построить превью шага {step}: {e}")
+            return None
+        with self._lock:
+            self.stats["previews"] += 1
+            self.stats["seconds"] = round(self.stats["seconds"] + time.perf_counter() - start_time, 4)
+        self._queue.put(path)
+        return path
+
+    def stream(self, future: Future, poll_seconds: float = 0.05) -> Iterator[str]:
+        """Пути превью по мере готовности, пока future не завершится; затем остаток очереди."""
+        while not future.done():
+            try:
+                yield self._queue.get(timeout=poll_seconds)
+            except queue.Empty:
+                continue
+        while True:
+            try:
+                yield self._queue.get_nowait()
+            except queue.Empty:
+                return
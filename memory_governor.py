@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Управление памятью GPU между запросами.
+
+Вместо безусловных empty_cache()/gc.collect() после каждого запроса память
+освобождается только под давлением (свободного места меньше запаса headroom)
+или после неудачного выделения памяти (OOM, с одним повтором). Теплые блоки
+кэширующего аллокатора остаются следующему запросу. Пиковая память каждого
+запроса и запас до предела копятся в stats.
+
+Модуль не импортирует PyTorch: снимок памяти, освобождение, сброс пиков и
+распознавание OOM передаются функциями; create_cuda_memory_governor() собирает
+их из переданного модуля torch.
+"""
+
+import gc
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """Признак OOM по тексту ошибки (torch.cuda.OutOfMemoryError и RuntimeError CUDA)."""
+    return "out of memory" in str(error).lower()
+
+
+class MemoryGovernor:
+    """Освобождает память GPU только при нехватке запаса или после OOM.
+
+    memory_stats() возвращает байты: allocated, reserved, peak_allocated,
+    peak_reserved, total (total == 0 — устройство без ограничений, например CPU).
+    reclaim() освобождает кэш аллокатора и мусор Python, reset_peak()
+    сбрасывает пиковые счетчики в начале запроса, если других запросов в работе
+    нет: сброс посреди чужого запроса стер бы его пики. Пики общие для устройства:
+    у запроса, пересекшегося с соседями, метрика включает их (exclusive_peak=False).
+    """
+
+    def __init__(self, headroom_bytes: int, memory_stats: Callable[[], Dict[str, int]],
+                 reclaim: Callable[[], None], reset_peak: Optional[Callable[[], None]] = None,
+                 is_oom: Callable[[BaseException], bool] = is_out_of_memory):
+        self.headroom_bytes = max(0, int(headroom_bytes))
+        self.memory_stats = memory_stats
+        self._reclaim = reclaim
+        self.reset_peak = reset_peak
+        self.is_oom = is_oom
+        self._lock = threading.Lock()
+        self._active: List[Dict[str, bool]] = []
+        self.stats = {
+            "requests": 0, "reclaims": 0, "skipped_reclaims": 0, "oom_retries": 0,
+            "reclaim_seconds": 0.0, "saved_seconds": 0.0,
+            "max_peak_allocated_mb": 0.0, "max_peak_reserved_mb": 0.0, "min_headroom_mb": None
+        }
+
+    def under_pressure(self, snapshot: Optional[Dict[str, int]] = None) -> bool:
+        """Свободного (незарезервированного) места меньше запаса headroom."""
+        if snapshot is None:
+            snapshot = self.memory_stats()
+        total = snapshot.get("total", 0)
+        return total > 0 and total - snapshot.get("reserved", 0) < self.headroom_bytes
+
+    def reclaim(self, reason: str) -> float:
+        """Освобождает память и возвращает затраченное время."""
+        start_time = time.perf_counter()
+        self._reclaim()
+        elapsed = time.perf_counter() - start_time
+        with self._lock:
+            self.stats["reclaims"] += 1
+            self.stats["reclaim_seconds"] = round(self.stats["reclaim_seconds"] + elapsed, 4)
+        logger.info(f"🧹 Память освобождена ({reason}) за {elapsed * 1000:.1f} мс")
+        return elapsed
+
+    def maybe_reclaim(self, reason: str = "pressure") -> bool:
+        """Освобождает память, только если запас исчерпан; True — освобождение было."""
+        if self.under_pressure():
+            self.reclaim(reason)
+            return True
+        return False
+
+    def begin_request(self) -> Dict[str, bool]:
+        """Начало запроса: сброс пиковых счетчиков, только если других запросов в работе нет.
+        Возвращает билет запроса для end_request() и finish_request()."""
+        with self._lock:
+            ticket = {"exclusive": not self._active}
+            for other in self._active:
+                other["exclusive"] = False
+            self._active.append(ticket)
+            if ticket["exclusive"] and self.reset_peak is not None:
+                self.reset_peak()
+        return ticket
+
+    def finish_request(self, ticket: Dict[str, bool]) -> None:
+        """Запрос завершен (в том числе с ошибкой): следующий запрос на простаивающем устройстве сбросит пики."""
+        with self._lock:
+            self._active = [active for active in self._active if active is not ticket]
+
+    def end_request(self, peaks: Optional[Dict[str, int]] = None,
+                    ticket: Optional[Dict[str, bool]] = None) -> Dict[str, Any]:
+        """Конец запроса: метрики пиковой памяти; освобождение — только под давлением.
+        peaks (peak_allocated/peak_reserved) заменяет пики снимка, если счетчики сбрасывались
+        внутри запроса (профиль стадий). exclusive_peak=False — запрос пересекался с другими
+        и пики включают их память."""
+        snapshot = dict(self.memory_stats())
+        if peaks:
+            snapshot.update({key: value for key, value in peaks.items() if value})
+        reclaimed = self.under_pressure(snapshot)
+        if reclaimed:
+            self.reclaim("pressure")
+        total = snapshot.get("total", 0)
+        metrics = {
+            "peak_allocated_mb": round(snapshot.get("peak_allocated", 0) / MB, 1),
+            "peak_reserved_mb": round(snapshot.get("peak_reserved", 0) / MB, 1),
+            "reserved_mb": round(snapshot.get("reserved", 0) / MB, 1),
+            "headroom_mb": round((total - snapshot.get("peak_reserved", 0)) / MB, 1) if total else None,
+            "reclaimed": reclaimed,
+            "exclusive_peak": ticket["exclusive"] if ticket is not None else None
+        }
+        with self._lock:
+            self.stats["requests"] += 1
+            if not reclaimed:
+                self.stats["skipped_reclaims"] += 1
+                self.stats["saved_seconds"] = round(self.stats["saved_seconds"] + self._mean_reclaim_seconds(), 4)
+            self.stats["max_peak_allocated_mb"] = max(self.stats["max_peak_allocated_mb"], metrics["peak_allocated_mb"])
+            self.stats["max_peak_reserved_mb"] = max(self.stats["max_peak_reserved_mb"], metrics["peak_reserved_mb"])
+            if metrics["headroom_mb"] is not None:
+                current = self.stats["min_headroom_mb"]
+                self.stats["min_headroom_mb"] = metrics["headroom_mb"] if current is None else min(current, metrics["headroom_mb"])
+        return metrics
+
+    def run(self, func: Callable[[], Any]) -> Any:
+        """Выполняет func(); при OOM освобождает память и повторяет один раз."""
+        try:
+            return func()
+        except Exception as e:
+            if not self.is_oom(e):
+                raise
+            logger.warning(f"⚠️ Нехватка памяти GPU, освобождаем кэш и повторяем: {e}")
+            with self._lock:
+                self.stats["oom_retries"] += 1
+            self.reclaim("oom")
+            return func()
+
+    def _mean_reclaim_seconds(self) -> float:
+        reclaims = self.stats["reclaims"]
+        return self.stats["reclaim_seconds"] / reclaims if reclaims else 0.0
+
+
+def create_cuda_memory_governor(torch_module: Any, headroom_bytes: int) -> MemoryGovernor:
+    """MemoryGovernor поверх torch.cuda текущего устройства (модуль torch передается вызывающим);
+    без CUDA снимок пустой и освобождение сводится к gc.collect()."""
+    cuda = torch_module.cuda
+
+    def memory_stats() -> Dict[str, int]:
+        if not cuda.is_available():
+            return {}
+        return {
+            "allocated": cuda.memory_allocated(),
+            "reserved": cuda.memory_reserved(),
+            "peak_allocated": cuda.max_memory_allocated(),
+            "peak_reserved": cuda.max_memory_reserved(),
+            "total": cuda.get_device_properties(cuda.current_device()).total_memory
+        }
+
+    def reclaim() -> None:
+        gc.collect()
+        if cuda.is_available():
+            cuda.empty_cache()
+
+    def reset_peak() -> None:
+        if cuda.is_available():
+            cuda.reset_peak_memory_stats()
+
+    oom_error = getattr(cuda, "OutOfMemoryError", None)
+
+    def is_oom(error: BaseException) -> bool:
+        return (oom_error is not None and isinstance(error, oom_error)) or is_out_of_memory(error)
+
+    return MemoryGovernor(headroom_bytes, memory_stats, reclaim, reset_peak, is_oom)
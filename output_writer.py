@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Кодирование выходных изображений запроса в пуле потоков.
+
+Файлы (финальные изображения, превью, colormap, легенда) кодируются
+параллельно, пока predict() отдает уже готовые: paths() выдает пути по
+группам приоритета (сначала финальные изображения, затем превью, затем
+colormap и легенда), внутри группы — в порядке постановки (финал i
+соответствует seed i), при этом кодирование идет параллельно. Форматы: PNG с
+настраиваемым уровнем сжатия, WebP без потерь, JPEG высокого качества
+(для превью). Время кодирования копится по форматам в профиле запроса
+(стадии encode/<формат>) и в stats. Модуль не зависит от PyTorch.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from stage_timer import StageProfiler, profile_stage
+
+logger = logging.getLogger(__name__)
+
+# Формат -> (формат PIL, расширение файла)
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+}
+
+# Группы приоритета выдачи
+GROUP_FINAL = 0
+GROUP_PREVIEW = 1
+GROUP_COLORMAP = 2
+
+
+class OutputWriter:
+    """Выходы одного запроса: submit() ставит задачу в пул, encode() кодирует изображение,
+    paths() отдает готовые пути по группам.
+
+    Задача submit() возвращает путь записанного файла; ее исключения пробрасываются
+    из paths(). png_compress_level — уровень zlib (0–9, 1 — быстро при почти том же
+    размере для шумных текстур), jpeg_quality — качество JPEG (субдискретизация
+    цвета отключена), webp_method — скорость WebP без потерь (0 — быстрее всего).
+    """
+
+    def __init__(self, pool: Executor, profiler: Optional[StageProfiler] = None, png_compress_level: int = 1,
+                 jpeg_quality: int = 95, webp_method: int = 0):
+        self.pool = pool
+        self.profiler = profiler
+        self.png_compress_level = min(9, max(0, int(png_compress_level)))
+        self.jpeg_quality = min(100, max(1, int(jpeg_quality)))
+        self.webp_method = min(6, max(0, int(webp_method)))
+        self._tasks: List[Tuple[int, int, Future]] = []
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, Any]] = {}
+
+    def save_params(self, output_format: str) -> Dict[str, Any]:
+        """Параметры Image.save для формата."""
+        if output_format == "png":
+            return {"compress_level": self.png_compress_level}
+        if output_format == "webp":
+            return {"lossless": True, "method": self.webp_method}
+        if output_format == "jpeg":
+            return {"quality": self.jpeg_quality, "subsampling": 0}
+        raise ValueError(f"Неизвестный формат вывода: {output_format} (доступны: {', '.join(OUTPUT_FORMATS)})")
+
+    def encode(self, image: Image.Image, base_path: str, output_format: str, **params: Any) -> str:
+        """Кодирует image в файл base_path + расширение формата и возвращает путь.
+        params дополняют параметры формата (например, transparency для палитровых PNG)."""
+        save_params = {**self.save_params(output_format), **params}
+        pil_format, extension = OUTPUT_FORMATS[output_format]
+        if output_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+            save_params.pop("transparency", None)
+        path = base_path + extension
+        start_time = time.perf_counter()
+        with profile_stage([self.profiler], f"encode/{output_format}", gpu=False):
+            image.save(path, pil_format, **save_params)
+        elapsed = time.perf_counter() - start_time
+        with self._lock:
+            stats = self.stats.setdefault(output_format, {"files": 0, "seconds": 0.0})
+            stats["files"] += 1
+            stats["seconds"] = round(stats["seconds"] + elapsed, 4)
+        return path
+
+    def submit(self, group: int, task: Callable[..., str], *args: Any, **kwargs: Any) -> Future:
+        """Ставит задачу записи файла в пул; group — приоритет выдачи в paths()."""
+        future = self.pool.submit(task, *args, **kwargs)
+        with self._lock:
+            self._tasks.append((group, len(self._tasks), future))
+        return future
+
+    def submit_after(self, group: int, dependency: Future, task: Callable[..., str], *args: Any, **kwargs: Any) -> Future:
+        """Как submit(), но задача попадает в пул только после готовности dependency и получает
+        ее результат первым аргументом: задача не занимает воркер пула, ожидая работу, стоящую
+        в очереди того же пула. Исключение dependency становится исключением задачи."""
+        future: Future = Future()
+
+        def relay(source: Future) -> None:
+            if source.cancelled():
+                future.cancel()
+            elif source.exception() is not None:
+                future.set_exception(source.exception())
+            else:
+                future.set_result(source.result())
+
+        def start(source: Future) -> None:
+            if source.cancelled() or source.exception() is not None:
+                relay(source)
+                return
+            try:
+                self.pool.submit(task, source.result(), *args, **kwargs).add_done_callback(relay)
+            except Exception as e:
+                future.set_exception(e)
+
+        future.set_running_or_notify_cancel()
+        dependency.add_done_callback(start)
+        with self._lock:
+            self._tasks.append((group, len(self._tasks), future))
+        return future
+
+    def paths(self) -> Iterator[str]:
+        """Пути файлов: группы по возрастанию, внутри группы — в порядке постановки задач
+        (позиционные потребители сопоставляют выходы с seeds); задачи кодируются параллельно."""
+        with self._lock:
+            tasks = sorted(self._tasks)
+        groups: Dict[int, List[Future]] = {}
+        for group, _, future in tasks:
+            groups.setdefault(group, []).append(future)
+        for group in sorted(groups):
+            for future in groups[group]:
+                yield future.result()
@@ -9,6 +9,9 @@ import json
 import logging
 import time
 import math
+import resource
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional, List, Dict, Any, Iterator
 from PIL import Image, ImageDraw, ImageColor
 import numpy as np
@@ -22,10 +25,30 @@ import random
 # Импортируем ColorManager из отдельного модуля
 from color_manager import ColorManager
 
+# Векторизованный движок генерации colormap (NumPy, без PyTorch)
+import colormap_engine
+import prompt_embedding_cache
+import latent_preview
+import fused_checkpoint
+import device_postprocess
+from stage_timer import StageProfiler, StageTimer, profile_stage, run_until_steady
+from memory_governor import create_cuda_memory_governor
+from guidance_schedule import GuidanceSchedule, parse_guidance_schedule
+from request_workspace import WorkspaceManager
+from output_writer import GROUP_COLORMAP, GROUP_FINAL, GROUP_PREVIEW, OUTPUT_FORMATS, OutputWriter
+from batch_scheduler import MicroBatchScheduler
+from controlnet_pool import ControlNetPool, parse_controlnet_specs
+from predict_multimodal_controlnet import MultimodalControlNet, active_controlnet_fraction, build_multi_controlnet_kwargs
+
+# Атлас гранул: число вариантов маски на размер/форму (разнообразие форм vs память)
+GRANULE_ATLAS_VARIANTS = int(os.environ.get("GRANULE_ATLAS_VARIANTS", "64"))
+# Кэш атласа на диске, чтобы не строить его при каждом старте контейнера
+GRANULE_ATLAS_CACHE_DIR = os.environ.get("GRANULE_ATLAS_CACHE_DIR", "/src/granule-cache")
+
 class ColorGridControlNet:
     """Улучшенный Color Grid Adapter для точного контроля цветовых пропорций"""
     
-    def __init__(self):
+    def __init__(self, atlas_variants: Optional[int] = None):
         self.patterns = ["random", "grid", "radial", "granular"]
         # Динамические размеры гранул на основе калибровки с референсными изображениями
         self.granule_sizes = {
@@ -45,534 +68,93 @@ class ColorGridControlNet:
         
         # Инициализация централизованного менеджера цветов
         self.color_manager = ColorManager()
+        
+        # Атлас заранее растеризованных гранул (0 вариантов — растеризация каждой гранулы заново)
+        self.atlas_variants = GRANULE_ATLAS_VARIANTS if atlas_variants is None else atlas_variants
+        self.granule_atlas = None
+        if self.atlas_variants > 0:
+            self.granule_atlas = colormap_engine.GranuleAtlas.load_or_build(
+                self.granule_calibration, self.atlas_variants, GRANULE_ATLAS_CACHE_DIR
+            )
+    
+    def engine_signature(self) -> Dict[str, Any]:
+        """Параметры движка, от которых зависит карта при том же рецепте и seed (часть ключа кэша colormap)"""
+        return {
+            "granule_sizes": self.granule_sizes,
+            "granule_calibration": self.granule_calibration,
+            "atlas": (colormap_engine.GranuleAtlas.cache_key(self.granule_calibration, self.atlas_variants)
+                      if self.granule_atlas is not None else None)
+        }
     
     def create_optimized_colormap(self, colors, size=(1024, 1024), 
-                                 pattern_type="granular", granule_size="medium"):
+                                 pattern_type="granular", granule_size="medium", seed=None):
         """Создает оптимизированный colormap для ControlNet"""
-        
-        if pattern_type == "granular":
-            return self._create_granular_pattern(colors, size, granule_size)
-        elif pattern_type == "random":
-            return self._create_random_pattern(colors, size)
-        elif pattern_type == "grid":
-            return self._create_grid_pattern(colors, size)
-        elif pattern_type == "radial":
-            return self._create_radial_pattern(colors, size)
-        else:
-            return self._create_granular_pattern(colors, size, "medium")
+        return self.create_label_map(colors, size, pattern_type, granule_size, seed).rgba
 
     def create_optimized_colormap_and_hint(self, colors, size=(1024, 1024), 
-                                           pattern_type="granular", granule_size="medium"):
+                                           pattern_type="granular", granule_size="medium", seed=None):
         """Создает colormap (RGBA) и одноканальный L-хинт для ControlNet в один проход."""
+        label_map = self.create_label_map(colors, size, pattern_type, granule_size, seed)
+        return label_map.rgba, label_map.hint
+
+    def create_label_map(self, colors, size=(1024, 1024), 
+                         pattern_type="granular", granule_size="medium", seed=None) -> colormap_engine.LabelMap:
+        """Создает палитровую карту меток colormap (uint8 + палитра), из которой RGBA и хинт выводятся по LUT.
+        seed задает воспроизводимую карту; None — новая случайная карта."""
+        rng = np.random.default_rng(seed)
         if pattern_type == "granular":
-            return self._create_granular_pattern_with_hint(colors, size, granule_size)
+            return self._create_granular_label_map(colors, size, granule_size, rng)
         elif pattern_type == "random":
-            return self._create_random_pattern_with_hint(colors, size)
+            return self._create_random_label_map(colors, size, rng)
         elif pattern_type == "grid":
-            return self._create_grid_pattern_with_hint(colors, size)
+            return self._create_grid_label_map(colors, size, rng)
         elif pattern_type == "radial":
-            return self._create_radial_pattern_with_hint(colors, size)
+            return self._create_radial_label_map(colors, size, rng)
         else:
-            return self._create_granular_pattern_with_hint(colors, size, "medium")
+            return self._create_granular_label_map(colors, size, "medium", rng)
     
-    def _create_granular_pattern(self, colors, size, granule_size="medium"):
-        """Создает паттерн, имитирующий резиновую крошку с пустыми полями по краям"""
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))  # Прозрачный фон
-        pixels = canvas.load()
-        
-        # Вычисляем размеры пустых полей (2-3% от общего размера)
-        margin_x = int(width * 0.025)  # 2.5% по горизонтали
-        margin_y = int(height * 0.025)  # 2.5% по вертикали
-        
-        # Рабочая область (без полей)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        
-        # Параметры гранул с динамическим диапазоном
-        granule_params = self.granule_sizes[granule_size]
-        min_size = granule_params["min_size"]
-        max_size = granule_params["max_size"]
-        density = granule_params["density"]
-        variation = granule_params["variation"]
-        
-        # Калиброванные параметры для реалистичности
-        calibration = self.granule_calibration
-        
-        # Нормализация пропорций для рабочей области
-        total_proportion = sum(color.get("proportion", 0) for color in colors)
-        normalized_colors = []
-        for color in colors:
-            proportion = color.get("proportion", 0) / total_proportion
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            normalized_colors.append({
-                "color": color_rgb,
-                "proportion": proportion,
-                "pixels_needed": int(proportion * work_width * work_height * density)
-            })
-        
-        # Создание гранул с вариативными размерами и органическими формами
-        pixels_placed = {i: 0 for i in range(len(normalized_colors))}
-        
-        # Создаем список позиций только в рабочей области и перемешиваем
-        all_positions = [(x + margin_x, y + margin_y) for x in range(work_width) for y in range(work_height)]
-        random.shuffle(all_positions)
-        
-        pos_idx = 0
-        for color_idx, color_info in enumerate(normalized_colors):
-            pixels_to_place = color_info["pixels_needed"]
-            placed = 0
-            
-            while placed < pixels_to_place and pos_idx < len(all_positions):
-                x, y = all_positions[pos_idx]
-                pos_idx += 1
-                
-                # Проверяем, что пиксель еще прозрачный
-                if pixels[x, y] == (255, 255, 255, 0):
-                    # Создаем гранулу с вариативным размером
-                    granule_size = self._generate_variable_granule_size(min_size, max_size, variation, calibration)
-                    
-                    # Создаем органическую форму гранулы
-                    actual_pixels_placed = self._draw_organic_granule(pixels, x, y, granule_size, color_info["color"], 
-                                                                    work_width, work_height, margin_x, margin_y, calibration)
-                    
-                    placed += actual_pixels_placed  # Учитываем фактически размещенные пиксели
-        
-        return canvas
-
-    def _create_granular_pattern_with_hint(self, colors, size, granule_size="medium"):
-        """Генерирует RGBA colormap и L-хинт одновременно (без последующих конвертаций)."""
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))
-        hint = Image.new('L', size, 0)
-        pixels = canvas.load()
-        hp = hint.load()
-        
-        margin_x = int(width * 0.025)
-        margin_y = int(height * 0.025)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        
-        granule_params = self.granule_sizes[granule_size]
-        min_size = granule_params["min_size"]
-        max_size = granule_params["max_size"]
-        variation = granule_params["variation"]
-        calibration = self.granule_calibration
-        
+    def _granular_pixel_quotas(self, colors, size, granule_size):
+        """Нормализует пропорции и возвращает (RGB цветов, квоты пикселей) для рабочей области"""
+        _, _, work_width, work_height = colormap_engine.compute_work_area(size)
+        density = self.granule_sizes[granule_size]["density"]
         total_proportion = sum(color.get("proportion", 0) for color in colors)
-        normalized_colors = []
+        rgb_colors = []
+        pixel_quotas = []
         for color in colors:
             proportion = color.get("proportion", 0) / max(1e-8, total_proportion)
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            normalized_colors.append({
-                "color": color_rgb,
-                "proportion": proportion,
-                "pixels_needed": int(proportion * work_width * work_height * self.granule_sizes[granule_size]["density"])  # type: ignore
-            })
-        
-        all_positions = [(x + margin_x, y + margin_y) for x in range(work_width) for y in range(work_height)]
-        random.shuffle(all_positions)
-        
-        def luma(rgb):
-            r, g, b = rgb
-            return int(0.299 * r + 0.587 * g + 0.114 * b)
-        
-        pos_idx = 0
-        for _, color_info in enumerate(normalized_colors):
-            pixels_to_place = color_info["pixels_needed"]
-            placed = 0
-            while placed < pixels_to_place and pos_idx < len(all_positions):
-                x, y = all_positions[pos_idx]
-                pos_idx += 1
-                if pixels[x, y] == (255, 255, 255, 0):
-                    gsize = self._generate_variable_granule_size(min_size, max_size, variation, calibration)
-                    actual = self._draw_organic_granule(pixels, x, y, gsize, color_info["color"], work_width, work_height, margin_x, margin_y, calibration)
-                    # Заполняем hint там, где поставили цветные пиксели (пробегаем локально)
-                    half = max(1, gsize // 2)
-                    for dx in range(-half, half + 1):
-                        for dy in range(-half, half + 1):
-                            xx, yy = x + dx, y + dy
-                            if margin_x <= xx < margin_x + work_width and margin_y <= yy < margin_y + work_height:
-                                if pixels[xx, yy] != (255, 255, 255, 0):
-                                    hp[xx, yy] = luma(color_info["color"])  # фон остаётся 0
-                    placed += actual
-        return canvas, hint
-    
-    def _generate_variable_granule_size(self, min_size: int, max_size: int, variation: float, calibration: dict) -> int:
-        """Генерирует вариативный размер гранулы на основе калиброванных параметров"""
-        import random
-        
-        # Базовый размер с вариацией
-        base_size = random.randint(min_size, max_size)
-        
-        # Применяем вариацию для создания неоднородности
-        variation_factor = 1.0 + (random.random() - 0.5) * variation * 2
-        variable_size = int(base_size * variation_factor)
-        
-        # Ограничиваем размер калиброванными параметрами
-        variable_size = max(calibration["min_granule_size"], 
-                           min(calibration["max_granule_size"], variable_size))
-        
-        return variable_size
-    
-    def _draw_organic_granule(self, pixels, center_x: int, center_y: int, size: int, color: tuple, 
-                             work_width: int, work_height: int, margin_x: int, margin_y: int, calibration: dict) -> int:
-        """Рисует органическую гранулу с неправильной формой и возвращает количество размещенных пикселей"""
-        import random
-        import math
-        
-        # Параметры органичности
-        organic_factor = calibration["organic_factor"]
-        form_complexity = calibration["form_complexity"]
-        
-        # Определяем форму гранулы на основе сложности
-        if random.random() < form_complexity:
-            # Сложная органическая форма
-            return self._draw_complex_organic_granule(pixels, center_x, center_y, size, color, 
-                                                    work_width, work_height, margin_x, margin_y, organic_factor)
-        else:
-            # Простая форма с небольшими искажениями
-            return self._draw_simple_organic_granule(pixels, center_x, center_y, size, color, 
-                                                   work_width, work_height, margin_x, margin_y, organic_factor)
-    
-    def _draw_simple_organic_granule(self, pixels, center_x: int, center_y: int, size: int, color: tuple,
-                                   work_width: int, work_height: int, margin_x: int, margin_y: int, organic_factor: float) -> int:
-        """Рисует простую органическую гранулу с небольшими искажениями и возвращает количество размещенных пикселей"""
-        import random
-        import math
-        
-        # Базовый радиус с небольшими вариациями
-        base_radius = size // 2
-        pixels_placed = 0
-        
-        for dx in range(-base_radius, base_radius + 1):
-            for dy in range(-base_radius, base_radius + 1):
-                x, y = center_x + dx, center_y + dy
-                
-                # Проверяем границы
-                if (margin_x <= x < work_width + margin_x and 
-                    margin_y <= y < work_height + margin_y):
-                    
-                    # Вычисляем расстояние от центра
-                    distance = math.sqrt(dx*dx + dy*dy)
-                    
-                    # Добавляем органические искажения
-                    organic_distortion = 1.0 + (random.random() - 0.5) * organic_factor * 0.3
-                    effective_radius = base_radius * organic_distortion
-                    
-                    # Рисуем пиксель, если он внутри искаженного круга
-                    if distance <= effective_radius:
-                        pixels[x, y] = color
-                        pixels_placed += 1
-        
-        return pixels_placed
+            rgb_colors.append(self._name_to_rgb(color.get("name", "white")))
+            pixel_quotas.append(int(proportion * work_width * work_height * density))
+        return rgb_colors, pixel_quotas
+
+    def _create_granular_label_map(self, colors, size, granule_size, rng):
+        """Гранулярный паттерн (резиновая крошка) через векторизованный NumPy-движок."""
+        rgb_colors, pixel_quotas = self._granular_pixel_quotas(colors, size, granule_size)
+        labels = colormap_engine.build_granular_label_map(
+            pixel_quotas, size, self.granule_sizes[granule_size], self.granule_calibration,
+            rng, self.granule_atlas
+        )
+        return colormap_engine.LabelMap(labels, rgb_colors)
+
+    def _create_random_label_map(self, colors, size, rng):
+        """Случайный паттерн с точными квотами: одна перестановка массива меток uint8 вместо списка позиций."""
+        labels = colormap_engine.build_random_label_map(self._proportions(colors), size, rng)
+        return colormap_engine.LabelMap(labels, self._rgb_colors(colors))
     
-    def _draw_complex_organic_granule(self, pixels, center_x: int, center_y: int, size: int, color: tuple,
-                                    work_width: int, work_height: int, margin_x: int, margin_y: int, organic_factor: float) -> int:
-        """Рисует сложную органическую гранулу с неправильной формой и возвращает количество размещенных пикселей"""
-        import random
-        import math
-        
-        # Создаем несколько точек для сложной формы
-        num_points = max(3, size // 2)
-        points = []
-        
-        for i in range(num_points):
-            angle = (2 * math.pi * i) / num_points
-            # Добавляем случайные отклонения для органичности
-            radius_variation = 1.0 + (random.random() - 0.5) * organic_factor
-            point_radius = (size // 2) * radius_variation
-            
-            px = center_x + int(point_radius * math.cos(angle))
-            py = center_y + int(point_radius * math.sin(angle))
-            points.append((px, py))
-        
-        # Рисуем гранулу, используя точки как основу для формы
-        pixels_placed = 0
-        for dx in range(-size, size + 1):
-            for dy in range(-size, size + 1):
-                x, y = center_x + dx, center_y + dy
-                
-                # Проверяем границы
-                if (margin_x <= x < work_width + margin_x and 
-                    margin_y <= y < work_height + margin_y):
-                    
-                    # Проверяем, находится ли точка внутри сложной формы
-                    if self._point_in_complex_shape(x, y, points, organic_factor):
-                        pixels[x, y] = color
-                        pixels_placed += 1
-        
-        return pixels_placed
+    def _create_grid_label_map(self, colors, size, rng):
+        """Точечный паттерн: прямая выборка без возвращения по свободным пикселям, квоты точные."""
+        labels = colormap_engine.build_grid_label_map(self._proportions(colors), size, rng)
+        return colormap_engine.LabelMap(labels, self._rgb_colors(colors))
     
-    def _point_in_complex_shape(self, x: int, y: int, points: list, organic_factor: float) -> bool:
-        """Проверяет, находится ли точка внутри сложной органической формы"""
-        import random
-        import math
-        
-        # Используем алгоритм ray casting для проверки принадлежности к многоугольнику
-        n = len(points)
-        inside = False
-        
-        p1x, p1y = points[0]
-        for i in range(1, n + 1):
-            p2x, p2y = points[i % n]
-            if y > min(p1y, p2y):
-                if y <= max(p1y, p2y):
-                    if x <= max(p1x, p2x):
-                        if p1y != p2y:
-                            xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                        if p1x == p2x or x <= xinters:
-                            inside = not inside
-            p1x, p1y = p2x, p2y
-        
-        # Добавляем органические искажения
-        if inside and random.random() < organic_factor * 0.2:
-            inside = not inside  # Случайно исключаем некоторые пиксели
-        
-        return inside
+    def _create_radial_label_map(self, colors, size, rng):
+        """Радиальный паттерн: взвешенная по расстоянию выборка без возвращения, квоты точные."""
+        labels = colormap_engine.build_radial_label_map(self._proportions(colors), size, rng)
+        return colormap_engine.LabelMap(labels, self._rgb_colors(colors))
     
-    def _create_random_pattern(self, colors, size):
-        """Создает случайный паттерн с точными пропорциями и пустыми полями по краям"""
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))  # Прозрачный фон
-        pixels = canvas.load()
-        
-        # Вычисляем размеры пустых полей (2-3% от общего размера)
-        margin_x = int(width * 0.025)  # 2.5% по горизонтали
-        margin_y = int(height * 0.025)  # 2.5% по вертикали
-        
-        # Рабочая область (без полей)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        
-        # Нормализация пропорций для рабочей области
-        total_proportion = sum(color.get("proportion", 0) for color in colors)
-        color_pixels = {}
-        
-        for color in colors:
-            proportion = color.get("proportion", 0) / total_proportion
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            color_pixels[color_rgb] = int(proportion * work_width * work_height)
-        
-        # Случайное размещение пикселей в рабочей области
-        all_positions = [(x + margin_x, y + margin_y) for x in range(work_width) for y in range(work_height)]
-        random.shuffle(all_positions)
-        
-        pos_idx = 0
-        for color_rgb, pixel_count in color_pixels.items():
-            for _ in range(pixel_count):
-                if pos_idx < len(all_positions):
-                    x, y = all_positions[pos_idx]
-                    pixels[x, y] = color_rgb
-                    pos_idx += 1
-        
-        return canvas
-
-    def _create_random_pattern_with_hint(self, colors, size):
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))
-        hint = Image.new('L', size, 0)
-        pixels = canvas.load()
-        hp = hint.load()
-        
-        margin_x = int(width * 0.025)
-        margin_y = int(height * 0.025)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        
-        total_proportion = sum(color.get("proportion", 0) for color in colors)
-        color_pixels = {}
-        for color in colors:
-            proportion = color.get("proportion", 0) / max(1e-8, total_proportion)
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            color_pixels[color_rgb] = int(proportion * work_width * work_height)
-        
-        all_positions = [(x + margin_x, y + margin_y) for x in range(work_width) for y in range(work_height)]
-        random.shuffle(all_positions)
-        
-        def luma(rgb):
-            r, g, b = rgb
-            return int(0.299 * r + 0.587 * g + 0.114 * b)
-        
-        pos_idx = 0
-        for color_rgb, pixel_count in color_pixels.items():
-            for _ in range(pixel_count):
-                if pos_idx < len(all_positions):
-                    x, y = all_positions[pos_idx]
-                    pixels[x, y] = color_rgb
-                    hp[x, y] = luma(color_rgb)
-                    pos_idx += 1
-        return canvas, hint
+    def _proportions(self, colors):
+        return [color.get("proportion", 0) for color in colors]
     
-    def _create_grid_pattern(self, colors, size):
-        """Создает сеточный паттерн с точечным распределением и пустыми полями по краям"""
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))  # Прозрачный фон
-        pixels = canvas.load()
-        
-        # Вычисляем размеры пустых полей (2-3% от общего размера)
-        margin_x = int(width * 0.025)  # 2.5% по горизонтали
-        margin_y = int(height * 0.025)  # 2.5% по вертикали
-        
-        # Рабочая область (без полей)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        
-        # Нормализация пропорций для рабочей области
-        total_proportion = sum(color.get("proportion", 0) for color in colors)
-        
-        # Создание точечного распределения в рабочей области
-        for color in colors:
-            proportion = color.get("proportion", 0) / total_proportion
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            pixels_needed = int(proportion * work_width * work_height)
-            
-            # Случайное размещение точек в рабочей области
-            positions_placed = 0
-            attempts = 0
-            max_attempts = pixels_needed * 10  # Ограничение попыток
-            
-            while positions_placed < pixels_needed and attempts < max_attempts:
-                x = random.randint(margin_x, margin_x + work_width - 1)
-                y = random.randint(margin_y, margin_y + work_height - 1)
-                
-                # Проверяем, что позиция свободна
-                if pixels[x, y] == (255, 255, 255, 0):
-                    pixels[x, y] = color_rgb
-                    positions_placed += 1
-                
-                attempts += 1
-        
-        return canvas
-
-    def _create_grid_pattern_with_hint(self, colors, size):
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))
-        hint = Image.new('L', size, 0)
-        pixels = canvas.load()
-        hp = hint.load()
-        
-        margin_x = int(width * 0.025)
-        margin_y = int(height * 0.025)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        
-        total_proportion = sum(color.get("proportion", 0) for color in colors)
-        
-        def luma(rgb):
-            r, g, b = rgb
-            return int(0.299 * r + 0.587 * g + 0.114 * b)
-        
-        for color in colors:
-            proportion = color.get("proportion", 0) / max(1e-8, total_proportion)
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            pixels_needed = int(proportion * work_width * work_height)
-            positions_placed = 0
-            attempts = 0
-            max_attempts = pixels_needed * 10
-            while positions_placed < pixels_needed and attempts < max_attempts:
-                x = random.randint(margin_x, margin_x + work_width - 1)
-                y = random.randint(margin_y, margin_y + work_height - 1)
-                if pixels[x, y] == (255, 255, 255, 0):
-                    pixels[x, y] = color_rgb
-                    hp[x, y] = luma(color_rgb)
-                    positions_placed += 1
-                attempts += 1
-        return canvas, hint
-    
-    def _create_radial_pattern(self, colors, size):
-        """Создает радиальный паттерн с точечным распределением и пустыми полями по краям"""
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))  # Прозрачный фон
-        pixels = canvas.load()
-        
-        # Вычисляем размеры пустых полей (2-3% от общего размера)
-        margin_x = int(width * 0.025)  # 2.5% по горизонтали
-        margin_y = int(height * 0.025)  # 2.5% по вертикали
-        
-        # Рабочая область (без полей)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        
-        # Центр рабочей области
-        center_x = margin_x + work_width // 2
-        center_y = margin_y + work_height // 2
-        max_radius = min(work_width, work_height) // 2
-        
-        # Нормализация пропорций для рабочей области
-        total_proportion = sum(color.get("proportion", 0) for color in colors)
-        
-        # Создание точечного распределения с радиальным влиянием в рабочей области
-        for color in colors:
-            proportion = color.get("proportion", 0) / total_proportion
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            pixels_needed = int(proportion * work_width * work_height)
-            
-            # Случайное размещение точек с радиальным приоритетом
-            positions_placed = 0
-            attempts = 0
-            max_attempts = pixels_needed * 10  # Ограничение попыток
-            
-            while positions_placed < pixels_needed and attempts < max_attempts:
-                # Генерируем позицию с радиальным распределением
-                angle = random.uniform(0, 2 * 3.14159)  # 0 до 2π
-                radius = random.uniform(0, max_radius)
-                
-                x = int(center_x + radius * math.cos(angle))
-                y = int(center_y + radius * math.sin(angle))
-                
-                # Проверяем границы рабочей области
-                if (margin_x <= x < margin_x + work_width and 
-                    margin_y <= y < margin_y + work_height):
-                    # Проверяем, что позиция свободна
-                    if pixels[x, y] == (255, 255, 255, 0):
-                        pixels[x, y] = color_rgb
-                        positions_placed += 1
-                
-                attempts += 1
-        
-        return canvas
-
-    def _create_radial_pattern_with_hint(self, colors, size):
-        width, height = size
-        canvas = Image.new('RGBA', size, (255, 255, 255, 0))
-        hint = Image.new('L', size, 0)
-        pixels = canvas.load()
-        hp = hint.load()
-        
-        margin_x = int(width * 0.025)
-        margin_y = int(height * 0.025)
-        work_width = width - 2 * margin_x
-        work_height = height - 2 * margin_y
-        center_x = margin_x + work_width // 2
-        center_y = margin_y + work_height // 2
-        max_radius = min(work_width, work_height) // 2
-        total_proportion = sum(color.get("proportion", 0) for color in colors)
-        
-        def luma(rgb):
-            r, g, b = rgb
-            return int(0.299 * r + 0.587 * g + 0.114 * b)
-        
-        for color in colors:
-            proportion = color.get("proportion", 0) / max(1e-8, total_proportion)
-            color_rgb = self._name_to_rgb(color.get("name", "white"))
-            pixels_needed = int(proportion * work_width * work_height)
-            positions_placed = 0
-            attempts = 0
-            max_attempts = pixels_needed * 10
-            while positions_placed < pixels_needed and attempts < max_attempts:
-                angle = random.uniform(0, 2 * 3.14159)
-                radius = random.uniform(0, max_radius)
-                x = int(center_x + radius * math.cos(angle))
-                y = int(center_y + radius * math.sin(angle))
-                if (margin_x <= x < margin_x + work_width and 
-                    margin_y <= y < margin_y + work_height):
-                    if pixels[x, y] == (255, 255, 255, 0):
-                        pixels[x, y] = color_rgb
-                        hp[x, y] = luma(color_rgb)
-                        positions_placed += 1
-                attempts += 1
-        return canvas, hint
+    def _rgb_colors(self, colors):
+        return [self._name_to_rgb(color.get("name", "white")) for color in colors]
     
     def _name_to_rgb(self, color_name):
         """Преобразует название цвета в RGB через ColorManager"""
@@ -602,7 +184,7 @@ os.environ["HF_HUB_DISABLE_PROGRESS_BARS"] = "1"
 os.environ["TRANSFORMERS_VERBOSITY"] = "error"
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-from diffusers import StableDiffusionXLPipeline, DPMSolverMultistepScheduler
+from diffusers import StableDiffusionXLPipeline, StableDiffusionXLImg2ImgPipeline, DPMSolverMultistepScheduler
 try:
     from diffusers import ControlNetModel, StableDiffusionXLControlNetPipeline
 except Exception:
@@ -611,6 +193,83 @@ except Exception:
 from transformers import CLIPTextModel, T5EncoderModel
 from cog import BasePredictor, Input
 
+# Кэш colormap между запросами: бюджет памяти и опциональный дисковый уровень
+COLORMAP_CACHE_MAX_BYTES = int(os.environ.get("COLORMAP_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+COLORMAP_CACHE_DIR = os.environ.get("COLORMAP_CACHE_DIR", "")
+
+# Кэш эмбеддингов промптов на устройстве: бюджет VRAM в байтах
+PROMPT_EMBED_CACHE_MAX_BYTES = int(os.environ.get("PROMPT_EMBED_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# Пакетная генерация вариантов: потолок батча и оценка VRAM на один сэмпл 1024×1024
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "4"))
+BATCH_SAMPLE_VRAM_MB = int(os.environ.get("BATCH_SAMPLE_VRAM_MB", "2048"))
+# Максимум вариантов за один вызов predict()
+MAX_OUTPUTS = 8
+# Окно сбора совместимых конкурентных запросов в один батч (0 — без планировщика)
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "30"))
+
+# ControlNet, загружаемые заранее ("тип=repo_id_или_путь,..."; первый — основной ControlNet).
+# Типы совпадают с select_optimal_controlnet: t2i_color, color_grid, shuffle
+CONTROLNET_MODELS = os.environ.get("CONTROLNET_MODELS", "t2i_color=thibaud/controlnet-openpose-sdxl-1.0")
+# Когда загружать пул ControlNet: setup (до первого запроса), background (фоном после setup), off
+CONTROLNET_PRELOAD = os.environ.get("CONTROLNET_PRELOAD", "setup")
+
+# Веса НАШЕЙ модели: LoRA и Textual Inversion, а также слитый из них чекпоинт
+# (scripts/build_fused_checkpoint.py), который setup загружает вместо базовой модели + LoRA + TI
+LORA_DIR = "/src/model_files"
+LORA_WEIGHT_NAME = "rubber-tile-lora-v4_sdxl_lora.safetensors"
+TI_PATH = "/src/model_files/rubber-tile-lora-v4_sdxl_embeddings.safetensors"
+FUSED_CHECKPOINT_DIR = os.environ.get("FUSED_CHECKPOINT_DIR", "/src/model_files/fused-sdxl")
+
+# Латентные превью шагов: каждые N шагов, декодер linear или taesd, размер стороны JPEG.
+# По умолчанию 0 (выключены, клиент включает через preview_every_n_steps): шаговые JPEG идут
+# в начале списка выходов и каждый раз копируют латенты на хост
+LATENT_PREVIEW_STEPS = int(os.environ.get("LATENT_PREVIEW_STEPS", "0"))
+LATENT_PREVIEW_DECODER = os.environ.get("LATENT_PREVIEW_DECODER", "linear")
+LATENT_PREVIEW_TAESD = os.environ.get("LATENT_PREVIEW_TAESD", "madebyollin/taesdxl")
+LATENT_PREVIEW_SIZE = int(os.environ.get("LATENT_PREVIEW_SIZE", "256"))
+
+# Прогрев в конце setup: шагов на прогон (0 — без прогрева) и максимум прогонов на pipeline,
+# пока время прогона не стабилизируется (автотюнинг cuDNN, рост аллокатора, выбор ядер внимания)
+WARMUP_STEPS = int(os.environ.get("WARMUP_STEPS", "4"))
+WARMUP_MAX_RUNS = int(os.environ.get("WARMUP_MAX_RUNS", "3"))
+
+# Запас свободной памяти GPU: кэш аллокатора освобождается, только когда свободного места меньше
+MEMORY_HEADROOM_MB = int(os.environ.get("MEMORY_HEADROOM_MB", "2048"))
+
+# Профиль стадий запроса: синхронизировать устройство и сбрасывать пики VRAM на границах стадий и шагов
+# (точное время GPU и пики по стадиям ценой простоя: CPU не ставит работу GPU в очередь заранее).
+# Только для профилирования; без него стадии меряются по часам, пики VRAM — общие для запроса
+STAGE_PROFILING_SYNC = os.environ.get("STAGE_PROFILING_SYNC", "0") == "1"
+
+# Потоки для CPU-работ запроса (colormap, легенда, PNG), идущих параллельно с UNet
+CPU_WORKER_THREADS = int(os.environ.get("CPU_WORKER_THREADS", "2"))
+
+# Каталоги выходных файлов запросов (пусто — системный tmp) и сколько секунд хранить освобожденный
+# каталог: сервер загружает отданные файлы после завершения predict()
+OUTPUT_WORKSPACE_ROOT = os.environ.get("OUTPUT_WORKSPACE_ROOT", "")
+OUTPUT_WORKSPACE_TTL = float(os.environ.get("OUTPUT_WORKSPACE_TTL", "600"))
+
+# Форматы выходов по умолчанию (png | webp | jpeg) и параметры кодеков
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "png")
+PREVIEW_FORMAT = os.environ.get("PREVIEW_FORMAT", "jpeg")
+OUTPUT_PNG_COMPRESS_LEVEL = int(os.environ.get("OUTPUT_PNG_COMPRESS_LEVEL", "1"))
+OUTPUT_JPEG_QUALITY = int(os.environ.get("OUTPUT_JPEG_QUALITY", "95"))
+OUTPUT_WEBP_METHOD = int(os.environ.get("OUTPUT_WEBP_METHOD", "0"))
+
+# Цветовое кондиционирование по умолчанию: controlnet или latent_init (img2img от colormap без ControlNet)
+# и сила img2img для latent_init (доля шагов денойзинга, пройденных от colormap)
+COLOR_CONDITIONING = os.environ.get("COLOR_CONDITIONING", "controlnet")
+LATENT_INIT_STRENGTH = float(os.environ.get("LATENT_INIT_STRENGTH", "0.75"))
+
+# Расписание CFG по умолчанию: full — обе ветки на всех шагах, auto — пресет адаптивной таблицы,
+# cutoff:<доля шагов> и/или delta:<порог разницы ветвей> — отключение безусловной ветки
+GUIDANCE_SCHEDULE = os.environ.get("GUIDANCE_SCHEDULE", "full")
+
+# Постобработка на GPU: uint8 и превью считаются на устройстве, на хост идут только байты uint8
+GPU_POSTPROCESS = os.environ.get("GPU_POSTPROCESS", "1") == "1"
+PREVIEW_IMAGE_SIZE = 512
+
 # Специальные исключения для критических ошибок
 class ColormapGenerationError(Exception):
     """Критическая ошибка генерации colormap"""
@@ -624,12 +283,17 @@ class Predictor(BasePredictor):
     def __init__(self):
         self.device = None
         self.pipe = None
-        self.controlnet = None
-        self.pipe_cn = None
+        self.controlnet_pool = None
+        self.img2img_pipe = None
+        self.preview_decoder = None
+        self.setup_timings: Dict[str, float] = {}
+        self.warmup_stats: Dict[str, List[float]] = {}
         
         # Инициализация Color Grid Adapter
         self.color_grid_adapter = ColorGridControlNet()
         logger.info("🎨 Color Grid Adapter инициализирован")
+        # Контрольные карты дополнительных ControlNet (сетка, перемешивание, края) из хинта colormap
+        self.multimodal_controlnet = MultimodalControlNet()
         
         # Инициализация централизованного менеджера цветов
         self.color_manager = ColorManager()
@@ -639,13 +303,60 @@ class Predictor(BasePredictor):
         self.color_grid_stats = {
             "total_generations": 0,
             "controlnet_used": 0,
+            "latent_init_used": 0,
             "patterns_used": {"random": 0, "grid": 0, "radial": 0, "granular": 0},
-            "granule_sizes_used": {"small": 0, "medium": 0, "large": 0}
+            "granule_sizes_used": {"small": 0, "medium": 0, "large": 0},
+            # Режим кондиционирования -> число цветов -> средние время генерации и цветовая точность
+            "conditioning": {},
+            # Расписание CFG -> число цветов -> средние время генерации и цветовая точность
+            "guidance": {}
         }
+        # Счетчики статистики меняются из конкурентных запросов
+        self._stats_lock = threading.Lock()
+        
+        # LRU-кэш готовых colormap/хинтов (популярные цветовые рецепты)
+        self.colormap_cache = colormap_engine.ColormapCache(COLORMAP_CACHE_MAX_BYTES, COLORMAP_CACHE_DIR)
+        self.color_grid_stats["colormap_cache"] = self.colormap_cache.stats
+        
+        # LRU-кэш эмбеддингов промптов (фиксированный негативный промпт и популярные рецепты)
+        self.prompt_embedding_cache = prompt_embedding_cache.PromptEmbeddingCache(PROMPT_EMBED_CACHE_MAX_BYTES)
+        self.color_grid_stats["prompt_embedding_cache"] = self.prompt_embedding_cache.stats
+        
+        # Память GPU освобождается только под давлением или после OOM, а не после каждого запроса
+        self.memory_governor = create_cuda_memory_governor(torch, MEMORY_HEADROOM_MB * 1024 * 1024)
+        self.color_grid_stats["memory_governor"] = self.memory_governor.stats
+        
+        # Профили запросов текущего батча (поток диспетчера) для замеров внутри pipeline
+        self._active_profilers = threading.local()
+        # Расписание CFG текущего под-батча (поток диспетчера) для UNet и ControlNet
+        self._guidance_state = threading.local()
+        
+        # Выходные файлы каждого запроса — в собственном каталоге (конкурентные запросы не пересекаются)
+        self.workspaces = WorkspaceManager(OUTPUT_WORKSPACE_ROOT or None, OUTPUT_WORKSPACE_TTL)
+        self.color_grid_stats["workspaces"] = self.workspaces.stats
+        
+        # GPU-работа запросов без планировщика микро-батчей выполняется по одной
+        self._gpu_lock = threading.Lock()
+        
+        # Пул CPU-работ: colormap и его файлы готовятся, пока GPU крутит UNet
+        self.cpu_pool = ThreadPoolExecutor(max_workers=max(1, CPU_WORKER_THREADS), thread_name_prefix="colormap")
+        
+        # Микро-батчи: совместимые конкурентные запросы идут одним циклом денойзинга;
+        # окно ждем, только когда в обработке больше одного запроса
+        self._inflight_requests = 0
+        self._inflight_lock = threading.Lock()
+        self.batch_scheduler = None
+        if BATCH_WINDOW_MS > 0:
+            self.batch_scheduler = MicroBatchScheduler(
+                self._run_batch_requests, MAX_BATCH_SIZE, BATCH_WINDOW_MS,
+                should_wait=lambda: self._inflight_requests > 1
+            )
+            self.color_grid_stats["batch_scheduler"] = self.batch_scheduler.stats
     
     def setup(self):
         """Инициализация модели при запуске сервера."""
         logger.info(f"🚀 Инициализация модели {MODEL_VERSION} (Color Grid Adapter + ControlNet Integration)...")
+        timer = StageTimer()
         
         # 1. Определение устройства
         if torch.cuda.is_available():
@@ -659,16 +370,20 @@ class Predictor(BasePredictor):
         else:
             self.device = "cpu"
             logger.info("⚠️ CUDA недоступен, используется CPU")
-        
-        # 2. Загрузка SDXL pipeline
-        logger.info("📥 Загрузка базовой модели SDXL...")
-        self.pipe = StableDiffusionXLPipeline.from_pretrained(
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            torch_dtype=torch.float16,
-            use_safetensors=True,
-            variant="fp16",
-            resume_download=False
-        )
+        timer.lap("device")
+        
+        # 2. Загрузка SDXL pipeline: слитый чекпоинт (LoRA + TI) или базовая модель
+        fused_loaded = self._load_fused_checkpoint()
+        if not fused_loaded:
+            logger.info("📥 Загрузка базовой модели SDXL...")
+            self.pipe = StableDiffusionXLPipeline.from_pretrained(
+                "stabilityai/stable-diffusion-xl-base-1.0",
+                torch_dtype=torch.float16,
+                use_safetensors=True,
+                variant="fp16",
+                resume_download=False
+            )
+        timer.lap("load_pipeline")
         
         # 3. Перемещение на GPU
         self.pipe = self.pipe.to(self.device)
@@ -681,11 +396,116 @@ class Predictor(BasePredictor):
                 torch.backends.cudnn.benchmark = True
             except Exception:
                 pass
+        timer.lap("to_device")
+        
+        # 4-6. LoRA и Textual Inversion: в слитом чекпоинте уже есть, иначе подключаем к базовой модели
+        if fused_loaded:
+            logger.info("✅ LoRA и Textual Inversion уже в слитом чекпоинте, подключение пропущено")
+        else:
+            self._load_lora_adapters()
+            timer.lap("lora")
+            self._load_textual_inversion()
+            timer.lap("textual_inversion")
+        
+        # 7. Настройка планировщика
+        logger.info("⚙️ Настройка планировщика...")
+        self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(
+            self.pipe.scheduler.config,
+            algorithm_type="dpmsolver++",
+            use_karras_sigmas=True
+        )
+        timer.lap("scheduler")
         
+        # 8. Оптимизации VAE (как в успешной модели v45)
+        logger.info("🚀 Применение VAE оптимизаций (метод v45)...")
+        self.pipe.vae.enable_slicing()
+        # Включаем tiling для лучшей детализации (как в v45)
+        self.pipe.vae.enable_tiling()
+        logger.info("✅ VAE tiling включен для максимальной детализации")
+        try:
+            # Формат каналов для ускорения и стабильности
+            self.pipe.unet.to(memory_format=torch.channels_last)
+            self.pipe.vae.to(memory_format=torch.channels_last)
+        except Exception:
+            pass
+        # Замеры VAE decode и PIL-конвертации для профилей запросов
+        self._instrument_pipeline(self.pipe)
+        # Расписание CFG: UNet общий у всех pipeline, оборачивается один раз
+        self._schedule_unet_guidance(self.pipe.unet)
+        timer.lap("vae")
+        
+        # 9. Легкий декодер латентных превью (TAESD) вместо линейной проекции
+        if LATENT_PREVIEW_DECODER == "taesd":
+            try:
+                from diffusers import AutoencoderTiny
+                self.preview_decoder = AutoencoderTiny.from_pretrained(LATENT_PREVIEW_TAESD, torch_dtype=torch.float16).to(self.device)
+                logger.info(f"✅ Декодер превью TAESD загружен: {LATENT_PREVIEW_TAESD}")
+            except Exception as e:
+                logger.warning(f"⚠️ TAESD недоступен, превью через линейную проекцию: {e}")
+        timer.lap("preview_decoder")
+        
+        # Img2img-вариант pipeline для color_conditioning=latent_init: новых весов нет, компоненты общие
+        self.img2img_pipe = self._create_img2img_pipeline()
+        timer.lap("img2img")
+        
+        # 10. Пул ControlNet: модели и pipeline-вариант собираются до первого запроса
+        self.controlnet_pool = self._create_controlnet_pool()
+        if self.controlnet_pool is not None and CONTROLNET_PRELOAD != "off":
+            background = CONTROLNET_PRELOAD == "background"
+            logger.info(f"🔗 Предзагрузка ControlNet ({'фоном' if background else 'в setup'}): {list(self.controlnet_pool.specs)}")
+            self.controlnet_pool.preload(background=background, pipelines=[self._default_controlnet_names()])
+            if not background:
+                logger.info(f"📊 Пул ControlNet: {self.controlnet_pool.status()}")
+        timer.lap("controlnet_pool")
+        
+        # 11. Прогрев: первый запрос после холодного старта идет со скоростью установившегося режима
+        if WARMUP_STEPS > 0:
+            self._warmup()
+        timer.lap("warmup")
+        
+        # 12. Очистка памяти: мусор загрузки; прогретый кэш аллокатора сохраняем, если запаса хватает
+        gc.collect()
+        self.memory_governor.maybe_reclaim("setup")
+        timer.lap("cleanup")
+        
+        # Длительность фаз setup: по ней видно выигрыш слитого чекпоинта на холодном старте
+        self.setup_timings = timer.to_dict()
+        logger.info(f"⏱️ Setup по фазам ({'слитый чекпоинт' if fused_loaded else 'базовая модель + LoRA + TI'}): {timer.summary()}")
+        logger.info(f"🎉 Модель {MODEL_VERSION} успешно инициализирована!")
+    
+    def _load_fused_checkpoint(self) -> bool:
+        """Загружает слитый чекпоинт (scripts/build_fused_checkpoint.py): LoRA уже в UNet, токены TI
+        в токенизаторах и эмбеддингах; safetensors читаются через mmap. False — чекпоинта нет
+        или он собран из других файлов LoRA/TI либо с другим весом LoRA."""
+        manifest = fused_checkpoint.read_manifest(FUSED_CHECKPOINT_DIR)
+        if manifest is None:
+            logger.info(f"ℹ️ Слитый чекпоинт не найден в {FUSED_CHECKPOINT_DIR}, загружаем базовую модель")
+            return False
+        stale = fused_checkpoint.stale_sources(manifest, {"lora": os.path.join(LORA_DIR, LORA_WEIGHT_NAME), "ti": TI_PATH})
+        stale += fused_checkpoint.stale_parameters(manifest, lora_scale=fused_checkpoint.LORA_SCALE)
+        if stale:
+            logger.warning(f"⚠️ Слитый чекпоинт устарел (изменились {stale}), загружаем базовую модель")
+            return False
+        try:
+            self.pipe = StableDiffusionXLPipeline.from_pretrained(
+                FUSED_CHECKPOINT_DIR,
+                torch_dtype=torch.float16,
+                use_safetensors=True,
+                variant="fp16",
+                local_files_only=True
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить слитый чекпоинт: {e}. Загружаем базовую модель")
+            return False
+        logger.info(f"✅ Слитый чекпоинт загружен: {FUSED_CHECKPOINT_DIR} (собран {manifest.get('created_at')})")
+        return True
+    
+    def _load_lora_adapters(self):
+        """Подключает LoRA к базовой модели с fuse_lora (путь без слитого чекпоинта)."""
         # 4. Загрузка НАШИХ обученных LoRA (robust для разных версий diffusers)
         logger.info("🔧 Загрузка НАШИХ LoRA адаптеров...")
-        lora_dir = "/src/model_files"
-        lora_weight_name = "rubber-tile-lora-v4_sdxl_lora.safetensors"
+        lora_dir = LORA_DIR
+        lora_weight_name = LORA_WEIGHT_NAME
         
         # Проверяем, что LoRA файлы существуют и не являются Git LFS указателями
         lora_file_path = f"{lora_dir}/{lora_weight_name}"
@@ -717,36 +537,25 @@ class Predictor(BasePredictor):
         else:
             try:
                 loaded = False
-                # Попытка 1: set_adapters + fuse_lora (если доступно)
-                try:
-                    if hasattr(self.pipe, "set_adapters"):
-                        self.pipe.set_adapters(["rubber-tile-lora-v4"], adapter_weights=[0.75])
-                        if hasattr(self.pipe, "fuse_lora"):
-                            self.pipe.fuse_lora()
-                        loaded = True
-                        logger.info("✅ LoRA подключена через set_adapters (+fuse_lora при наличии)")
-                except Exception as e1:
-                    logger.warning(f"⚠️ set_adapters недоступен или не сработал: {e1}")
-                
-                # Попытка 2: load_lora_weights из директории с указанием файла safetensors
+                # Попытка 1: load_lora_weights из директории с указанием файла safetensors
                 if not loaded:
                     try:
                         if hasattr(self.pipe, "load_lora_weights"):
                             self.pipe.load_lora_weights(lora_dir, weight_name=lora_weight_name)
                             # При наличии, выполняем fuse_lora для ускорения
                             if hasattr(self.pipe, "fuse_lora"):
-                                self.pipe.fuse_lora()
+                                self.pipe.fuse_lora(lora_scale=fused_checkpoint.LORA_SCALE)
                             loaded = True
                             logger.info("✅ LoRA загружена через load_lora_weights(dir, weight_name=.safetensors)")
                     except Exception as e2:
                         logger.warning(f"⚠️ load_lora_weights(dir, weight_name) не сработал: {e2}")
                 
-                # Попытка 3: прямой путь к весам через load_lora_weights (на старых версиях иногда работает)
+                # Попытка 2: прямой путь к весам через load_lora_weights (на старых версиях иногда работает)
                 if not loaded:
                     try:
                         self.pipe.load_lora_weights(f"{lora_dir}/{lora_weight_name}")
                         if hasattr(self.pipe, "fuse_lora"):
-                            self.pipe.fuse_lora()
+                            self.pipe.fuse_lora(lora_scale=fused_checkpoint.LORA_SCALE)
                         loaded = True
                         logger.info("✅ LoRA загружена через load_lora_weights(file)")
                     except Exception as e3:
@@ -759,7 +568,9 @@ class Predictor(BasePredictor):
                     
             except Exception as e:
                 logger.warning(f"⚠️ Ошибка загрузки LoRA: {e}. Модель будет работать без LoRA адаптеров.")
-        
+    
+    def _load_textual_inversion(self):
+        """Добавляет токены <s0>/<s1> и их эмбеддинги в оба текстовых энкодера (путь без слитого чекпоинта)."""
         # 5. ДЕТАЛЬНАЯ ДИАГНОСТИКА РАЗМЕРОВ SDXL
         logger.info("🔍 ДЕТАЛЬНАЯ ДИАГНОСТИКА РАЗМЕРОВ SDXL...")
         
@@ -784,7 +595,7 @@ class Predictor(BasePredictor):
         
         # 6. Загрузка НАШИХ обученных Textual Inversion (ИСПРАВЛЕНИЕ ПЕРЕПУТАННЫХ РАЗМЕРОВ)
         logger.info("🔤 Загрузка НАШИХ Textual Inversion (ИСПРАВЛЕНИЕ ПЕРЕПУТАННЫХ РАЗМЕРОВ)...")
-        ti_path = "/src/model_files/rubber-tile-lora-v4_sdxl_embeddings.safetensors"
+        ti_path = TI_PATH
         
         # Проверяем, что Textual Inversion файл существует и не является Git LFS указателем
         ti_file_valid = False
@@ -951,34 +762,182 @@ class Predictor(BasePredictor):
                 logger.error(f"📊 Детали ошибки: {type(e).__name__}: {str(e)}")
                 logger.error("🔄 Продолжение без Textual Inversion (качество может быть снижено)")
                 # Продолжаем без Textual Inversion, если загрузка не удалась
+    
+    def _create_controlnet_pool(self) -> Optional[ControlNetPool]:
+        """Создает пул ControlNet из CONTROLNET_MODELS; pipeline-варианты делят UNet, VAE и энкодеры self.pipe"""
+        if ControlNetModel is None or StableDiffusionXLControlNetPipeline is None:
+            logger.warning("⚠️ ControlNet недоступен в установленной версии diffusers")
+            return None
+        specs = parse_controlnet_specs(CONTROLNET_MODELS)
+        if not specs:
+            logger.warning(f"⚠️ Пустая спецификация CONTROLNET_MODELS: '{CONTROLNET_MODELS}'")
+            return None
         
-        # 7. Настройка планировщика
-        logger.info("⚙️ Настройка планировщика...")
-        self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(
-            self.pipe.scheduler.config,
-            algorithm_type="dpmsolver++",
-            use_karras_sigmas=True
-        )
-        
-        # 8. Оптимизации VAE (как в успешной модели v45)
-        logger.info("🚀 Применение VAE оптимизаций (метод v45)...")
-        self.pipe.vae.enable_slicing()
-        # Включаем tiling для лучшей детализации (как в v45)
-        self.pipe.vae.enable_tiling()
-        logger.info("✅ VAE tiling включен для максимальной детализации")
+        def load_model(source: str):
+            controlnet = ControlNetModel.from_pretrained(source, torch_dtype=torch.float16).to(self.device)
+            return self._gate_controlnet_forward(controlnet)
+        
+        def build_pipeline(controlnet):
+            return self._instrument_pipeline(StableDiffusionXLControlNetPipeline(
+                vae=self.pipe.vae,
+                text_encoder=self.pipe.text_encoder,
+                text_encoder_2=self.pipe.text_encoder_2,
+                tokenizer=self.pipe.tokenizer,
+                tokenizer_2=self.pipe.tokenizer_2,
+                unet=self.pipe.unet,
+                controlnet=controlnet,
+                scheduler=self.pipe.scheduler
+            ).to(self.device))
+        
+        return ControlNetPool(specs, load_model, build_pipeline)
+    
+    def _create_img2img_pipeline(self):
+        """Img2img-вариант self.pipe (latent_init): UNet, VAE, энкодеры и scheduler общие с базовым pipeline"""
         try:
-            # Формат каналов для ускорения и стабильности
-            self.pipe.unet.to(memory_format=torch.channels_last)
-            self.pipe.vae.to(memory_format=torch.channels_last)
-        except Exception:
-            pass
-        
-        # 9. Очистка памяти
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        gc.collect()
+            return self._instrument_pipeline(StableDiffusionXLImg2ImgPipeline(
+                vae=self.pipe.vae,
+                text_encoder=self.pipe.text_encoder,
+                text_encoder_2=self.pipe.text_encoder_2,
+                tokenizer=self.pipe.tokenizer,
+                tokenizer_2=self.pipe.tokenizer_2,
+                unet=self.pipe.unet,
+                scheduler=self.pipe.scheduler
+            ).to(self.device))
+        except Exception as e:
+            logger.warning(f"⚠️ Img2img pipeline недоступен, latent_init будет заменен ControlNet: {e}")
+            return None
+    
+    def _gate_controlnet_forward(self, controlnet):
+        """Пропускает forward ControlNet на шагах вне его окна control_guidance_start/end.
+        diffusers вызывает модель и там с conditioning_scale=0, а результат умножает на 0;
+        вместо этого возвращаем нулевые остатки той же формы (запомненные по форме входа).
+        После отключения безусловной ветки CFG (расписание guidance) считает только условную половину."""
+        original_forward = controlnet.forward
+        zero_residuals: Dict[tuple, tuple] = {}
+        
+        def forward(sample, *args, conditioning_scale=1.0, return_dict=True, **kwargs):
+            guidance = getattr(self._guidance_state, "state", None)
+            if guidance is not None and guidance["truncated"] and sample.shape[0] == 2 * guidance["batch"]:
+                batch = guidance["batch"]
+                sample, args, kwargs = self._cond_half(sample, batch), self._cond_half(args, batch), self._cond_half(kwargs, batch)
+            shape_key = tuple(sample.shape)
+            if conditioning_scale == 0 and not return_dict and shape_key in zero_residuals:
+                return zero_residuals[shape_key]
+            output = original_forward(sample, *args, conditioning_scale=conditioning_scale, return_dict=return_dict, **kwargs)
+            if not return_dict and shape_key not in zero_residuals:
+                down_block_res_samples, mid_block_res_sample = output
+                zero_residuals[shape_key] = (
+                    tuple(torch.zeros_like(residual) for residual in down_block_res_samples),
+                    torch.zeros_like(mid_block_res_sample)
+                )
+            return output
         
-        logger.info(f"🎉 Модель {MODEL_VERSION} успешно инициализирована!")
+        controlnet.forward = forward
+        return controlnet
+    
+    def _schedule_unet_guidance(self, unet):
+        """UNet с расписанием CFG: после отключения безусловной ветки удвоенный батч считается только
+        по условной половине, а результат дублируется (CFG от двух равных веток дает условную).
+        До отключения при пороге delta замеряется относительная разница ветвей ||cond − uncond|| / ||cond||."""
+        if getattr(unet, "_guidance_scheduled", False):
+            return unet
+        original_forward = unet.forward
+        
+        def forward(sample, *args, **kwargs):
+            guidance = getattr(self._guidance_state, "state", None)
+            if guidance is None or sample.shape[0] != 2 * guidance["batch"]:
+                return original_forward(sample, *args, **kwargs)
+            if guidance["truncated"]:
+                batch = guidance["batch"]
+                output = original_forward(self._cond_half(sample, batch), *self._cond_half(args, batch),
+                                          **self._cond_half(kwargs, batch))
+                noise = output[0] if isinstance(output, tuple) else output.sample
+                noise = torch.cat([noise, noise])
+                return (noise,) + tuple(output[1:]) if isinstance(output, tuple) else type(output)(sample=noise)
+            output = original_forward(sample, *args, **kwargs)
+            if guidance["needs_delta"]:
+                noise = output[0] if isinstance(output, tuple) else output.sample
+                uncond, cond = noise.float().chunk(2)
+                guidance["delta"] = ((cond - uncond).norm() / cond.norm().clamp_min(1e-6)).item()
+            return output
+        
+        unet.forward = forward
+        unet._guidance_scheduled = True
+        return unet
+    
+    @staticmethod
+    def _cond_half(value, batch: int):
+        """Условная половина удвоенного CFG-батча (порядок diffusers [uncond, cond]): тензоры с 2×batch
+        сэмплами -> вторая половина, вложенные tuple/list/dict — поэлементно, остальное как есть."""
+        if torch.is_tensor(value):
+            return value.chunk(2)[1] if value.dim() > 0 and value.shape[0] == 2 * batch else value
+        if isinstance(value, (list, tuple)):
+            return type(value)(Predictor._cond_half(item, batch) for item in value)
+        if isinstance(value, dict):
+            return {key: Predictor._cond_half(item, batch) for key, item in value.items()}
+        return value
+    
+    def _warmup(self) -> None:
+        """Минимальная генерация в боевом разрешении через каждый обслуживаемый pipeline (базовый,
+        ControlNet-наборы из пула и img2img для latent_init), пока время прогона не перестанет меняться."""
+        variants = [("plain", self.pipe, {})]
+        if self.controlnet_pool is not None:
+            for names in self._served_controlnet_sets():
+                if not self.controlnet_pool.is_ready(names):
+                    logger.info(f"ℹ️ ControlNet {names} еще загружается, прогрев пропущен")
+                    continue
+                pipe = self.controlnet_pool.pipeline(names)
+                if pipe is not None:
+                    blank_hints = [Image.new("L", (1024, 1024), 0) for _ in names]
+                    variants.append(("+".join(names), pipe, build_multi_controlnet_kwargs(names, blank_hints)))
+        if self.img2img_pipe is not None:
+            # latent_init: img2img от пустого init-изображения прогревает и VAE encode
+            blank_init = Image.new("RGB", (1024, 1024), (255, 255, 255))
+            variants.append(("img2img", self.img2img_pipe, {"image": blank_init, "strength": LATENT_INIT_STRENGTH}))
+        
+        for name, pipe, variant_kwargs in variants:
+            pipe_kwargs = dict(
+                prompt="ohwx_rubber_tile <s0><s1> 100% red rubber tile",
+                negative_prompt="",
+                num_inference_steps=WARMUP_STEPS,
+                guidance_scale=7.5,
+                width=1024,
+                height=1024,
+                **variant_kwargs
+            )
+            if pipe is self.img2img_pipe:
+                # Размер задает init-изображение, как в latent_init запроса; img2img проходит только
+                # долю strength шагов, поэтому шагов не меньше, чем нужно для одного шага денойзинга
+                pipe_kwargs.pop("width")
+                pipe_kwargs.pop("height")
+                pipe_kwargs["num_inference_steps"] = max(WARMUP_STEPS, math.ceil(1 / max(LATENT_INIT_STRENGTH, 0.01)))
+            
+            def run() -> None:
+                self._run_batch_requests(None, [(pipe, pipe_kwargs, [0])])
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+            
+            try:
+                durations = run_until_steady(run, WARMUP_MAX_RUNS)
+            except Exception as e:
+                logger.warning(f"⚠️ Прогрев {name} не удался: {e}")
+                continue
+            self.warmup_stats[name] = [round(duration, 2) for duration in durations]
+            logger.info(f"🔥 Прогрев {name}: {len(durations)} прогон(ов) по {WARMUP_STEPS} шагов, {self.warmup_stats[name]} с")
+    
+    def _served_controlnet_sets(self) -> List[List[str]]:
+        """Наборы ControlNet, которые будут обслуживаться: основной и выбор select_optimal_controlnet
+        по числу цветов (только модели из пула, как в apply_multi_controlnet)."""
+        served = [self._default_controlnet_names()]
+        for color_count in (2, 3, 4):
+            selected = [name for name in self.select_optimal_controlnet(color_count) or [] if name in self.controlnet_pool.specs]
+            if selected and selected not in served:
+                served.append(selected)
+        return served
+    
+    def _default_controlnet_names(self) -> List[str]:
+        """Набор ControlNet основного pipeline: первая модель из CONTROLNET_MODELS"""
+        return list(self.controlnet_pool.specs)[:1] if self.controlnet_pool is not None else []
     
     def _rgba_gray_hint(self, img: Image.Image) -> Image.Image:
         """Конвертирует изображение в градации серого для ControlNet с учётом альфа-канала.
@@ -1142,6 +1101,306 @@ class Predictor(BasePredictor):
         
         return img
     
+    def _resolve_seeds(self, seed: int, num_outputs: int, seeds: str) -> List[int]:
+        """Seeds вариантов: явный список через запятую или seed, seed+1, ... (num_outputs штук)"""
+        if seeds and seeds.strip():
+            try:
+                parsed = [int(value) for value in seeds.replace(";", ",").split(",") if value.strip()]
+            except ValueError:
+                logger.warning(f"⚠️ Не удалось распарсить seeds '{seeds}', используем seed и num_outputs")
+                parsed = []
+            if parsed:
+                if len(parsed) > MAX_OUTPUTS:
+                    logger.warning(f"⚠️ Seeds обрезаны до {MAX_OUTPUTS}")
+                return parsed[:MAX_OUTPUTS]
+        
+        count = max(1, min(MAX_OUTPUTS, int(num_outputs)))
+        return [seed + index for index in range(count)]
+    
+    def _max_batch_size(self) -> int:
+        """Сколько сэмплов помещается в один проход UNet по свободной VRAM (не больше MAX_BATCH_SIZE).
+        Свободной считается и зарезервированная, но не занятая память аллокатора: MemoryGovernor
+        намеренно держит кэш теплым, и mem_get_info() без него занижал бы предел до 1."""
+        if self.device != "cuda" or not torch.cuda.is_available():
+            return max(1, MAX_BATCH_SIZE)
+        try:
+            free_bytes, _ = torch.cuda.mem_get_info()
+            free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        except Exception:
+            return 1
+        return max(1, min(MAX_BATCH_SIZE, int(free_bytes // (BATCH_SAMPLE_VRAM_MB * 1024 * 1024))))
+    
+    def _generate_batched(self, pipe, pipe_kwargs: Dict[str, Any], seeds: List[int]) -> List[tuple]:
+        """Генерирует по паре (финал, превью) на seed (см. _submit_generation) и ждет результат."""
+        return self._submit_generation(pipe, pipe_kwargs, seeds).result()
+    
+    def _submit_generation(self, pipe, pipe_kwargs: Dict[str, Any], seeds: List[int]) -> Future:
+        """Запускает генерацию по изображению на seed и сразу возвращает Future, чтобы predict()
+        мог отдавать латентные превью во время денойзинга. При включенном планировщике запрос
+        может попасть в общий батч с совместимыми конкурентными запросами; иначе идет в своем потоке
+        (конкурентные генерации без планировщика выполняются по одной)."""
+        if self.batch_scheduler is not None:
+            return self.batch_scheduler.submit(self._batch_key(pipe, pipe_kwargs), (pipe, pipe_kwargs, seeds), len(seeds))
+        
+        future: Future = Future()
+        
+        def run() -> None:
+            try:
+                with self._gpu_lock:
+                    result = self._run_batch_requests(None, [(pipe, pipe_kwargs, seeds)])[0]
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+        
+        threading.Thread(target=run, name="generation", daemon=True).start()
+        return future
+    
+    def _batch_key(self, pipe, pipe_kwargs: Dict[str, Any]) -> tuple:
+        """Ключ совместимости запросов: pipeline, шаги, guidance, размер, ControlNet, вид промпта"""
+        return (
+            id(pipe),
+            pipe_kwargs.get("num_inference_steps"),
+            pipe_kwargs.get("guidance_scale"),
+            pipe_kwargs.get("width"),
+            pipe_kwargs.get("height"),
+            "image" in pipe_kwargs,
+            str(pipe_kwargs.get("controlnet_conditioning_scale")),
+            str(pipe_kwargs.get("control_guidance_start")),
+            str(pipe_kwargs.get("control_guidance_end")),
+            pipe_kwargs.get("strength"),
+            str(pipe_kwargs.get("guidance_schedule")),
+            "prompt_embeds" in pipe_kwargs
+        )
+    
+    def _merge_pipe_kwargs(self, kwargs_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Объединяет аргументы сэмплов одного батча: эмбеддинги и хинты по сэмплу, остальное общее"""
+        merged = dict(kwargs_list[0])
+        if len(kwargs_list) == 1:
+            return merged
+        for field in prompt_embedding_cache.EMBEDDING_FIELDS:
+            if field in merged:
+                merged[field] = torch.cat([kwargs[field] for kwargs in kwargs_list], dim=0)
+        for field in ("prompt", "negative_prompt", "image"):
+            if field in merged:
+                merged[field] = [kwargs[field] for kwargs in kwargs_list]
+        # Multi-ControlNet: image — список по моделям, в каждом — карты сэмплов
+        if isinstance(kwargs_list[0].get("image"), list):
+            merged["image"] = [[kwargs["image"][net] for kwargs in kwargs_list] for net in range(len(kwargs_list[0]["image"]))]
+        return merged
+    
+    def _run_batch_requests(self, key, requests: List[tuple]) -> List[List[tuple]]:
+        """Выполняет запросы (pipe, pipe_kwargs, seeds) одного ключа общим циклом денойзинга.
+        Сэмплы всех запросов идут под-батчами по _max_batch_size() с генератором на сэмпл;
+        возвращает пары (финал, превью) каждого запроса в порядке его seeds. Превью строится
+        на GPU (_gpu_postprocess()), иначе None — его уменьшит _save_preview на CPU."""
+        pipe = requests[0][0]
+        samples = [
+            (index, pipe_kwargs, seed, variant)
+            for index, (_, pipe_kwargs, seeds) in enumerate(requests) for variant, seed in enumerate(seeds)
+        ]
+        results: List[List[tuple]] = [[] for _ in requests]
+        gpu_postprocess = self._gpu_postprocess()
+        
+        batch_size = self._max_batch_size()
+        for start in range(0, len(samples), batch_size):
+            chunk = samples[start:start + batch_size]
+            batch_kwargs = self._merge_pipe_kwargs([pipe_kwargs for _, pipe_kwargs, _, _ in chunk])
+            batch_kwargs.pop("latent_previewer", None)
+            batch_kwargs.pop("stage_profiler", None)
+            batch_kwargs.pop("guidance_report", None)
+            guidance_schedule = batch_kwargs.pop("guidance_schedule", None)
+            if len(chunk) > 1:
+                batch_kwargs["num_images_per_prompt"] = 1
+            if len(samples) > 1:
+                logger.info(f"🚀 Под-батч {start // batch_size + 1}: {len(chunk)} сэмпл(ов), "
+                            f"seeds={[seed for _, _, seed, _ in chunk]}")
+            # Превью каждого сэмпла уходят в превьюер его запроса, замеры шагов — в профили запросов под-батча
+            preview_targets = [(pipe_kwargs.get("latent_previewer"), variant) for _, pipe_kwargs, _, variant in chunk]
+            profilers = list({
+                id(pipe_kwargs["stage_profiler"]): pipe_kwargs["stage_profiler"]
+                for _, pipe_kwargs, _, _ in chunk if pipe_kwargs.get("stage_profiler") is not None
+            }.values())
+            guidance_reports = list({
+                id(pipe_kwargs["guidance_report"]): pipe_kwargs["guidance_report"]
+                for _, pipe_kwargs, _, _ in chunk if pipe_kwargs.get("guidance_report") is not None
+            }.values())
+            total_steps = self._denoising_steps(batch_kwargs)
+            guidance_attempt: Dict[str, Any] = {}
+            
+            def run_pipe():
+                # Состояние расписания CFG — на каждую попытку: pipeline заново включает обе ветки
+                guidance = None
+                if (guidance_schedule is not None and guidance_schedule.enabled
+                        and batch_kwargs.get("guidance_scale", 0) > 1.0):
+                    guidance = {"schedule": guidance_schedule, "batch": len(chunk), "needs_delta": guidance_schedule.needs_delta,
+                                "truncated": False, "truncated_at": None, "delta": None}
+                guidance_attempt["state"] = guidance
+                self._guidance_state.state = guidance
+                # Коллбэк создается на каждую попытку: отсчет первого шага начинается с запуска pipeline
+                if profilers or guidance is not None or any(previewer is not None for previewer, _ in preview_targets):
+                    batch_kwargs["callback_on_step_end"] = self._step_callback(
+                        preview_targets, profilers, total_steps, guidance
+                    )
+                    batch_kwargs["callback_on_step_end_tensor_inputs"] = ["latents"]
+                return pipe(**{
+                    **batch_kwargs,
+                    "generator": [torch.Generator(device=self.device).manual_seed(seed) for _, _, seed, _ in chunk],
+                    "output_type": "pt" if gpu_postprocess else "pil"
+                })
+            
+            # При OOM governor освобождает кэш и повторяет под-батч со свежими генераторами
+            self._active_profilers.profilers = profilers
+            try:
+                result = self.memory_governor.run(run_pipe)
+                if gpu_postprocess:
+                    with profile_stage(profilers, "device_postprocess"):
+                        outputs = device_postprocess.postprocess(result.images, PREVIEW_IMAGE_SIZE)
+                else:
+                    outputs = [(image, None) for image in result.images]
+            finally:
+                self._active_profilers.profilers = []
+                self._guidance_state.state = None
+            guidance = guidance_attempt.get("state")
+            for report in guidance_reports:
+                report.update(steps=total_steps, truncated_at_step=guidance["truncated_at"] if guidance else None,
+                              last_delta=round(guidance["delta"], 4) if guidance and guidance["delta"] is not None else None)
+            for (index, _, _, _), output in zip(chunk, outputs):
+                results[index].append(output)
+        return results
+    
+    @staticmethod
+    def _denoising_steps(pipe_kwargs: Dict[str, Any]) -> int:
+        """Фактическое число шагов денойзинга: img2img (strength) проходит только хвост расписания"""
+        steps = pipe_kwargs["num_inference_steps"]
+        if "strength" in pipe_kwargs:
+            return min(steps, int(steps * pipe_kwargs["strength"]))
+        return steps
+    
+    def _gpu_postprocess(self) -> bool:
+        """Постобработка изображений на GPU (device_postprocess): только на CUDA и если не выключена"""
+        return GPU_POSTPROCESS and self.device == "cuda"
+    
+    def _step_callback(self, preview_targets: List[tuple], profilers: List[StageProfiler], total_steps: int,
+                       guidance: Optional[Dict[str, Any]] = None):
+        """callback_on_step_end для под-батча: длительность шага -> профили запросов (первый шаг включает
+        подготовку латентов), латенты сэмпла i -> превьюер (previewer, variant) из preview_targets.
+        По расписанию CFG (guidance) после шага отключается безусловная ветка. Время построения
+        превью в шаги не входит."""
+        step_begin = [profilers[0].begin() if profilers else None]
+        
+        def callback(pipe, step_index, timestep, callback_kwargs):
+            if profilers:
+                measurement = profilers[0].end(step_begin[0])
+                for profiler in profilers:
+                    profiler.record_step(measurement)
+            if (guidance is not None and not guidance["truncated"]
+                    and guidance["schedule"].should_truncate(step_index + 1, total_steps, guidance["delta"])):
+                # Следующие шаги UNet (и ControlNet) считает только условную ветку на половинном батче
+                guidance["truncated"] = True
+                guidance["truncated_at"] = step_index + 1
+                logger.info(f"✂️ CFG отключен после шага {step_index + 1}/{total_steps} "
+                            f"({guidance['schedule']}, разница ветвей: {guidance['delta']})")
+            latents = callback_kwargs["latents"]
+            for sample, (previewer, variant) in enumerate(preview_targets):
+                if previewer is not None and previewer.should_preview(step_index + 1, total_steps):
+                    previewer.add(step_index + 1, latents[sample], variant)
+            if profilers:
+                step_begin[0] = profilers[0].begin()
+            return callback_kwargs
+        
+        return callback
+    
+    def _create_stage_profiler(self) -> StageProfiler:
+        """Профиль запроса: время стадий, пики VRAM и пиковый RSS; синхронизация CUDA и сброс пиков
+        на границах стадий — только при STAGE_PROFILING_SYNC (сброс пиков устройства посреди соседних
+        запросов к тому же искажает их метрики), иначе время на GPU — по CUDA-событиям, пики — на запрос."""
+        cuda_available = torch.cuda.is_available()
+        
+        def memory_probe() -> Dict[str, int]:
+            # ru_maxrss в Linux — килобайты
+            memory = {"rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+            if cuda_available:
+                memory["vram_peak"] = torch.cuda.max_memory_allocated()
+                memory["vram_reserved_peak"] = torch.cuda.max_memory_reserved()
+            return memory
+        
+        return StageProfiler(
+            synchronize=torch.cuda.synchronize if cuda_available and STAGE_PROFILING_SYNC else None,
+            memory_probe=memory_probe,
+            reset_peak=torch.cuda.reset_peak_memory_stats if cuda_available and STAGE_PROFILING_SYNC else None,
+            # Без синхронизации время GPU-стадий — по парам CUDA-событий (хост не ждет устройство)
+            timing_event=(lambda: torch.cuda.Event(enable_timing=True)) if cuda_available else None
+        )
+    
+    def _instrument_pipeline(self, pipe):
+        """Замер VAE encode/decode и PIL-конвертации внутри pipeline: стадии пишутся в профили запросов,
+        которые сейчас выполняет этот поток (VAE общий у всех pipeline, оборачивается один раз)."""
+        for owner, method, stage_name in ((pipe.vae, "decode", "vae_decode"),
+                                          (pipe.vae, "encode", "vae_encode"),
+                                          (getattr(pipe, "image_processor", None), "postprocess", "pil_convert")):
+            if owner is None or getattr(owner, f"_stage_profiled_{method}", False):
+                continue
+            original = getattr(owner, method)
+            
+            def profiled(*args, _original=original, _stage_name=stage_name, **kwargs):
+                with profile_stage(getattr(self._active_profilers, "profilers", ()), _stage_name):
+                    return _original(*args, **kwargs)
+            
+            setattr(owner, method, profiled)
+            setattr(owner, f"_stage_profiled_{method}", True)
+        return pipe
+    
+    def _latent_preview_decode(self):
+        """Латент сэмпла -> маленькое RGB: TAESD, если загружен, иначе линейная проекция каналов"""
+        if self.preview_decoder is None:
+            return lambda latent: latent_preview.latents_to_rgb(latent.float().cpu().numpy())
+        
+        def decode(latent) -> Image.Image:
+            with torch.no_grad():
+                image = self.preview_decoder.decode(latent.unsqueeze(0).to(self.preview_decoder.dtype)).sample[0]
+            array = ((image.float().clamp(-1, 1) + 1) * 127.5).round().to(torch.uint8).permute(1, 2, 0).cpu().numpy()
+            return Image.fromarray(array, "RGB")
+        
+        return decode
+    
+    def _prompt_embedding_kwargs(self, prompt: str, negative_prompt: Optional[str], guidance_scale: float,
+                                 profiler: Optional[StageProfiler] = None) -> Dict[str, Any]:
+        """Аргументы промпта для pipeline: эмбеддинги обоих текстовых энкодеров из LRU-кэша.
+        Оба pipeline (базовый и ControlNet) делят энкодеры, поэтому эмбеддинги подходят обоим."""
+        raw_kwargs = {"prompt": prompt, "negative_prompt": negative_prompt}
+        if not hasattr(self.pipe, "encode_prompt"):
+            return raw_kwargs
+        
+        do_classifier_free_guidance = guidance_scale > 1.0
+        key = prompt_embedding_cache.prompt_embedding_key(
+            prompt, negative_prompt, device=self.device, dtype=self.pipe.text_encoder_2.dtype,
+            cfg=do_classifier_free_guidance
+        )
+        
+        def encode() -> Dict[str, Any]:
+            with torch.no_grad():
+                prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = self.pipe.encode_prompt(
+                    prompt=prompt,
+                    device=self.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                    negative_prompt=negative_prompt
+                )
+            return {
+                "prompt_embeds": prompt_embeds,
+                "negative_prompt_embeds": negative_prompt_embeds,
+                "pooled_prompt_embeds": pooled_prompt_embeds,
+                "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds
+            }
+        
+        try:
+            with profile_stage([profiler], "text_encoding"):
+                embeddings = self.prompt_embedding_cache.get_or_encode(key, encode)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось закодировать промпт заранее, передаем строки: {e}")
+            return raw_kwargs
+        return {field: tensor for field, tensor in embeddings.items() if tensor is not None}
+    
     def _build_prompt_from_simple(self, simple_prompt: str) -> str:
         """Преобразование простого промпта в полный формат с НАШИМИ токенами (как в v45)."""
         # Базовый промпт с НАШИМИ токенами активации (как в v45)
@@ -1234,68 +1493,188 @@ class Predictor(BasePredictor):
             logger.warning(f"⚠️ Ошибка усиления токенов цветов: {e}")
             return prompt
     
-    def _create_optimized_colormap(self, prompt: str, size: tuple = (1024, 1024), pattern_type: str = "random", granule_size: str = "medium") -> Image.Image:
-        """Создает оптимизированный colormap для ControlNet с точными пропорциями"""
-        try:
-            # Парсим цвета из промпта
-            colors = self._parse_percent_colors(prompt)
-            if not colors:
-                logger.warning("⚠️ Не удалось распарсить цвета, создаем базовый colormap")
-                return Image.new('RGBA', size, (255, 255, 255, 0))  # Прозрачный фон
-            
-            # Если паттерн не указан, определяем оптимальный на основе количества цветов
-            if pattern_type == "random":
-                color_count = len(colors)
-                if color_count == 1:
-                    pattern_type = "random"  # Простой случай
-                elif color_count == 2:
-                    pattern_type = "granular"  # Имитация резиновой крошки
-                elif color_count == 3:
-                    pattern_type = "granular"  # Сложная крошка
-                else:  # 4+ цветов
-                    pattern_type = "granular"  # Максимальная сложность
-            
-            logger.info(f"🎨 Создание colormap: {len(colors)} цветов, паттерн: {pattern_type}, гранулы: {granule_size}")
-            
-            # Обновляем статистику использования
+    def _resolve_pattern_type(self, colors: List[Dict[str, Any]], pattern_type: str) -> str:
+        """Паттерн "random" по умолчанию заменяется оптимальным для количества цветов"""
+        if pattern_type == "random":
+            color_count = len(colors)
+            if color_count == 1:
+                return "random"  # Простой случай
+            elif color_count == 2:
+                return "granular"  # Имитация резиновой крошки
+            elif color_count == 3:
+                return "granular"  # Сложная крошка
+            else:  # 4+ цветов
+                return "granular"  # Максимальная сложность
+        return pattern_type
+    
+    def _create_optimized_label_map(self, prompt: str, size: tuple = (1024, 1024), pattern_type: str = "random", granule_size: str = "medium",
+                                    colormap_seed: Optional[int] = None, use_cache: bool = True) -> Optional[colormap_engine.LabelMap]:
+        """Создает палитровую карту меток colormap с точными пропорциями (None, если цвета не распознаны).
+        При заданном colormap_seed результат берется из кэша/кладется в кэш; None — свежая случайная карта."""
+        # Парсим цвета из промпта
+        colors = self._parse_percent_colors(prompt)
+        if not colors:
+            logger.warning("⚠️ Не удалось распарсить цвета, создаем базовый colormap")
+            return None
+        
+        # Если паттерн не указан, определяем оптимальный на основе количества цветов
+        pattern_type = self._resolve_pattern_type(colors, pattern_type)
+        
+        logger.info(f"🎨 Создание colormap: {len(colors)} цветов, паттерн: {pattern_type}, гранулы: {granule_size}")
+        
+        # Обновляем статистику использования
+        with self._stats_lock:
             self.color_grid_stats["patterns_used"][pattern_type] += 1
             self.color_grid_stats["granule_sizes_used"][granule_size] += 1
-            
-            # Создаем оптимизированный colormap и готовый L-хинт (один проход)
-            try:
-                colormap, hint_l = self.color_grid_adapter.create_optimized_colormap_and_hint(
-                    colors, size, pattern_type, granule_size
-                )
-            except Exception:
-                # Совместимость со старыми реализациями
-                colormap = self.color_grid_adapter.create_optimized_colormap(
-                    colors, size, pattern_type, granule_size
-                )
-                hint_l = None
-            
-            logger.info(f"✅ Оптимизированный colormap создан: {colormap.size}")
+        
+        # Кэш между запросами: одинаковый рецепт и seed дают одинаковую карту
+        cache_key = None
+        if use_cache and colormap_seed is not None:
+            cache_key = colormap_engine.colormap_cache_key(colors, size, pattern_type, granule_size, colormap_seed,
+                                                           self.color_grid_adapter.engine_signature())
+            cached = self.colormap_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"♻️ Colormap взят из кэша: {cache_key[:12]}")
+                return cached
+        
+        label_map = self.color_grid_adapter.create_label_map(colors, size, pattern_type, granule_size, colormap_seed)
+        if cache_key is not None:
+            self.colormap_cache.put(cache_key, label_map)
+        
+        logger.info(f"✅ Оптимизированный colormap создан: {label_map.size} ({label_map.nbytes / 1024:.0f} KB)")
+        with self._stats_lock:
             logger.info(f"📊 Статистика паттернов: {self.color_grid_stats['patterns_used']}")
             logger.info(f"📊 Статистика размеров гранул: {self.color_grid_stats['granule_sizes_used']}")
-            
-            return colormap if hint_l is None else (colormap, hint_l)
+        return label_map
+    
+    def _create_optimized_colormap(self, prompt: str, size: tuple = (1024, 1024), pattern_type: str = "random", granule_size: str = "medium",
+                                   colormap_seed: Optional[int] = None, use_cache: bool = True) -> Image.Image:
+        """Создает оптимизированный colormap для ControlNet с точными пропорциями (пара RGBA colormap и L-хинт)"""
+        try:
+            label_map = self._create_optimized_label_map(prompt, size, pattern_type, granule_size, colormap_seed, use_cache)
+            if label_map is None:
+                return Image.new('RGBA', size, (255, 255, 255, 0))  # Прозрачный фон
+            return label_map.rgba, label_map.hint
             
         except Exception as e:
             logger.error(f"❌ Ошибка создания оптимизированного colormap: {e}")
             # Fallback: простой colormap
             return self._render_legend(self._parse_percent_colors(prompt), size)
     
+    def _build_colormap_artifact(self, prompt: str, pattern_type: str, granule_size: str,
+                                 colormap_seed: Optional[int], use_cache: bool,
+                                 size: tuple = (1024, 1024),
+                                 profiler: Optional[StageProfiler] = None) -> colormap_engine.ColormapArtifact:
+        """Создает colormap запроса один раз: генерация, валидация и при необходимости пересборка.
+        Из результата берутся хинт ControlNet, сохраненный colormap, легенда и generation_data.json."""
+        start_time = time.perf_counter()
+        stage_begin = profiler.begin(gpu=False) if profiler is not None else None
+        try:
+            label_map = self._create_optimized_label_map(prompt, size, pattern_type, granule_size, colormap_seed, use_cache)
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания оптимизированного colormap: {e}")
+            label_map = None
+        if label_map is None:
+            # Пустая карта не пройдет валидацию и будет пересобрана
+            label_map = colormap_engine.LabelMap(np.zeros((size[1], size[0]), dtype=np.uint8), [])
+        
+        colors = self._parse_percent_colors(prompt)
+        artifact = colormap_engine.ColormapArtifact(
+            colors, label_map, colormap_seed,
+            self._resolve_pattern_type(colors, pattern_type), granule_size,
+            time.perf_counter() - start_time
+        )
+        
+        # Валидация colormap против промпта
+        with profile_stage([profiler], "validation", gpu=False):
+            valid = self._validate_colormap_against_prompt(artifact.label_map, prompt)
+        if not valid:
+            logger.warning("⚠️ Colormap не соответствует промпту, пересоздаем...")
+            self._rebuild_colormap_artifact(artifact, prompt)
+        
+        if profiler is not None:
+            profiler.record("colormap", profiler.end(stage_begin, gpu=False))
+        logger.info(f"⏱️ Colormap запроса: {artifact.generations} генерация(й) за {artifact.generation_seconds * 1000:.1f} мс")
+        return artifact
+    
+    def _rebuild_colormap_artifact(self, artifact: colormap_engine.ColormapArtifact, prompt: str) -> None:
+        """Принудительно пересобирает colormap запроса (после провала валидации)"""
+        start_time = time.perf_counter()
+        label_map = self._force_rebuild_label_map(prompt, size=artifact.size)
+        artifact.replace(label_map, time.perf_counter() - start_time)
+    
+    def _wait_colormap_artifact(self, future: Future) -> colormap_engine.ColormapArtifact:
+        """Ждет CPU-работу colormap из пула; ее исключения пробрасываются в predict()."""
+        start_time = time.perf_counter()
+        artifact = future.result()
+        wait_ms = (time.perf_counter() - start_time) * 1000
+        if wait_ms >= 1.0:
+            logger.info(f"⏱️ Ожидание colormap из пула CPU-работ: {wait_ms:.1f} мс")
+        return artifact
+    
+    def _write_colormap_output(self, artifact: colormap_engine.ColormapArtifact, writer: OutputWriter, base_path: str,
+                               kind: str) -> str:
+        """Сохраняет colormap или легенду (kind: colormap | legend) индексированным PNG (задача пула,
+        ставится после построения colormap и идет параллельно с UNet). Ошибка сохранения — белая заглушка."""
+        try:
+            # Индексированный PNG: палитра + 1 байт на пиксель
+            label_map = artifact.label_map if kind == "colormap" else artifact.legend
+            path = writer.encode(label_map.to_indexed_image(), base_path, "png", transparency=0)
+            if kind == "colormap":
+                logger.info(f"🎨 ОПТИМИЗИРОВАННЫЙ COLORMAP_READY {path}")
+                logger.info(f"📊 Размер colormap: {artifact.size}")
+            else:
+                logger.info(f"📋 ЛЕГЕНДА_READY {path}")
+        except Exception as e:
+            logger.error(f"❌ Критическая ошибка сохранения {kind}: {e}")
+            path = writer.encode(Image.new('RGBA', (256, 256), color=(255, 255, 255, 255)), base_path, "png")
+        return path
+    
+    def _write_final(self, image: Image.Image, writer: OutputWriter, base_path: str, output_format: str) -> str:
+        """Сохраняет финальное изображение (задача пула)."""
+        path = writer.encode(image, base_path, output_format)
+        logger.info(f"✅ FINAL_READY {path}")
+        return path
+    
+    def _save_preview(self, final_image: Image.Image, preview_image: Optional[Image.Image], writer: OutputWriter,
+                      base_path: str, output_format: str) -> str:
+        """Сохраняет превью 512×512 (задача пула): готовое с GPU или уменьшенное из финального изображения."""
+        if preview_image is None:
+            preview_image = final_image.resize((PREVIEW_IMAGE_SIZE, PREVIEW_IMAGE_SIZE), Image.Resampling.LANCZOS)
+        path = writer.encode(preview_image, base_path, output_format)
+        logger.info(f"🟡 PREVIEW_READY {path}")
+        return path
+    
     def get_color_grid_stats(self) -> Dict[str, Any]:
-        """Возвращает статистику использования Color Grid Adapter"""
+        """Возвращает статистику использования Color Grid Adapter (согласованный снимок счетчиков)"""
+        with self._stats_lock:
+            total_generations = self.color_grid_stats["total_generations"]
+            controlnet_used = self.color_grid_stats["controlnet_used"]
+            latent_init_used = self.color_grid_stats["latent_init_used"]
+            patterns_used = self.color_grid_stats["patterns_used"].copy()
+            granule_sizes_used = self.color_grid_stats["granule_sizes_used"].copy()
+            conditioning, guidance = (
+                {mode: {count: dict(entry) for count, entry in by_count.items()}
+                 for mode, by_count in self.color_grid_stats[table].items()}
+                for table in ("conditioning", "guidance")
+            )
         return {
-            "total_generations": self.color_grid_stats["total_generations"],
-            "controlnet_used": self.color_grid_stats["controlnet_used"],
-            "controlnet_usage_percent": round(
-                (self.color_grid_stats["controlnet_used"] / max(1, self.color_grid_stats["total_generations"])) * 100, 2
-            ),
-            "patterns_used": self.color_grid_stats["patterns_used"].copy(),
-            "granule_sizes_used": self.color_grid_stats["granule_sizes_used"].copy(),
-            "most_used_pattern": max(self.color_grid_stats["patterns_used"].items(), key=lambda x: x[1])[0],
-            "most_used_granule_size": max(self.color_grid_stats["granule_sizes_used"].items(), key=lambda x: x[1])[0]
+            "total_generations": total_generations,
+            "controlnet_used": controlnet_used,
+            "latent_init_used": latent_init_used,
+            "controlnet_usage_percent": round((controlnet_used / max(1, total_generations)) * 100, 2),
+            "patterns_used": patterns_used,
+            "granule_sizes_used": granule_sizes_used,
+            "conditioning": conditioning,
+            "guidance": guidance,
+            "most_used_pattern": max(patterns_used.items(), key=lambda x: x[1])[0],
+            "most_used_granule_size": max(granule_sizes_used.items(), key=lambda x: x[1])[0],
+            "colormap_cache": self.color_grid_stats["colormap_cache"].copy(),
+            "prompt_embedding_cache": self.color_grid_stats["prompt_embedding_cache"].copy(),
+            "batch_scheduler": self.color_grid_stats.get("batch_scheduler", {}).copy(),
+            "controlnet_pool": self.controlnet_pool.status() if self.controlnet_pool is not None else {},
+            "memory_governor": self.color_grid_stats["memory_governor"].copy(),
+            "workspaces": self.color_grid_stats["workspaces"].copy()
         }
     
     def test_color_grid_adapter(self, test_prompts: List[str] = None) -> Dict[str, Any]:
@@ -1343,14 +1722,27 @@ class Predictor(BasePredictor):
         logger.info("🧪 Тестирование Color Grid Adapter завершено")
         return test_results
     
-    def _validate_colormap_against_prompt(self, colormap: Image, prompt: str) -> bool:
-        """Валидация colormap против промпта (поддержка RGBA)"""
+    def _validate_colormap_against_prompt(self, colormap, prompt: str) -> bool:
+        """Валидация colormap против промпта (поддержка RGBA и палитровой карты меток)"""
         try:
             expected_colors = self.color_manager.extract_colors_from_prompt(prompt)
             if not expected_colors:
                 logger.warning("⚠️ Не удалось извлечь цвета из промпта")
                 return False
             
+            # Палитровая карта: проверка по счетчикам меток без построения RGBA
+            if isinstance(colormap, colormap_engine.LabelMap):
+                counts = colormap.pixel_counts()
+                used_colors = [rgb for rgb, count in zip(colormap.rgb_colors, counts[1:]) if count > 0]
+                if not used_colors:
+                    logger.warning("⚠️ Colormap полностью прозрачный")
+                    return False
+                if all(rgb == (127, 127, 127) for rgb in used_colors):
+                    logger.warning("⚠️ Colormap полностью серый в непрозрачных областях")
+                    return False
+                logger.info(f"✅ Colormap валиден для цветов: {expected_colors}")
+                return True
+            
             # Проверка: colormap не должен быть полностью серым или прозрачным
             colormap_array = np.array(colormap)
             
@@ -1390,76 +1782,93 @@ class Predictor(BasePredictor):
             logger.error(f"❌ Ошибка валидации colormap: {e}")
             return False
     
-    def _validate_controlnet_map(self, colormap: Image, prompt: str) -> bool:
-        """Валидация ControlNet карты перед передачей в ControlNet"""
+    def _analyze_controlnet_map(self, colormap, prompt: str) -> Dict[str, Any]:
+        """Отчет валидации ControlNet карты: число цветов и доля каждого цвета против целевой.
+        Принимает LabelMap (счетчики меток) или PIL-изображение (векторный подсчет уникальных цветов)."""
+        targets = self._color_targets(prompt)
+        if not targets:
+            return {"valid": False, "reason": "no_colors", "expected_count": 0, "colors": []}
+        
+        start_time = time.perf_counter()
+        report = colormap_engine.analyze_colormap_colors(colormap, targets, tolerance=10)
+        report["elapsed_ms"] = round((time.perf_counter() - start_time) * 1000, 2)
+        return report
+    
+    def _color_targets(self, prompt: str) -> List[Dict[str, Any]]:
+        """Ожидаемые цвета промпта {"name", "rgb", "proportion"}: доли из процентов, иначе равные"""
+        # Извлекаем ожидаемые цвета из промпта
+        expected_colors = self.color_manager.extract_colors_from_prompt(prompt)
+        if not expected_colors:
+            return []
+        
+        # Целевые доли берем из процентов промпта, иначе равные доли
+        proportions = {color["name"]: color["proportion"] for color in self._parse_percent_colors(prompt)}
+        return [
+            {
+                "name": name,
+                "rgb": self.color_manager.get_color_rgb(name),
+                "proportion": proportions.get(name, 1.0 / len(expected_colors))
+            }
+            for name in expected_colors
+        ]
+    
+    def _measure_color_fidelity(self, image: Image.Image, prompt: str) -> Dict[str, Any]:
+        """Цветовая точность финального изображения против цветов промпта (задача пула)"""
         try:
-            # Извлекаем ожидаемые цвета из промпта
-            expected_colors = self.color_manager.extract_colors_from_prompt(prompt)
-            if not expected_colors:
-                logger.warning("⚠️ Не удалось извлечь цвета из промпта для валидации ControlNet")
-                return False
-            
-            # Конвертируем colormap в массив для анализа
-            colormap_array = np.array(colormap)
-            
-            # Подсчитываем уникальные цвета в colormap
-            if len(colormap_array.shape) == 4:  # RGBA
-                # Берем только RGB каналы и альфа
-                rgb_array = colormap_array[:, :, :3]
-                alpha_array = colormap_array[:, :, 3]
-                
-                # Находим непрозрачные пиксели
-                opaque_mask = alpha_array > 128  # Порог прозрачности
-                if not np.any(opaque_mask):
-                    logger.warning("⚠️ ControlNet карта полностью прозрачна")
-                    return False
-                
-                # Получаем RGB значения непрозрачных пикселей
-                opaque_rgb = rgb_array[opaque_mask]
-                
-            elif len(colormap_array.shape) == 3:  # RGB
-                # Для RGB изображения берем все пиксели
-                opaque_rgb = colormap_array.reshape(-1, 3)
-            else:
-                logger.warning("⚠️ Неподдерживаемый формат ControlNet карты")
-                return False
-            
-            # Находим уникальные цвета (с допуском на вариации)
-            unique_colors = []
-            for pixel in opaque_rgb:
-                # Проверяем, есть ли уже похожий цвет
-                is_unique = True
-                for existing_color in unique_colors:
-                    if np.allclose(pixel, existing_color, atol=10):  # Допуск 10 единиц
-                        is_unique = False
-                        break
-                if is_unique:
-                    unique_colors.append(pixel)
-            
-            # Проверяем количество уникальных цветов
-            expected_count = len(expected_colors)
-            actual_count = len(unique_colors)
-            
-            logger.info(f"🔍 ControlNet валидация: ожидается {expected_count} цветов, найдено {actual_count}")
-            
-            # Допускаем небольшое отклонение (например, если один цвет представлен несколькими оттенками)
-            if actual_count < expected_count * 0.5:  # Менее 50% ожидаемых цветов
-                logger.warning(f"⚠️ ControlNet карта содержит слишком мало цветов: {actual_count} из {expected_count}")
-                return False
-            
-            if actual_count > expected_count * 2:  # Более чем в 2 раза больше ожидаемых
-                logger.warning(f"⚠️ ControlNet карта содержит слишком много цветов: {actual_count} из {expected_count}")
-                return False
-            
-            logger.info(f"✅ ControlNet карта валидна: {actual_count} уникальных цветов")
-            return True
-            
+            return colormap_engine.measure_color_fidelity(image, self._color_targets(prompt))
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось измерить цветовую точность: {e}")
+            return {"fidelity": None, "mean_color_error": None, "off_target": None, "colors": []}
+    
+    def _record_quality(self, table: str, mode: str, color_count: int, seconds: float, fidelity: Optional[float]) -> None:
+        """Копит средние время генерации и цветовую точность в таблице статистики table
+        (conditioning — по режиму кондиционирования, guidance — по расписанию CFG) и числу цветов"""
+        with self._stats_lock:
+            entry = self.color_grid_stats[table].setdefault(mode, {}).setdefault(
+                str(color_count), {"requests": 0, "mean_seconds": 0.0, "mean_fidelity": None}
+            )
+            entry["requests"] += 1
+            entry["mean_seconds"] = round(entry["mean_seconds"] + (seconds - entry["mean_seconds"]) / entry["requests"], 3)
+            if fidelity is not None:
+                current = entry["mean_fidelity"]
+                entry["mean_fidelity"] = round(fidelity if current is None else
+                                               current + (fidelity - current) / entry["requests"], 4)
+    
+    def _validate_controlnet_map(self, colormap, prompt: str, artifact: Optional[colormap_engine.ColormapArtifact] = None) -> bool:
+        """Валидация ControlNet карты перед передачей в ControlNet (отчет сохраняется в artifact.validation)"""
+        try:
+            report = self._analyze_controlnet_map(colormap, prompt)
         except Exception as e:
             logger.error(f"❌ Ошибка валидации ControlNet карты: {e}")
             return False
+        if artifact is not None:
+            artifact.validation = report
+        
+        if report["reason"] == "no_colors":
+            logger.warning("⚠️ Не удалось извлечь цвета из промпта для валидации ControlNet")
+            return False
+        if report["reason"] == "transparent":
+            logger.warning("⚠️ ControlNet карта полностью прозрачна")
+            return False
+        
+        logger.info(f"🔍 ControlNet валидация: ожидается {report['expected_count']} цветов, "
+                    f"найдено {report['found_count']} ({report['elapsed_ms']} мс)")
+        for color in report["colors"]:
+            logger.info(f"   🎨 {color['name']}: {color['share'] * 100:.1f}% (цель {color['target'] * 100:.1f}%)")
+        
+        # Допускаем небольшое отклонение (например, если один цвет представлен несколькими оттенками)
+        if report["reason"] == "too_few_colors":
+            logger.warning(f"⚠️ ControlNet карта содержит слишком мало цветов: {report['found_count']} из {report['expected_count']}")
+            return False
+        if report["reason"] == "too_many_colors":
+            logger.warning(f"⚠️ ControlNet карта содержит слишком много цветов: {report['found_count']} из {report['expected_count']}")
+            return False
+        
+        logger.info(f"✅ ControlNet карта валидна: {report['found_count']} уникальных цветов")
+        return True
     
-    def _force_rebuild_colormap(self, prompt: str, size: tuple = (1024, 1024)) -> Image:
-        """Принудительная пересборка colormap при ошибках"""
+    def _force_rebuild_label_map(self, prompt: str, size: tuple = (1024, 1024)) -> colormap_engine.LabelMap:
+        """Принудительная пересборка colormap при ошибках (равные доли цветов, случайное распределение)"""
         try:
             logger.info("🔧 Принудительная пересборка colormap...")
             
@@ -1468,39 +1877,14 @@ class Predictor(BasePredictor):
             if not colors:
                 logger.error("❌ Не удалось извлечь цвета для пересборки colormap")
                 # Fallback: простой серый colormap
-                return Image.new('RGBA', size, (127, 127, 127, 255))  # Непрозрачный серый фон
+                return colormap_engine.LabelMap(np.ones((size[1], size[0]), dtype=np.uint8), [(127, 127, 127)])
             
             # Создаем colormap со случайным распределением точек вместо полос
-            colormap = Image.new('RGBA', size, (255, 255, 255, 0))  # Прозрачный фон
-            pixels = colormap.load()
-            
-            # Создаем случайное распределение цветных точек
-            import random
-            total_pixels = size[0] * size[1]
-            
-            for i, color in enumerate(colors):
-                rgb = self.color_manager.get_color_rgb(color)
-                # Вычисляем количество пикселей для этого цвета (примерно равномерно)
-                pixels_per_color = total_pixels // len(colors)
-                
-                # Случайно размещаем пиксели этого цвета
-                placed_pixels = 0
-                max_attempts = pixels_per_color * 3  # Ограничиваем количество попыток
-                attempts = 0
-                
-                while placed_pixels < pixels_per_color and attempts < max_attempts:
-                    x = random.randint(0, size[0] - 1)
-                    y = random.randint(0, size[1] - 1)
-                    
-                    # Проверяем, что пиксель еще не занят
-                    if pixels[x, y] == (255, 255, 255, 0):  # Прозрачный пиксель
-                        pixels[x, y] = rgb
-                        placed_pixels += 1
-                    
-                    attempts += 1
+            labels = colormap_engine.build_random_label_map([1.0] * len(colors), size, np.random.default_rng())
+            label_map = colormap_engine.LabelMap(labels, [self.color_manager.get_color_rgb(color) for color in colors])
             
             logger.info(f"✅ Colormap пересобран для цветов: {colors}")
-            return colormap
+            return label_map
             
         except Exception as e:
             logger.error(f"❌ Критическая ошибка пересборки colormap: {e}")
@@ -1515,8 +1899,30 @@ class Predictor(BasePredictor):
                 colormap: str = Input(description="Тип паттерна colormap", default="random"),
                 granule_size: str = Input(description="Размер гранул", default="medium"),
                 use_controlnet: bool = Input(description="Включить ControlNet", default=False),
-                control_image: Optional[Path] = Input(description="Контрольное изображение (опц.)", default=None)) -> Iterator[Path]:
-        """Генерация изображения резиновой плитки с использованием НАШЕЙ обученной модели."""
+                control_image: Optional[Path] = Input(description="Контрольное изображение (опц.)", default=None),
+                colormap_seed: int = Input(description="Seed colormap: один рецепт и seed дают одну карту (кэшируется); -1 — seed запроса", default=-1),
+                colormap_cache: bool = Input(description="Брать colormap из кэша; False — новая случайная карта", default=True),
+                num_outputs: int = Input(description=f"Число вариантов за один вызов (seed, seed+1, ...), до {MAX_OUTPUTS}", default=1),
+                seeds: str = Input(description="Seeds вариантов через запятую (перекрывает seed и num_outputs)", default=""),
+                preview_every_n_steps: int = Input(description="Латентное превью (JPEG) каждые N шагов во время генерации (идут первыми в списке выходов); 0 — выключено", default=LATENT_PREVIEW_STEPS),
+                output_format: str = Input(description="Формат финальных изображений: png или webp (без потерь)", choices=["png", "webp"], default=OUTPUT_FORMAT),
+                preview_format: str = Input(description="Формат превью 512×512", choices=list(OUTPUT_FORMATS), default=PREVIEW_FORMAT),
+                png_compress_level: int = Input(description="Уровень сжатия PNG (0–9; 1 — быстро)", ge=0, le=9, default=OUTPUT_PNG_COMPRESS_LEVEL),
+                color_conditioning: str = Input(description="Управление цветом: controlnet или latent_init (img2img от colormap без ControlNet — дешевле)", choices=["controlnet", "latent_init"], default=COLOR_CONDITIONING),
+                color_strength: float = Input(description="Сила img2img для latent_init: доля шагов от colormap (меньше — ближе к colormap)", ge=0.1, le=1.0, default=LATENT_INIT_STRENGTH),
+                guidance_schedule: str = Input(description="Расписание CFG: full, auto (пресет по числу цветов), cutoff:<доля шагов>, delta:<порог разницы ветвей> или cutoff:0.6,delta:0.05", default=GUIDANCE_SCHEDULE)) -> Iterator[Path]:
+        """Генерация изображения резиновой плитки с использованием НАШЕЙ обученной модели.
+        Латентные превью шагов отдаются по мере денойзинга, затем final, preview, colormap и легенда
+        по мере кодирования в пуле."""
+        
+        # Счетчик запросов в обработке: планировщик ждет окно батча, только если их больше одного
+        with self._inflight_lock:
+            self._inflight_requests += 1
+        memory_ticket = self.memory_governor.begin_request()
+        # Все выходные файлы запроса — в его собственном каталоге
+        workspace = self.workspaces.create()
+        # Профиль стадий запроса: generation_data.json и лог-строка STAGE_TIMINGS
+        profiler = self._create_stage_profiler()
         
         try:
             # 🚀 STARTUP_SNAPSHOT_START - Гарантированное сохранение логов стартапа
@@ -1536,6 +1942,10 @@ class Predictor(BasePredictor):
             logger.info(f"🎚️ Guidance: {guidance_scale} (базовый)")
             logger.info(f"🎨 Colormap: {colormap}")
             logger.info(f"🔧 Granule Size: {granule_size}")
+            logger.info(f"🎲 Colormap Seed: {colormap_seed} (кэш: {colormap_cache})")
+            logger.info(f"🖼️ Вариантов: {num_outputs} (seeds: {seeds or '-'})")
+            logger.info(f"🎛️ Color Conditioning: {color_conditioning} (strength: {color_strength})")
+            logger.info(f"✂️ Guidance Schedule: {guidance_schedule}")
             logger.info(f"🎨 Адаптивные параметры будут рассчитаны на основе количества цветов")
             logger.info("🚀 STARTUP_SNAPSHOT_END")
             
@@ -1547,7 +1957,6 @@ class Predictor(BasePredictor):
             # ИСПРАВЛЕНИЕ: Обработка входного промпта (удаление JSON-обертки)
             if isinstance(prompt, str) and prompt.strip().startswith('{'):
                 try:
-                    import json
                     prompt_data = json.loads(prompt)
                     if isinstance(prompt_data, dict) and "prompt" in prompt_data:
                         prompt = prompt_data["prompt"]
@@ -1567,6 +1976,21 @@ class Predictor(BasePredictor):
                 seed = random.randint(0, 999999999)
                 logger.info(f"🎲 Установлен случайный сид: {seed}")
             
+            # Seeds вариантов: один батч UNet, общий colormap и эмбеддинги промпта
+            variant_seeds = self._resolve_seeds(seed, num_outputs, seeds)
+            seed = variant_seeds[0]
+            logger.info(f"🎲 Seeds вариантов: {variant_seeds}")
+            
+            # Seed colormap: по умолчанию seed запроса; None — свежая случайная карта без кэша
+            colormap_seed_value = (seed if colormap_seed == -1 else colormap_seed) if colormap_cache else None
+            
+            # Colormap запроса строится один раз в пуле CPU-работ параллельно с подготовкой pipeline;
+            # на критическом пути только ожидание хинта ControlNet
+            colormap_future = self.cpu_pool.submit(
+                self._build_colormap_artifact, prompt, colormap, granule_size, colormap_seed_value, colormap_cache,
+                profiler=profiler
+            )
+            
             torch.manual_seed(seed)
             if torch.cuda.is_available():
                 torch.cuda.manual_seed(seed)
@@ -1591,52 +2015,96 @@ class Predictor(BasePredictor):
             # Подсчитываем количество цветов в промпте через ColorManager
             color_count = self.color_manager.get_color_count(prompt)
             logger.info(f"🎨 Обнаружено цветов в промпте: {color_count}")
+            profiler.lap("prompt_parsing", gpu=False)
             
             # Адаптивные настройки на основе количества цветов (как в v45)
             if color_count == 1:
                 # Один цвет - простой промпт, как в успешном тесте 4
                 adaptive_steps = max(20, num_inference_steps)
                 adaptive_guidance = max(7.0, guidance_scale)
-                logger.info("🎯 Адаптивные параметры для 1 цвета: steps=20, guidance=7.0")
+                adaptive_cfg_cutoff = 0.5
+                logger.info("🎯 Адаптивные параметры для 1 цвета: steps=20, guidance=7.0, cfg_cutoff=0.5")
             elif color_count == 2:
                 # Два цвета - средняя сложность
                 adaptive_steps = max(25, num_inference_steps)
                 adaptive_guidance = max(7.5, guidance_scale)
-                logger.info("🎯 Адаптивные параметры для 2 цветов: steps=25, guidance=7.5")
+                adaptive_cfg_cutoff = 0.6
+                logger.info("🎯 Адаптивные параметры для 2 цветов: steps=25, guidance=7.5, cfg_cutoff=0.6")
             elif color_count == 3:
                 # Три цвета - высокая сложность
                 adaptive_steps = max(30, num_inference_steps)
                 adaptive_guidance = max(8.0, guidance_scale)
-                logger.info("🎯 Адаптивные параметры для 3 цветов: steps=30, guidance=8.0")
+                adaptive_cfg_cutoff = 0.7
+                logger.info("🎯 Адаптивные параметры для 3 цветов: steps=30, guidance=8.0, cfg_cutoff=0.7")
             else:
                 # 4+ цвета - максимальная сложность
                 adaptive_steps = max(35, num_inference_steps)
                 adaptive_guidance = max(8.5, guidance_scale)
-                logger.info("🎯 Адаптивные параметры для 4+ цветов: steps=35, guidance=8.5")
+                adaptive_cfg_cutoff = 0.8
+                logger.info("🎯 Адаптивные параметры для 4+ цветов: steps=35, guidance=8.5, cfg_cutoff=0.8")
+            
+            # Расписание CFG: auto — пресет адаптивной таблицы (больше цветов — дольше полный CFG)
+            if guidance_schedule.strip().lower() == "auto":
+                cfg_schedule = GuidanceSchedule(cutoff_fraction=adaptive_cfg_cutoff)
+            else:
+                cfg_schedule = parse_guidance_schedule(guidance_schedule)
+            guidance_report: Dict[str, Any] = {}
+            logger.info(f"✂️ Расписание CFG: {cfg_schedule}")
             
             # Генерация изображения с адаптивными параметрами
             logger.info("🚀 Запуск pipeline для генерации с адаптивными параметрами...")
             pipe_to_use = self.pipe
             pipe_kwargs = dict(
-                prompt=strengthened_prompt,  # Используем усиленный промпт
-                negative_prompt=negative_prompt,
+                # Усиленный промпт передается готовыми эмбеддингами из кэша (или строками при ошибке)
+                **self._prompt_embedding_kwargs(strengthened_prompt, negative_prompt, float(adaptive_guidance), profiler),
                 num_inference_steps=max(5, int(adaptive_steps)),
                 guidance_scale=float(adaptive_guidance),
                 width=1024,
                 height=1024,
-                generator=torch.Generator(device=self.device).manual_seed(seed),
+                # Генераторы по одному на сэмпл задает _generate_batched
                 # LoRA уже интегрирован через fuse_lora, scale не нужен
                 # cross_attention_kwargs={"scale": float(max(0.0, min(1.0, lora_scale)))}
+                # Профиль запроса: шаги денойзинга, VAE decode и PIL-конвертация замеряются в батче
+                stage_profiler=profiler,
+                # Расписание CFG и отчет о шаге отключения безусловной ветки
+                guidance_schedule=cfg_schedule,
+                guidance_report=guidance_report
             )
 
-            # ИСПРАВЛЕНИЕ: Убран неиспользуемый callback, который вызывал дублирование генерации
-            # Превью создается из финального изображения после генерации
+            # Латентные превью: callback каждые N шагов переводит латенты в маленький JPEG
+            # (линейная проекция или TAESD) без полного VAE и дополнительных проходов UNet
+            latent_previewer = None
+            if preview_every_n_steps > 0:
+                latent_previewer = latent_preview.LatentPreviewer(
+                    preview_every_n_steps, workspace.path,
+                    decode=self._latent_preview_decode(), max_size=LATENT_PREVIEW_SIZE
+                )
+                pipe_kwargs["latent_previewer"] = latent_previewer
 
+            # LATENT_INIT: денойзинг стартует от VAE-латентов colormap (img2img), ControlNet не нужен
+            latent_init = color_conditioning == "latent_init" and self.img2img_pipe is not None
+            if color_conditioning == "latent_init" and not latent_init:
+                logger.warning("⚠️ Img2img pipeline не загружен, latent_init заменен ControlNet")
+            if latent_init:
+                # Colormap нужен до запуска pipeline: он же init-изображение
+                with profile_stage([profiler], "colormap_wait", gpu=False):
+                    colormap_artifact = self._wait_colormap_artifact(colormap_future)
+                if control_image is not None:
+                    logger.warning("⚠️ control_image используется только с ControlNet, latent_init стартует от colormap")
+                pipe_to_use = self.img2img_pipe
+                # Размер задает init-изображение; colormap кодируется VAE один раз на запрос внутри pipeline
+                pipe_kwargs.pop("width", None)
+                pipe_kwargs.pop("height", None)
+                pipe_kwargs["image"] = colormap_artifact.label_map.rgb()
+                pipe_kwargs["strength"] = float(color_strength)
+                logger.info(f"✅ Latent init: img2img от colormap, strength={color_strength} "
+                            f"({self._denoising_steps(pipe_kwargs)} из {pipe_kwargs['num_inference_steps']} шагов)")
+            
             # МУЛЬТИМОДАЛЬНЫЙ CONTROLNET: Адаптивный выбор на основе сложности
             auto_controlnet = False
             selected_controlnets = None
             
-            if not use_controlnet:
+            if not use_controlnet and not latent_init:
                 # Используем уже подсчитанное количество цветов
                 if color_count >= 2:
                     auto_controlnet = True
@@ -1645,110 +2113,85 @@ class Predictor(BasePredictor):
                     logger.info(f"🎯 Автоматически включаем мультимодальный ControlNet для {color_count} цветов: {selected_controlnets}")
             
             # Обновляем общую статистику
-            self.color_grid_stats["total_generations"] += 1
-            if use_controlnet or auto_controlnet:
-                self.color_grid_stats["controlnet_used"] += 1
+            use_controlnet = use_controlnet and not latent_init
+            with self._stats_lock:
+                self.color_grid_stats["total_generations"] += 1
+                if use_controlnet or auto_controlnet:
+                    self.color_grid_stats["controlnet_used"] += 1
+                if latent_init:
+                    self.color_grid_stats["latent_init_used"] += 1
             
             # МУЛЬТИМОДАЛЬНЫЙ CONTROLNET: Инициализация и применение
-            if (use_controlnet or auto_controlnet) and ControlNetModel is not None and StableDiffusionXLControlNetPipeline is not None:
+            if (use_controlnet or auto_controlnet) and self.controlnet_pool is not None:
                 try:
-                    if self.controlnet is None:
-                        logger.info("🔗 Загрузка ControlNet для SDXL...")
-                        self.controlnet = ControlNetModel.from_pretrained(
-                            "thibaud/controlnet-openpose-sdxl-1.0", torch_dtype=torch.float16
-                        )
-                    if self.pipe_cn is None:
-                        self.pipe_cn = StableDiffusionXLControlNetPipeline(
-                            vae=self.pipe.vae,
-                            text_encoder=self.pipe.text_encoder,
-                            text_encoder_2=self.pipe.text_encoder_2,
-                            tokenizer=self.pipe.tokenizer,
-                            tokenizer_2=self.pipe.tokenizer_2,
-                            unet=self.pipe.unet,
-                            controlnet=self.controlnet,
-                            scheduler=self.pipe.scheduler
-                        ).to(self.device)
-                    pipe_to_use = self.pipe_cn
+                    # Pipeline из пула ControlNet (предзагружен в setup; при фоновой загрузке ждем готовности)
+                    if not self.controlnet_pool.is_ready(self._default_controlnet_names()):
+                        logger.warning(f"⚠️ Пул ControlNet еще не готов: {self.controlnet_pool.status()['models']}")
+                    pipe_cn = self.controlnet_pool.pipeline(self._default_controlnet_names())
+                    if pipe_cn is None:
+                        raise RuntimeError(f"ControlNet не загружен: {self.controlnet_pool.status()['errors']}")
+                    pipe_to_use = pipe_cn
                     
                     # МУЛЬТИМОДАЛЬНЫЙ CONTROLNET: Подготовка множественных контрольных карт
                     try:
+                        # Хинт нужен до запуска pipeline: ждем colormap запроса
+                        with profile_stage([profiler], "colormap_wait", gpu=False):
+                            colormap_artifact = self._wait_colormap_artifact(colormap_future)
+                        
                         if control_image is not None:
                             # Если пользователь предоставил контрольное изображение
                             user_hint = Image.open(control_image)
                             user_hint = self._rgba_gray_hint(user_hint).resize((1024, 1024), Image.Resampling.LANCZOS)
                             logger.info("✅ ControlNet использует пользовательское контрольное изображение")
-                            
-                            # Создаем дополнительные контрольные карты для мультимодальности
-                            control_images = [user_hint]
-                            if selected_controlnets and len(selected_controlnets) > 1:
-                                # Добавляем автоматически созданные карты для дополнительных ControlNet
-                                for i in range(1, len(selected_controlnets)):
-                                    add_result = self._create_optimized_colormap(prompt, size=(1024, 1024), pattern_type=colormap, granule_size=granule_size)
-                                    if isinstance(add_result, tuple):
-                                        additional_hint = add_result[1]
-                                    else:
-                                        additional_hint = self._rgba_gray_hint(add_result)
-                                    control_images.append(additional_hint)
+                            # Дополнительные ControlNet получат карты из хинта colormap запроса
+                            primary_hint = user_hint
                         else:
                             # Автоматически создаем множественные контрольные карты для мультимодального ControlNet
                             logger.info("🎨 Создание множественных контрольных карт для мультимодального ControlNet")
-                            control_images = []
-                            
-                            # Основная цветовая карта
-                            result_colormap = self._create_optimized_colormap(prompt, size=(1024, 1024), pattern_type=colormap, granule_size=granule_size)
-                            if isinstance(result_colormap, tuple):
-                                color_control_image, prepared_hint = result_colormap
-                            else:
-                                color_control_image, prepared_hint = result_colormap, None
-                            
-                            # Валидация colormap против промпта
-                            if not self._validate_colormap_against_prompt(color_control_image, prompt):
-                                logger.warning("⚠️ Colormap не соответствует промпту, пересоздаем...")
-                                color_control_image = self._force_rebuild_colormap(prompt, size=(1024, 1024))
                             
+                            # Основная цветовая карта — colormap запроса (уже провалидирован против промпта)
                             # Валидация ControlNet карты перед передачей в ControlNet
-                            if not self._validate_controlnet_map(color_control_image, prompt):
+                            with profile_stage([profiler], "validation", gpu=False):
+                                valid = self._validate_controlnet_map(colormap_artifact.label_map, prompt, colormap_artifact)
+                            if not valid:
                                 logger.warning("⚠️ ControlNet карта не прошла валидацию, пересоздаем...")
-                                color_control_image = self._force_rebuild_colormap(prompt, size=(1024, 1024))
+                                with profile_stage([profiler], "colormap", gpu=False):
+                                    self._rebuild_colormap_artifact(colormap_artifact, prompt)
                                 
                                 # Повторная валидация после пересоздания
-                                if not self._validate_controlnet_map(color_control_image, prompt):
+                                with profile_stage([profiler], "validation", gpu=False):
+                                    valid = self._validate_controlnet_map(colormap_artifact.label_map, prompt, colormap_artifact)
+                                if not valid:
                                     logger.error("❌ Критическая ошибка: ControlNet карта не может быть создана корректно")
                                     # Прерываем генерацию с ошибкой
                                     raise ControlNetValidationError("ControlNet карта не прошла валидацию после пересоздания")
                             
-                            # Используем готовый L-хинт, если он создан, иначе преобразуем
-                            main_hint = prepared_hint if prepared_hint is not None else self._rgba_gray_hint(color_control_image)
-                            control_images.append(main_hint)
-                            
-                            # Создаем дополнительные контрольные карты для мультимодальности
-                            if selected_controlnets and len(selected_controlnets) > 1:
-                                for i in range(1, len(selected_controlnets)):
-                                    additional_hint = self._create_optimized_colormap(prompt, size=(1024, 1024), pattern_type=colormap, granule_size=granule_size)
-                                    # Если генератор вернул пару (rgba, l), используем l, иначе преобразуем
-                                    if isinstance(additional_hint, tuple):
-                                        additional_hint = additional_hint[1]
-                                    else:
-                                        additional_hint = self._rgba_gray_hint(additional_hint)
-                                    control_images.append(additional_hint)
+                            # Основной ControlNet получает L-хинт colormap запроса
+                            primary_hint = colormap_artifact.hint
+                        
+                        # У каждого ControlNet своя карта: дополнительные выводятся из хинта colormap
+                        with profile_stage([profiler], "control_maps", gpu=False):
+                            controlnets, control_images = self._control_images_per_net(
+                                selected_controlnets, primary_hint, colormap_artifact.hint, prompt
+                            )
                         
                         # Применяем мультимодальный ControlNet
-                        if selected_controlnets and len(control_images) > 1:
-                            multi_controlnet_kwargs = self.apply_multi_controlnet(prompt, selected_controlnets, control_images)
-                            if multi_controlnet_kwargs:
-                                pipe_kwargs.update(multi_controlnet_kwargs)
-                                logger.info(f"✅ Мультимодальный ControlNet активирован с {len(control_images)} контрольными картами")
-                            else:
-                                # Fallback к основной карте
-                                pipe_kwargs["image"] = control_images[0]
-                                pipe_kwargs["controlnet_conditioning_scale"] = 1.0  # Усиленное влияние ControlNet
-                                logger.info("✅ ControlNet активирован с основной контрольной картой (fallback, усиленное влияние)")
+                        multi_controlnet = None
+                        if len(controlnets) > 1:
+                            multi_controlnet = self.apply_multi_controlnet(prompt, controlnets, control_images)
+                        if multi_controlnet:
+                            pipe_to_use, multi_controlnet_kwargs = multi_controlnet
+                            pipe_kwargs.update(multi_controlnet_kwargs)
+                            logger.info(f"✅ Мультимодальный ControlNet активирован с {len(control_images)} контрольными картами")
                         else:
-                            # Обычный режим с одной картой
-                            pipe_kwargs["image"] = control_images[0]
-                            pipe_kwargs["controlnet_conditioning_scale"] = 1.0  # Усиленное влияние ControlNet
-                            logger.info("✅ ControlNet активирован с контрольной картой (усиленное влияние)")
+                            # Одна модель (основная из пула): вес и окно шагов из CONTROLNET_SETTINGS, как у мульти-набора
+                            default_names = self._default_controlnet_names()
+                            pipe_kwargs.update(build_multi_controlnet_kwargs(default_names, control_images[:1]))
+                            logger.info(f"✅ ControlNet {default_names} активирован с основной контрольной картой: "
+                                        f"активно {active_controlnet_fraction(default_names) * 100:.0f}% ControlNet-шагов")
                         
+                    except (ColormapGenerationError, ControlNetValidationError):
+                        raise
                     except Exception as e:
                         logger.warning(f"⚠️ Ошибка подготовки мультимодального ControlNet: {e}")
                         # Fallback: простая контрольная карта
@@ -1756,97 +2199,98 @@ class Predictor(BasePredictor):
                         pipe_kwargs["image"] = hint
                         pipe_kwargs["controlnet_conditioning_scale"] = 0.8  # Умеренное влияние для fallback
                         logger.info("✅ ControlNet активирован с fallback картой (умеренное влияние)")
+                except (ColormapGenerationError, ControlNetValidationError):
+                    raise
                 except Exception as e:
                     logger.warning(f"⚠️ ControlNet недоступен: {e}")
 
-            # Единый проход: генерируем только финальное изображение
-            logger.info("🚀 Финальный сегмент: единый проход без callback")
-            result = pipe_to_use(
-                **{**pipe_kwargs, "output_type": "pil"}
-            )
-            logger.info("✅ Финальная генерация завершена")
+            # Выходы кодируются в пуле; colormap и легенда сохраняются, пока идет денойзинг.
+            # Запись ставится в пул только после построения colormap: задача, ждущая colormap внутри
+            # пула, заняла бы воркер, нужный самому построению (при параллельных запросах — взаимная блокировка)
+            writer = OutputWriter(self.cpu_pool, profiler, png_compress_level, OUTPUT_JPEG_QUALITY, OUTPUT_WEBP_METHOD)
+            for kind in ("colormap", "legend"):
+                writer.submit_after(GROUP_COLORMAP, colormap_future, self._write_colormap_output, writer, workspace.file(kind), kind)
+
+            # Единый проход: генерируем только финальные изображения (все варианты батчами)
+            logger.info("🚀 Финальный сегмент: единый проход (callback только для латентных превью)")
+            # Режим кондиционирования для сравнения latent_init и ControlNet по числу цветов
+            conditioning_mode = "latent_init" if latent_init else ("controlnet" if pipe_to_use is not self.pipe else "none")
+            generation_start = time.perf_counter()
+            generation_future = self._submit_generation(pipe_to_use, pipe_kwargs, variant_seeds)
+            if latent_previewer is not None:
+                for preview_path in latent_previewer.stream(generation_future):
+                    logger.info(f"🟡 LATENT_PREVIEW_READY {preview_path}")
+                    yield Path(preview_path)
+                logger.info(f"📊 Латентные превью: {latent_previewer.stats}")
+            generated = generation_future.result()
+            generation_seconds = time.perf_counter() - generation_start
+            final_images = [final for final, _ in generated]
+            logger.info(f"✅ Финальная генерация завершена за {generation_seconds:.2f}s ({conditioning_mode})")
             
             # Сохранение результатов
-            final_image = result.images[0]
+            final_image = final_images[0]
             logger.info(f"📊 Размер сгенерированного изображения: {final_image.size}")
             
-            # ИСПРАВЛЕНИЕ: Создаем превью из финального изображения
-            preview_path = "/tmp/preview.png"
-            preview_image = final_image.resize((512, 512), Image.Resampling.LANCZOS)
-            preview_image.save(preview_path)
-            logger.info(f"🟡 PREVIEW_READY {preview_path}")
-            
-            # Сохранение файлов
-            final_path = "/tmp/final.png"
-            
-            final_image.save(final_path)
-            logger.info(f"✅ FINAL_READY {final_path}")
-            
-            # Создание оптимизированного colormap с помощью Color Grid Adapter
-            colormap_path = "/tmp/colormap.png"
-            try:
-                # Используем наш оптимизированный Color Grid Adapter
-                result_colormap = self._create_optimized_colormap(prompt, size=(1024, 1024), pattern_type=colormap, granule_size=granule_size)
-                if isinstance(result_colormap, tuple):
-                    colormap_image, _prepared_hint = result_colormap
-                else:
-                    colormap_image = result_colormap
-                
-                # Валидация colormap против промпта
-                if not self._validate_colormap_against_prompt(colormap_image, prompt):
-                    logger.warning("⚠️ Colormap не соответствует промпту, пересоздаем...")
-                    colormap_image = self._force_rebuild_colormap(prompt, size=(1024, 1024))
-                
-                # Сохраняем в высоком разрешении для лучшего качества
-                colormap_image.save(colormap_path)
-                logger.info(f"🎨 ОПТИМИЗИРОВАННЫЙ COLORMAP_READY {colormap_path}")
-                logger.info(f"📊 Размер colormap: {colormap_image.size}")
-                
-                # Дополнительно сохраняем в маленьком размере для легенды
-                legend_path = "/tmp/legend.png"
-                legend_image = colormap_image.resize((256, 256), Image.Resampling.LANCZOS)
-                legend_image.save(legend_path)
-                logger.info(f"📋 ЛЕГЕНДА_READY {legend_path}")
-                
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось построить оптимизированный colormap: {e}")
-                # Fallback: простой colormap
-                try:
-                    parsed_colors = self._parse_percent_colors(prompt)
-                    if not parsed_colors:
-                        parsed_colors = [{"name": "white", "proportion": 1.0}]
-                    colormap_image = self._render_legend(parsed_colors, size=256)
-                    colormap_image.save(colormap_path)
-                    logger.info(f"🎨 FALLBACK COLORMAP_READY {colormap_path}")
-                except Exception as e2:
-                    logger.error(f"❌ Критическая ошибка создания colormap: {e2}")
-                    Image.new('RGBA', (256, 256), color=(255, 255, 255, 255)).save(colormap_path)
-            
-            # Очистка памяти
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            gc.collect()
-            logger.info("🧹 Память очищена")
+            # Финальные изображения и превью кодируются в пуле параллельно
+            for index, (image, preview_image) in enumerate(generated):
+                suffix = "" if len(generated) == 1 else f"_{index}"
+                writer.submit(GROUP_FINAL, self._write_final, image, writer, workspace.file(f"final{suffix}"), output_format)
+                writer.submit(GROUP_PREVIEW, self._save_preview, image, preview_image, writer,
+                              workspace.file(f"preview{suffix}"), preview_format)
+            # Цветовая точность первого варианта против цветов промпта (после задач кодирования)
+            fidelity_future = self.cpu_pool.submit(self._measure_color_fidelity, final_image, prompt)
+            
+            # Colormap запроса (того же, что управлял генерацией): ошибка построения прерывает запрос до выдачи файлов
+            colormap_artifact = self._wait_colormap_artifact(colormap_future)
+            
+            # Файлы отдаются по мере кодирования: final (по каждому варианту), preview, colormap, legend
+            for output_path in writer.paths():
+                yield Path(output_path)
+            logger.info(f"📊 Кодирование выходов: {writer.stats}")
+            
+            color_fidelity = fidelity_future.result()
+            self._record_quality("conditioning", conditioning_mode, color_count, generation_seconds, color_fidelity["fidelity"])
+            self._record_quality("guidance", str(cfg_schedule), color_count, generation_seconds, color_fidelity["fidelity"])
+            logger.info(f"🎯 Цветовая точность ({conditioning_mode}, {color_count} цв.): {color_fidelity['fidelity']}, "
+                        f"ошибка цвета {color_fidelity['mean_color_error']}")
+            
+            # Память: пики запроса; кэш аллокатора освобождается только при нехватке запаса
+            memory_metrics = self.memory_governor.end_request(profiler.peaks(), memory_ticket)
+            logger.info(f"📊 Память GPU запроса: {memory_metrics}")
             
             # Сохранение полного JSON-ответа с деталями генерации
+            timings = profiler.to_dict()
+            logger.info(f"STAGE_TIMINGS {json.dumps(timings, ensure_ascii=False)}")
             try:
-                import json
                 generation_data = {
                     "model_version": MODEL_VERSION,
                     "input_prompt": prompt,
                     "full_prompt": full_prompt,
                     "negative_prompt": negative_prompt,
                     "seed": seed,
+                    "seeds": variant_seeds,
                     "num_inference_steps": num_inference_steps,
                     "guidance_scale": guidance_scale,
                     "colormap": colormap,
                     "granule_size": granule_size,
                     "device": self.device,
                     "image_size": final_image.size,
-                    "generation_time": time.time() if 'time' in globals() else None,
-                    "parsed_colors": parsed_colors if 'parsed_colors' in locals() else []
+                    "generation_time": round(timings["total_ms"] / 1000, 3),
+                    "finished_at": time.time(),
+                    "parsed_colors": colormap_artifact.colors,
+                    "colormap_artifact": colormap_artifact.to_dict(),
+                    "color_conditioning": {
+                        "mode": conditioning_mode,
+                        "strength": float(color_strength) if latent_init else None,
+                        "color_count": color_count,
+                        "generation_seconds": round(generation_seconds, 3)
+                    },
+                    "color_fidelity": color_fidelity,
+                    "guidance": {**cfg_schedule.to_dict(), **guidance_report},
+                    "memory": memory_metrics,
+                    "timings": timings
                 }
-                json_path = "/tmp/generation_data.json"
+                json_path = workspace.file("generation_data.json")
                 with open(json_path, "w", encoding="utf-8") as f:
                     json.dump(generation_data, f, ensure_ascii=False, indent=2)
                 logger.info(f"📄 JSON_READY {json_path}")
@@ -1860,21 +2304,24 @@ class Predictor(BasePredictor):
             logger.info(f"📊 Color Grid Adapter статистика:")
             logger.info(f"   - Всего генераций: {stats['total_generations']}")
             logger.info(f"   - ControlNet использован: {stats['controlnet_used']} ({stats['controlnet_usage_percent']}%)")
+            logger.info(f"   - Latent init использован: {stats['latent_init_used']}")
+            logger.info(f"   - Кондиционирование по числу цветов: {stats['conditioning']}")
+            logger.info(f"   - Расписания CFG по числу цветов: {stats['guidance']}")
             logger.info(f"   - Популярный паттерн: {stats['most_used_pattern']}")
             logger.info(f"   - Популярный размер гранул: {stats['most_used_granule_size']}")
-            
-            # Возвращаем файлы в правильном порядке: preview, final, colormap, legend
-            yield Path(preview_path)
-            yield Path(final_path)
-            yield Path(colormap_path)
-            yield Path(legend_path)
+            logger.info(f"   - Кэш colormap: {stats['colormap_cache']}")
+            logger.info(f"   - Кэш эмбеддингов промптов: {stats['prompt_embedding_cache']}")
+            logger.info(f"   - Микро-батчи: {stats['batch_scheduler']}")
+            logger.info(f"   - Пул ControlNet: {stats['controlnet_pool']}")
+            logger.info(f"   - Память GPU: {stats['memory_governor']}")
+            logger.info(f"   - Каталоги запросов: {stats['workspaces']}")
             
         except (ColormapGenerationError, ControlNetValidationError) as e:
             logger.error(f"🚨 КРИТИЧЕСКАЯ ОШИБКА: {e}")
             logger.error(f"📊 Тип ошибки: {type(e).__name__}")
             logger.error("🛑 Генерация прервана для предотвращения некорректных результатов")
             # Возвращаем информативное сообщение об ошибке
-            error_path = "/tmp/error_message.txt"
+            error_path = workspace.file("error_message.txt")
             with open(error_path, "w", encoding="utf-8") as f:
                 f.write(f"Критическая ошибка генерации: {e}\n")
                 f.write(f"Тип ошибки: {type(e).__name__}\n")
@@ -1888,6 +2335,12 @@ class Predictor(BasePredictor):
             logger.error(f"📊 Тип ошибки: {type(e).__name__}")
             logger.error(f"📊 Детали ошибки: {str(e)}")
             raise e
+        finally:
+            with self._inflight_lock:
+                self._inflight_requests -= 1
+            self.memory_governor.finish_request(memory_ticket)
+            # Все выходы отданы (или запрос прерван): каталог запроса освобождается
+            self.workspaces.release(workspace)
 
     def select_optimal_controlnet(self, color_count):
         """Выбирает оптимальную комбинацию ControlNet на основе сложности промпта"""
@@ -1900,56 +2353,46 @@ class Predictor(BasePredictor):
         else:  # 4+ цветов
             return ["t2i_color", "color_grid", "shuffle"]  # Полный контроль
 
+    def _control_images_per_net(self, controlnets, primary_hint, base_hint, prompt):
+        """Пары (ControlNet, своя карта): первый получает primary_hint, остальные — карту своего типа
+        из base_hint (MultimodalControlNet). ControlNet, для которого своя карта не получилась
+        (совпала бы с уже выданной), отбрасывается: N копий одной карты только умножают forward."""
+        names = list(controlnets or [])[:1]
+        images = [primary_hint]
+        for controlnet_type in list(controlnets or [])[1:]:
+            image = self.multimodal_controlnet.create_control_image(controlnet_type, base_hint, prompt)
+            if image is base_hint or image is primary_hint:
+                logger.warning(f"⚠️ Для ControlNet '{controlnet_type}' нет отдельной карты, пропускаем")
+                continue
+            names.append(controlnet_type)
+            images.append(image)
+        return names, images
+
     def apply_multi_controlnet(self, prompt, controlnets, control_images):
-        """Применяет несколько ControlNet последовательно для максимальной точности"""
-        if not controlnets or not control_images:
+        """Настоящий multi-ControlNet: модели из пула в одном проходе, у каждой своя карта, вес и окно шагов.
+        Возвращает (pipeline, параметры) или None, если в пуле нет ни одной из выбранных моделей."""
+        if not controlnets or not control_images or self.controlnet_pool is None:
             return None
         
         try:
-            # Создаем комбинированную контрольную карту
-            combined_hint = self._create_combined_control_hint(control_images)
-            
-            # Применяем каждый ControlNet с соответствующими весами
-            pipe_kwargs = {}
+            # Карта i относится к ControlNet i; недостающие карты — основная карта
+            selected = []
+            images = []
             for i, controlnet_type in enumerate(controlnets):
-                if controlnet_type == "t2i_color":
-                    pipe_kwargs["image"] = control_images[i] if i < len(control_images) else combined_hint
-                    pipe_kwargs["controlnet_conditioning_scale"] = 1.0  # Усилено с 0.8 до 1.0
-                elif controlnet_type == "color_grid":
-                    pipe_kwargs["image"] = control_images[i] if i < len(control_images) else combined_hint
-                    pipe_kwargs["controlnet_conditioning_scale"] = 1.1  # Усилено с 0.9 до 1.1
-                elif controlnet_type == "shuffle":
-                    pipe_kwargs["image"] = control_images[i] if i < len(control_images) else combined_hint
-                    pipe_kwargs["controlnet_conditioning_scale"] = 0.9  # Усилено с 0.7 до 0.9
+                if controlnet_type not in self.controlnet_pool.specs:
+                    logger.warning(f"⚠️ ControlNet '{controlnet_type}' не задан в CONTROLNET_MODELS, пропускаем")
+                    continue
+                selected.append(controlnet_type)
+                images.append(control_images[i] if i < len(control_images) else control_images[0])
+            if not selected:
+                return None
             
-            return pipe_kwargs
+            pipe = self.controlnet_pool.pipeline(selected)
+            if pipe is None:
+                return None
+            pipe_kwargs = build_multi_controlnet_kwargs(selected, images)
+            logger.info(f"🎛️ Multi-ControlNet {selected}: активно {active_controlnet_fraction(selected) * 100:.0f}% ControlNet-шагов")
+            return pipe, pipe_kwargs
         except Exception as e:
             logger.warning(f"⚠️ Ошибка применения мульти ControlNet: {e}")
             return None
-
-    def _create_combined_control_hint(self, control_images):
-        """Создает комбинированную контрольную карту из нескольких источников"""
-        try:
-            if not control_images:
-                return None
-            
-            # Берем первое изображение как основу
-            base_image = control_images[0]
-            if len(control_images) == 1:
-                return base_image
-            
-            # Комбинируем несколько контрольных карт
-            combined = Image.new('L', base_image.size, 0)
-            for i, img in enumerate(control_images):
-                if img is not None:
-                    # Нормализуем и добавляем с весами
-                    weight = 1.0 / len(control_images)
-                    img_array = np.array(img.convert('L')).astype(np.float32) * weight
-                    combined_array = np.array(combined).astype(np.float32)
-                    combined_array += img_array
-                    combined = Image.fromarray(np.clip(combined_array, 0, 255).astype(np.uint8))
-            
-            return combined
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка создания комбинированной контрольной карты: {e}")
-            return control_images[0] if control_images else None
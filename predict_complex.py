@@ -22,9 +22,12 @@ from diffusers import (
     EulerDiscreteScheduler,
 )
 
+import colormap_engine
+from controlnet_pool import ControlNetPool
+from memory_governor import create_cuda_memory_governor
+
 # 🚀 ОПТИМИЗИРОВАННОЕ подавление предупреждений - v4.3.7
 import warnings
-import gc  # Для принудительной сборки мусора
 
 # Основные категории предупреждений
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -252,6 +255,9 @@ def manage_gpu_memory(device_info: Dict[str, Any], operation: str = "check") ->
     except Exception as e:
         logger.warning(f"GPU memory management error: {e}")
 
+# Free GPU memory to keep: the allocator cache is released only when less than this is left
+MEMORY_HEADROOM_MB = int(os.environ.get("MEMORY_HEADROOM_MB", "2048"))
+
 # Absolute cache paths inside the container
 # Fixed paths for proper model loading in cog runtime
 WEIGHTS_ROOT = "/src/model_files"
@@ -309,28 +315,15 @@ def sample_color_for_name(color_name: str) -> Tuple[int, int, int]:
     return named.get(color_name.lower(), (127, 127, 127))
 
 
-def build_color_map(colors: List[Dict[str, Any]], size: Tuple[int, int], out_path: str) -> Image.Image:
-    width, height = size
-    canvas = Image.new("RGB", (width, height))
-    draw = Image.new("RGB", (width, height))
-    # Normalize proportions
+def build_color_map(colors: List[Dict[str, Any]], size: Tuple[int, int], out_path: str) -> colormap_engine.LabelMap:
+    """Vertical color stripes as a palette label map (one byte per pixel), saved as an indexed PNG."""
+    # Normalized inside allocate_quotas; stripe widths cover the canvas exactly
     props = [max(0.0, float(c.get("proportion", 0))) for c in colors]
-    total = sum(props) or 1.0
-    props = [p / total for p in props]
-
-    x0 = 0
-    for c, p in zip(colors, props):
-        w = int(round(p * width))
-        if w <= 0:
-            continue
-        color = sample_color_for_name(c.get("name", "gray"))
-        for x in range(x0, min(x0 + w, width)):
-            for y in range(height):
-                canvas.putpixel((x, y), color)
-        x0 += w
+    labels = colormap_engine.build_stripe_label_map(props, size)
+    label_map = colormap_engine.LabelMap(labels, [sample_color_for_name(c.get("name", "gray")) for c in colors])
 
-    canvas.save(out_path)
-    return canvas
+    label_map.save(out_path)
+    return label_map
 
 
 def canny_edge_from_image(image: Image.Image, low_threshold: int, high_threshold: int) -> np.ndarray:
@@ -404,6 +397,9 @@ class OptimizedPredictor(BasePredictor):
         
         logger.info(f"🎯 Using device: {self.device} ({self.device_info['name']})")
         
+        # Память GPU освобождается только под давлением или после OOM, а не перед каждым проходом
+        self.memory_governor = create_cuda_memory_governor(torch, MEMORY_HEADROOM_MB * 1024 * 1024)
+        
         # 🚀 НОВОЕ: Проверка и управление памятью GPU
         manage_gpu_memory(self.device_info, "check")
 
@@ -583,6 +579,11 @@ class OptimizedPredictor(BasePredictor):
             logger.warning(f"⚠️ Device optimization failed: {e}")
 
         setup_time = time.time() - start_time
+        # ControlNet pool: models are loaded in a background thread right after setup,
+        # so requests never pay the load time (only wait if they arrive before it is done)
+        self.controlnet_pool = self._create_controlnet_pool()
+        self.controlnet_pool.preload(background=True)
+
         logger.info(f"🎉 Model setup completed successfully in {setup_time:.2f}s")
         logger.info(f"📊 ControlNet enabled: {self.has_controlnet}")
         logger.info(f"🔧 Pipeline type: {type(self.pipe).__name__}")
@@ -754,60 +755,36 @@ class OptimizedPredictor(BasePredictor):
         else:
             return True, f"Угол {angle}° требует ControlNet (нестандартный ракурс)"
 
+    def _create_controlnet_pool(self) -> ControlNetPool:
+        """ControlNet pool over the locally cached models (canny, softedge, lineart)."""
+        specs = {
+            name: path for name, path in (
+                ("canny", CONTROLNET_CANNY_DIR),
+                ("softedge", CONTROLNET_SOFTEDGE_DIR),
+                ("lineart", CONTROLNET_LINEART_DIR),
+            ) if os.path.exists(path)
+        }
+        for name in ("canny", "softedge", "lineart"):
+            if name not in specs:
+                logger.info(f"{name} ControlNet not found in local cache, will download from HF")
+        # The predictor swaps pipe.controlnet itself, so the pool only serves models
+        return ControlNetPool(specs, ControlNetModel.from_pretrained, lambda controlnet: self.pipe)
+
     def _load_controlnet_models_on_demand(self) -> None:
         """
-        🚀 Lazy Loading: Загружает ControlNet модели только при необходимости.
+        Takes the ControlNet models from the pool preloaded after setup (waits if still loading).
         """
-        if self.controlnet_models_loaded:
-            return
-            
-        logger.info("🚀 Loading ControlNet models on-demand...")
-        
-        # Проверка доступной памяти перед загрузкой
-        if torch.cuda.is_available():
-            available_memory = torch.cuda.get_device_properties(0).total_memory / (1024**3)
-            allocated_memory = torch.cuda.memory_allocated(0) / (1024**3)
-            free_memory = available_memory - allocated_memory
-            
-            logger.info(f"📊 Memory status before ControlNet loading:")
-            logger.info(f"   Total: {available_memory:.1f}GB")
-            logger.info(f"   Allocated: {allocated_memory:.1f}GB")
-            logger.info(f"   Free: {free_memory:.1f}GB")
-            
-            # Если свободной памяти меньше 2GB, очищаем кэш
-            if free_memory < 2.0:
-                logger.warning(f"⚠️ Low memory ({free_memory:.1f}GB), clearing cache before loading")
-                torch.cuda.empty_cache()
-                torch.cuda.synchronize()
-        
-        try:
-            # Загрузка Canny ControlNet
-            if os.path.exists(CONTROLNET_CANNY_DIR):
-                self.controlnet_canny = ControlNetModel.from_pretrained(CONTROLNET_CANNY_DIR)
-                logger.info("✅ Canny ControlNet loaded from local cache")
-            else:
-                logger.info("Canny ControlNet not found in local cache, will download from HF")
-                
-            # Загрузка Softedge ControlNet
-            if os.path.exists(CONTROLNET_SOFTEDGE_DIR):
-                self.controlnet_softedge = ControlNetModel.from_pretrained(CONTROLNET_SOFTEDGE_DIR)
-                logger.info("✅ Softedge ControlNet loaded from local cache")
-            else:
-                logger.info("Softedge ControlNet not found in local cache, will download from HF")
-                
-            # Загрузка Lineart ControlNet
-            if os.path.exists(CONTROLNET_LINEART_DIR):
-                self.controlnet_lineart = ControlNetModel.from_pretrained(CONTROLNET_LINEART_DIR)
-                logger.info("✅ Lineart ControlNet loaded from local cache")
-            else:
-                logger.info("Lineart ControlNet not found in local cache, will download from HF")
-                
-            self.controlnet_models_loaded = True
-            logger.info("✅ All ControlNet models loaded successfully")
-            
-        except Exception as e:
-            logger.error(f"❌ Failed to load ControlNet models: {e}")
-            self.controlnet_models_loaded = False
+        pool = getattr(self, "controlnet_pool", None)
+        if pool is None:
+            pool = self.controlnet_pool = self._create_controlnet_pool()
+        if not pool.is_ready():
+            logger.info(f"⏳ Waiting for ControlNet pool: {pool.status()['models']}")
+
+        self.controlnet_canny = pool.model("canny")
+        self.controlnet_softedge = pool.model("softedge")
+        self.controlnet_lineart = pool.model("lineart")
+        self.controlnet_models_loaded = pool.is_ready()
+        logger.info(f"✅ ControlNet pool status: {pool.status()}")
 
     def _get_controlnet_model(self, angle: int) -> Optional[Any]:
         """
@@ -852,7 +829,7 @@ class OptimizedPredictor(BasePredictor):
         self,
         params_json: str = Input(description="Business-oriented parameters JSON: colors, angle, seed, quality, overrides. ВАЖНО: Угол 0° - единственный надежный ракурс обученной модели. Другие углы требуют ControlNet для геометрического контроля.")
     ) -> List[Path]:
-        """Generate preview/final images using ControlNet color‑composition guidance.
+        """Generate the final image using ControlNet color‑composition guidance; preview is the downscaled final.
 
         Returns: [preview.png, final.png, colormap.png]
         """
@@ -861,263 +838,175 @@ class OptimizedPredictor(BasePredictor):
         # 🚀 НОВОЕ: Проверка ресурсов перед генерацией
         logger.info("🔍 Checking device resources before generation...")
         manage_gpu_memory(self.device_info, "check")
-        
-        # Parse and validate input parameters
+        memory_ticket = self.memory_governor.begin_request()
         try:
-            params = self._parse_params_json(params_json)
-        except Exception as e:
-            raise ValueError(f"Parameter validation failed: {e}")
+            # Parse and validate input parameters
+            try:
+                params = self._parse_params_json(params_json)
+            except Exception as e:
+                raise ValueError(f"Parameter validation failed: {e}")
 
-        colors = params.get("colors", [])
-        angle = int(params.get("angle", 0))
-        seed = int(params.get("seed", -1))
-        quality = str(params.get("quality", "standard"))
-        overrides: Dict[str, Any] = params.get("overrides", {}) or {}
+            colors = params.get("colors", [])
+            angle = int(params.get("angle", 0))
+            seed = int(params.get("seed", -1))
+            quality = str(params.get("quality", "standard"))
+            overrides: Dict[str, Any] = params.get("overrides", {}) or {}
 
-        logger.info(f"Generating with params: colors={len(colors)}, angle={angle}, quality={quality}, seed={seed}")
+            logger.info(f"Generating with params: colors={len(colors)}, angle={angle}, quality={quality}, seed={seed}")
         
-        # 🚀 НОВОЕ: Логирование текущего состояния ресурсов
-        if hasattr(self, 'resource_monitor'):
-            resource_summary = self.resource_monitor.get_resource_summary()
-            logger.info(f"📊 Resource status: {resource_summary}")
-
-        # 🚀 ИСПРАВЛЕННЫЕ ПРОФИЛИ КАЧЕСТВА v4.3.15: Оптимизированные параметры для лучшего качества
-        if quality == "preview":
-            steps_preview, steps_final = 25, 30  # Быстрый preview
-            size_preview, size_final = (512, 512), (1024, 1024)
-            guidance_scale_default = 5.5  # Меньше артефактов для preview
-        elif quality == "high":
-            steps_preview, steps_final = 50, 80  # Высокое качество
-            size_preview, size_final = (512, 512), (1024, 1024)
-            guidance_scale_default = 5.0  # Оптимальное для высокого качества
-        else:  # standard
-            steps_preview, steps_final = 40, 60  # Стандартное качество
-            size_preview, size_final = (512, 512), (1024, 1024)
-            guidance_scale_default = 5.5  # Сбалансированное значение
-
-        # Apply overrides
-        num_inference_steps_preview = int(overrides.get("num_inference_steps_preview", steps_preview))
-        num_inference_steps_final = int(overrides.get("num_inference_steps_final", steps_final))
-        guidance_scale = float(overrides.get("guidance_scale", guidance_scale_default))  # ИСПРАВЛЕНО: Используем оптимальные значения
-
-        # Build clean prompt
-        base_prompt = self._build_prompt(colors)
-        logger.info(f"Generated prompt: {base_prompt}")
-
-        negative_prompt = overrides.get(
-            "negative_prompt",
-            "object, blurry, worst quality, low quality, deformed, watermark, 3d render, cartoon, abstract, smooth, flat",
-        )
-
-        # Generator
-        generator = torch.manual_seed(seed) if seed != -1 else torch.Generator(device=self.device)
-        if seed == -1:
-            seed = generator.seed()
-
-        # Create color map and corresponding control image (edge map)
-        colormap_path = "/tmp/colormap.png"
-        logger.info(f"Building color map for {len(colors)} colors")
-        colormap_img = build_color_map(colors, size_final, colormap_path)
-        logger.info(f"Color map saved to {colormap_path}")
-
-        # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Логика углов в соответствии с ограничениями модели
-        should_use_controlnet, reason = self._should_use_controlnet(angle)
-        use_controlnet_by_angle = should_use_controlnet
+            # 🚀 НОВОЕ: Логирование текущего состояния ресурсов
+            if hasattr(self, 'resource_monitor'):
+                resource_summary = self.resource_monitor.get_resource_summary()
+                logger.info(f"📊 Resource status: {resource_summary}")
+
+            # 🚀 ИСПРАВЛЕННЫЕ ПРОФИЛИ КАЧЕСТВА v4.3.15: Оптимизированные параметры для лучшего качества
+            if quality == "preview":
+                steps_final = 30  # Быстрый профиль
+                size_preview, size_final = (512, 512), (1024, 1024)
+                guidance_scale_default = 5.5  # Меньше артефактов для preview
+            elif quality == "high":
+                steps_final = 80  # Высокое качество
+                size_preview, size_final = (512, 512), (1024, 1024)
+                guidance_scale_default = 5.0  # Оптимальное для высокого качества
+            else:  # standard
+                steps_final = 60  # Стандартное качество
+                size_preview, size_final = (512, 512), (1024, 1024)
+                guidance_scale_default = 5.5  # Сбалансированное значение
+
+            # Apply overrides (num_inference_steps_preview принимается для совместимости: preview — уменьшенный final)
+            num_inference_steps_final = int(overrides.get("num_inference_steps_final", steps_final))
+            guidance_scale = float(overrides.get("guidance_scale", guidance_scale_default))  # ИСПРАВЛЕНО: Используем оптимальные значения
+
+            # Build clean prompt
+            base_prompt = self._build_prompt(colors)
+            logger.info(f"Generated prompt: {base_prompt}")
+
+            negative_prompt = overrides.get(
+                "negative_prompt",
+                "object, blurry, worst quality, low quality, deformed, watermark, 3d render, cartoon, abstract, smooth, flat",
+            )
+
+            # Generator
+            generator = torch.manual_seed(seed) if seed != -1 else torch.Generator(device=self.device)
+            if seed == -1:
+                seed = generator.seed()
+
+            # Create color map and corresponding control image (edge map)
+            colormap_path = "/tmp/colormap.png"
+            logger.info(f"Building color map for {len(colors)} colors")
+            colormap_img = build_color_map(colors, size_final, colormap_path)
+            logger.info(f"Color map saved to {colormap_path}")
+
+            # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Логика углов в соответствии с ограничениями модели
+            should_use_controlnet, reason = self._should_use_controlnet(angle)
+            use_controlnet_by_angle = should_use_controlnet
         
-        # Пользовательский override ControlNet
-        user_controlnet_setting = overrides.get("use_controlnet", None)
+            # Пользовательский override ControlNet
+            user_controlnet_setting = overrides.get("use_controlnet", None)
         
-        if user_controlnet_setting is not None:
-            use_controlnet = bool(user_controlnet_setting)
-            if use_controlnet != use_controlnet_by_angle:
-                logger.warning(f"⚠️ Пользователь переопределил ControlNet: {use_controlnet} (рекомендуется: {use_controlnet_by_angle})")
-                logger.warning(f"⚠️ Причина рекомендации: {reason}")
-        else:
-            use_controlnet = use_controlnet_by_angle
+            if user_controlnet_setting is not None:
+                use_controlnet = bool(user_controlnet_setting)
+                if use_controlnet != use_controlnet_by_angle:
+                    logger.warning(f"⚠️ Пользователь переопределил ControlNet: {use_controlnet} (рекомендуется: {use_controlnet_by_angle})")
+                    logger.warning(f"⚠️ Причина рекомендации: {reason}")
+            else:
+                use_controlnet = use_controlnet_by_angle
             
-        logger.info(f"ControlNet решение: {use_controlnet} - {reason}")
+            logger.info(f"ControlNet решение: {use_controlnet} - {reason}")
         
-        # ИСПРАВЛЕНО: максимально безопасная работа с ControlNet
-        control_preview = None
-        control_final = None
+            # ИСПРАВЛЕНО: максимально безопасная работа с ControlNet
+            control_final = None
         
-        if use_controlnet and self.has_controlnet:
-            try:
-        # Select controlnet by angle
-                selected_cn = select_controlnet_by_angle(
-                    angle, self.controlnet_canny, self.controlnet_softedge, self.controlnet_lineart
-                )
-                if selected_cn is not None:
-                    # Безопасно устанавливаем ControlNet
-                    if hasattr(self.pipe, 'controlnet'):
-                        self.pipe.controlnet = selected_cn
-                        logger.info(f"✅ ControlNet set for angle {angle}")
-
-                        # Prepare edge maps for preview/final
-                        logger.info("Generating edge maps...")
-                        control_preview = canny_edge_from_image(colormap_img.resize(size_preview, Image.NEAREST), 80, 160)
-                        control_final = canny_edge_from_image(colormap_img.resize(size_final, Image.NEAREST), 100, 200)
-                        logger.info("✅ Edge maps generated successfully")
+            if use_controlnet and self.has_controlnet:
+                try:
+            # Select controlnet by angle
+                    selected_cn = select_controlnet_by_angle(
+                        angle, self.controlnet_canny, self.controlnet_softedge, self.controlnet_lineart
+                    )
+                    if selected_cn is not None:
+                        # Безопасно устанавливаем ControlNet
+                        if hasattr(self.pipe, 'controlnet'):
+                            self.pipe.controlnet = selected_cn
+                            logger.info(f"✅ ControlNet set for angle {angle}")
+
+                            # Prepare edge map for final (preview is derived from it)
+                            logger.info("Generating edge maps...")
+                            control_final = canny_edge_from_image(colormap_img.rgba.convert("RGB"), 100, 200)
+                            logger.info("✅ Edge maps generated successfully")
+                        else:
+                            logger.warning("⚠️ Pipeline does not support ControlNet")
+                            use_controlnet = False
                     else:
-                        logger.warning("⚠️ Pipeline does not support ControlNet")
+                        logger.warning("⚠️ No ControlNet available for this angle")
                         use_controlnet = False
-                else:
-                    logger.warning("⚠️ No ControlNet available for this angle")
+                except Exception as e:
+                    logger.error(f"❌ ControlNet setup failed: {e}")
                     use_controlnet = False
-            except Exception as e:
-                logger.error(f"❌ ControlNet setup failed: {e}")
-                use_controlnet = False
-                control_preview = None
-                control_final = None
-        else:
-            logger.info("ℹ️ ControlNet disabled (user preference or not available)")
+                    control_final = None
+            else:
+                logger.info("ℹ️ ControlNet disabled (user preference or not available)")
 
-        # Generate preview first (fast)
-        preview_start = time.time()
-        logger.info(f"Generating preview with {num_inference_steps_preview} steps, guidance_scale={guidance_scale}")
-        logger.info(f"ControlNet status: enabled={use_controlnet}, available={self.has_controlnet}, image={control_preview is not None}")
+            # Generate final (quality)
+            final_start = time.time()
+            logger.info(f"Generating final image with {num_inference_steps_final} steps")
         
-        try:
-            # Prepare generation parameters
-            gen_params = {
-                "prompt": base_prompt,
-                "negative_prompt": negative_prompt,
-                "width": size_preview[0],
-                "height": size_preview[1],
-                "num_inference_steps": num_inference_steps_preview,
-                "guidance_scale": guidance_scale,
-                "generator": generator,
-            }
-            
-            # Add ControlNet image if enabled and available
-            if use_controlnet and control_preview is not None and self.has_controlnet:
-                gen_params["image"] = control_preview
-                logger.info("✅ Using ControlNet for preview generation")
-            else:
-                logger.info("ℹ️ Preview generation without ControlNet")
-            
-            # 🧹 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ v4.3.10: Агрессивная очистка памяти без ограничений GPU
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-                torch.cuda.synchronize()
-                torch.cuda.reset_peak_memory_stats()  # Сброс статистики памяти
-                gc.collect()  # Принудительная сборка мусора
-                torch.cuda.empty_cache()  # Повторная очистка
-                
-                # 🚀 НОВОЕ: Комплексное управление памятью и устройствами
-                logger.info("🔧 Комплексное управление памятью выполнено")
-                
-                logger.info("🧹 Комплексная очистка памяти выполнена для стабильной работы")
-            
-            # 🚀 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ v4.3.10: Безопасный VAE decode с совместимостью типов
-            # 🚀 НОВОЕ: Оставляем ВЕСЬ pipeline на GPU для избежания конфликтов устройств
-            logger.info("🔧 Final generation с полным pipeline на GPU")
-            
-            # Генерируем preview с параметрами preview
-            preview_params = {
-                "prompt": base_prompt,
-                "negative_prompt": negative_prompt,
-                "width": size_preview[0],
-                "height": size_preview[1],
-                "num_inference_steps": num_inference_steps_preview,
-                "guidance_scale": guidance_scale,
-                "generator": generator,
-            }
-            
-            # Add ControlNet image if enabled and available
-            if use_controlnet and control_preview is not None and self.has_controlnet:
-                preview_params["image"] = control_preview
-                logger.info("✅ Using ControlNet for preview generation")
+            try:
+                # Prepare generation parameters
+                gen_params = {
+                    "prompt": base_prompt,
+                    "negative_prompt": negative_prompt,
+                    "width": size_final[0],
+                    "height": size_final[1],
+                    "num_inference_steps": num_inference_steps_final,
+                    "guidance_scale": guidance_scale,
+                    "generator": generator,
+                }
             
-            logger.info("🔧 Preview generation с полным pipeline на GPU")
-            with torch.no_grad():
-                preview = self.pipe(**preview_params).images[0]
+                # Add ControlNet image if enabled and available
+                if use_controlnet and control_final is not None and self.has_controlnet:
+                    gen_params["image"] = control_final
+                    logger.info("✅ Using ControlNet for final generation")
+                else:
+                    logger.info("ℹ️ Final generation without ControlNet")
             
-            logger.info("🔧 Preview generation завершен успешно")
+                # Очистка памяти только при нехватке запаса: теплые блоки аллокатора остаются проходу
+                self.memory_governor.maybe_reclaim()
             
-            # Генерируем final с параметрами final
-            with torch.no_grad():
-                final = self.pipe(**gen_params).images[0]
+                # 🚀 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ v4.3.10: Безопасный VAE decode с совместимостью типов
+                # 🚀 НОВОЕ: Оставляем ВЕСЬ pipeline на GPU для избежания конфликтов устройств
+                logger.info("🔧 Final generation с полным pipeline на GPU")
             
-            logger.info("🔧 Final generation завершен успешно")
-            try:
-                
-                preview_time = time.time() - preview_start
-                logger.info(f"✅ Preview generated successfully in {preview_time:.2f}s")
-                
-            except Exception as e:
-                # В случае ошибки возвращаем VAE на GPU
-                if hasattr(self.pipe, 'vae') and hasattr(self.pipe.vae, 'to'):
-                    self.pipe.vae = self.pipe.vae.to(original_vae_device)
-                logger.error(f"❌ Preview generation error: {e}")
-                raise e
-        except Exception as e:
-            logger.error(f"❌ Preview generation failed: {e}")
-            raise RuntimeError(f"Preview generation failed: {e}")
-
-        # Generate final (quality)
-        final_start = time.time()
-        logger.info(f"Generating final image with {num_inference_steps_final} steps")
-        
-        try:
-            # Prepare generation parameters
-            gen_params = {
-                "prompt": base_prompt,
-                "negative_prompt": negative_prompt,
-                "width": size_final[0],
-                "height": size_final[1],
-                "num_inference_steps": num_inference_steps_final,
-                "guidance_scale": guidance_scale,
-                "generator": generator,
-            }
+                # Генерируем final с полным pipeline на GPU (при OOM — освобождение кэша и повтор)
+                with torch.no_grad():
+                    final = self.memory_governor.run(lambda: self.pipe(**gen_params).images[0])
             
-            # Add ControlNet image if enabled and available
-            if use_controlnet and control_final is not None and self.has_controlnet:
-                gen_params["image"] = control_final
-                logger.info("✅ Using ControlNet for final generation")
-            else:
-                logger.info("ℹ️ Final generation without ControlNet")
-            
-            # 🧹 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ v4.3.10: Агрессивная очистка памяти без ограничений GPU
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-                torch.cuda.synchronize()
-                torch.cuda.reset_peak_memory_stats()  # Сброс статистики памяти
-                gc.collect()  # Принудительная сборка мусора
-                torch.cuda.empty_cache()  # Повторная очистка
-                
-                # 🚀 НОВОЕ: Комплексное управление памятью и устройствами
-                logger.info("🔧 Комплексное управление памятью выполнено")
-                
-                logger.info("🧹 Комплексная очистка памяти выполнена для стабильной работы")
-            
-            # 🚀 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ v4.3.10: Безопасный VAE decode с совместимостью типов
-            # 🚀 НОВОЕ: Оставляем ВЕСЬ pipeline на GPU для избежания конфликтов устройств
-            logger.info("🔧 Final generation с полным pipeline на GPU")
+                logger.info("🔧 Final generation завершен успешно")
             
-            # Генерируем final с полным pipeline на GPU
-            with torch.no_grad():
-                final = self.pipe(**gen_params).images[0]
+                logger.info(f"✅ Final generated in {time.time() - final_start:.2f}s")
             
-            logger.info("🔧 Final generation завершен успешно")
+                # Preview — уменьшенный final: отдельный 512-проход диффузии больше не запускается
+                preview = final.resize(size_preview, Image.Resampling.LANCZOS)
             
-            # Сохраняем изображения
-            preview_path = Path("/tmp/preview.png")
-            final_path = Path("/tmp/final.png")
-            colormap_path = Path("/tmp/colormap.png")
+                # Сохраняем изображения
+                preview_path = Path("/tmp/preview.png")
+                final_path = Path("/tmp/final.png")
+                colormap_path = Path("/tmp/colormap.png")
             
-            preview.save(preview_path)
-            final.save(final_path)
-            colormap_img.save(colormap_path)
+                preview.save(preview_path)
+                final.save(final_path)
+                colormap_img.save(colormap_path)
             
-            total_time = time.time() - start_time
-            logger.info(f"✅ Generation completed in {total_time:.2f}s")
+                total_time = time.time() - start_time
+                logger.info(f"✅ Generation completed in {total_time:.2f}s")
+                logger.info(f"📊 Request GPU memory: {self.memory_governor.end_request(ticket=memory_ticket)}")
                 
-            return [preview_path, final_path, colormap_path]
+                return [preview_path, final_path, colormap_path]
             
-        except Exception as e:
-            logger.error(f"❌ Final generation failed: {e}")
-            raise RuntimeError(f"Final generation failed: {e}")
+            except Exception as e:
+                logger.error(f"❌ Final generation failed: {e}")
+                raise RuntimeError(f"Final generation failed: {e}")
+        finally:
+            self.memory_governor.finish_request(memory_ticket)
 
     def _install_sdxl_textual_inversion_dual(self, ti_path: str, pipeline, token_g: str, token_l: str) -> None:
         """Install SDXL textual inversion that contains separate embeddings for CLIP-G and CLIP-L encoders."""
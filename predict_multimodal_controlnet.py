@@ -7,6 +7,51 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Вес и окно шагов (доли от числа шагов) для каждого типа ControlNet.
+# Цвет, сетка и перемешивание задают композицию на ранних шагах; после конца окна
+# ControlNet не участвует в шаге, и его forward можно пропустить
+CONTROLNET_SETTINGS = {
+    "t2i_color": {"scale": 1.0, "start": 0.0, "end": 0.6},
+    "color_grid": {"scale": 1.1, "start": 0.0, "end": 0.5},
+    "shuffle": {"scale": 0.9, "start": 0.0, "end": 0.35},
+    "softedge": {"scale": 0.85, "start": 0.0, "end": 0.5},
+    "canny": {"scale": 0.75, "start": 0.0, "end": 0.5},
+}
+DEFAULT_CONTROLNET_SETTINGS = {"scale": 1.0, "start": 0.0, "end": 1.0}
+
+
+def build_multi_controlnet_kwargs(controlnets: list, control_images: list) -> dict:
+    """
+    Параметры pipeline для настоящего multi-ControlNet: по изображению, весу и окну шагов на модель
+    
+    Args:
+        controlnets: Типы ControlNet (порядок = порядок моделей в pipeline)
+        control_images: Контрольные карты в том же порядке
+        
+    Returns:
+        Словарь image / controlnet_conditioning_scale / control_guidance_start / control_guidance_end;
+        для одной модели значения скалярные, для нескольких — списки
+    """
+    settings = [CONTROLNET_SETTINGS.get(controlnet_type, DEFAULT_CONTROLNET_SETTINGS) for controlnet_type in controlnets]
+    pipe_kwargs = {
+        "image": list(control_images),
+        "controlnet_conditioning_scale": [setting["scale"] for setting in settings],
+        "control_guidance_start": [setting["start"] for setting in settings],
+        "control_guidance_end": [setting["end"] for setting in settings],
+    }
+    if len(controlnets) == 1:
+        pipe_kwargs = {key: value[0] for key, value in pipe_kwargs.items()}
+    return pipe_kwargs
+
+
+def active_controlnet_fraction(controlnets: list) -> float:
+    """Доля ControlNet-forward, которые реально выполняются с учетом окон шагов (1.0 — без окон)"""
+    if not controlnets:
+        return 0.0
+    settings = [CONTROLNET_SETTINGS.get(controlnet_type, DEFAULT_CONTROLNET_SETTINGS) for controlnet_type in controlnets]
+    return sum(setting["end"] - setting["start"] for setting in settings) / len(settings)
+
+
 class MultimodalControlNet:
     """Мультимодальный ControlNet с адаптивным выбором на основе сложности промпта"""
     
@@ -219,11 +264,11 @@ class MultimodalControlNet:
     
     def apply_multi_controlnet(self, prompt: str, controlnets: list, base_image: Image.Image) -> dict:
         """
-        Применяет несколько ControlNet последовательно для максимальной точности
+        Готовит настоящий multi-ControlNet: своя контрольная карта, вес и окно шагов для каждой модели
         
         Args:
             prompt: Текстовый промпт
-            controlnets: Список типов ControlNet
+            controlnets: Список типов ControlNet (порядок = порядок моделей в pipeline)
             base_image: Базовое изображение
             
         Returns:
@@ -233,37 +278,14 @@ class MultimodalControlNet:
             return None
         
         try:
-            # Создаем множественные контрольные карты
+            # Создаем отдельную контрольную карту для каждого ControlNet (без смешивания в одну)
             control_images = []
             for controlnet_type in controlnets:
                 control_image = self.create_control_image(controlnet_type, base_image, prompt)
                 control_images.append(control_image)
             
-            # Создаем комбинированную контрольную карту
-            combined_hint = self._create_combined_control_hint(control_images)
-            
-            # Применяем каждый ControlNet с соответствующими весами
-            pipe_kwargs = {}
-            
-            # Основная контрольная карта
-            pipe_kwargs["image"] = combined_hint
-            
-            # Настройки для разных типов ControlNet
-            if "t2i_color" in controlnets:
-                pipe_kwargs["controlnet_conditioning_scale"] = 0.8
-            elif "color_grid" in controlnets:
-                pipe_kwargs["controlnet_conditioning_scale"] = 0.9
-            elif "shuffle" in controlnets:
-                pipe_kwargs["controlnet_conditioning_scale"] = 0.7
-            elif "softedge" in controlnets:
-                pipe_kwargs["controlnet_conditioning_scale"] = 0.85
-            elif "canny" in controlnets:
-                pipe_kwargs["controlnet_conditioning_scale"] = 0.75
-            
-            # Если несколько ControlNet, используем средний вес
-            if len(controlnets) > 1:
-                pipe_kwargs["controlnet_conditioning_scale"] = 0.8
-            
+            pipe_kwargs = build_multi_controlnet_kwargs(controlnets, control_images)
+            logger.info(f"🎛️ Multi-ControlNet {controlnets}: активно {active_controlnet_fraction(controlnets) * 100:.0f}% ControlNet-шагов")
             return pipe_kwargs
             
         except Exception as e:
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+LRU-кэш эмбеддингов промптов SDXL перед текстовыми энкодерами.
+
+Хранит prompt_embeds, pooled_prompt_embeds и их негативные пары на устройстве
+с бюджетом в байтах VRAM. Модуль не импортирует PyTorch: размер тензора
+берется из numel() * element_size() (или nbytes), поэтому его можно
+тестировать на массивах NumPy.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Поля эмбеддингов, которые принимает SDXL pipeline вместо строк промптов
+EMBEDDING_FIELDS = (
+    "prompt_embeds",
+    "negative_prompt_embeds",
+    "pooled_prompt_embeds",
+    "negative_pooled_prompt_embeds",
+)
+
+
+def tensor_nbytes(tensor: Any) -> int:
+    """Размер тензора в байтах (torch.Tensor или numpy.ndarray)."""
+    if tensor is None:
+        return 0
+    if hasattr(tensor, "numel") and hasattr(tensor, "element_size"):
+        return int(tensor.numel() * tensor.element_size())
+    return int(getattr(tensor, "nbytes", 0))
+
+
+def prompt_embedding_key(prompt: str, negative_prompt: Optional[str], **extra: Any) -> str:
+    """Ключ кэша: промпт, негативный промпт и параметры кодирования (устройство, dtype, CFG)."""
+    payload = json.dumps([prompt, negative_prompt or "", sorted((k, str(v)) for k, v in extra.items())])
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class PromptEmbeddingCache:
+    """LRU-кэш эмбеддингов промптов с бюджетом в байтах.
+
+    Запись — словарь полей EMBEDDING_FIELDS. При промахе get_or_encode вызывает
+    энкодер, замеряет его время и кладет результат в кэш; попадание экономит
+    среднее время кодирования, что копится в stats["saved_seconds"].
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0, "misses": 0, "evictions": 0, "entries": 0, "bytes": 0,
+            "encode_seconds": 0.0, "saved_seconds": 0.0
+        }
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Возвращает закэшированные эмбеддинги или None (промах)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["saved_seconds"] += self._mean_encode_seconds()
+            return entry
+
+    def put(self, key: str, embeddings: Dict[str, Any]) -> None:
+        """Сохраняет эмбеддинги с вытеснением по LRU; записи больше бюджета не кэшируются."""
+        nbytes = sum(tensor_nbytes(embeddings.get(field)) for field in EMBEDDING_FIELDS)
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            if key in self._entries:
+                del self._entries[key]
+                self.current_bytes -= self._sizes.pop(key)
+            self._entries[key] = embeddings
+            self._sizes[key] = nbytes
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self.current_bytes -= self._sizes.pop(evicted_key)
+                self.stats["evictions"] += 1
+            self.stats["entries"] = len(self._entries)
+            self.stats["bytes"] = self.current_bytes
+
+    def get_or_encode(self, key: str, encode: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Эмбеддинги из кэша или результат encode() (с замером времени энкодера)."""
+        embeddings = self.get(key)
+        if embeddings is not None:
+            return embeddings
+        start_time = time.perf_counter()
+        embeddings = encode()
+        with self._lock:
+            self.stats["encode_seconds"] += time.perf_counter() - start_time
+        self.put(key, embeddings)
+        return embeddings
+
+    def clear(self) -> None:
+        """Очищает кэш (например, после смены весов текстовых энкодеров)."""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.current_bytes = 0
+            self.stats["entries"] = 0
+            self.stats["bytes"] = 0
+
+    def _mean_encode_seconds(self) -> float:
+        encodes = self.stats["misses"]
+        return self.stats["encode_seconds"] / encodes if encodes else 0.0
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Изолированные каталоги выходных файлов запросов.
+
+Каждый запрос predict() пишет preview/final, colormap, легенду, JSON и
+латентные превью в собственный каталог вместо общих путей /tmp, поэтому
+конкурентные запросы не перезаписывают файлы друг друга. После того как
+запрос отдал все выходы, каталог освобождается, но удаляется только через
+ttl_seconds: сервер загружает отданные файлы уже после возврата из генератора,
+и фиксированное число хранимых каталогов при нескольких запросах в работе
+удаляло бы файлы до загрузки. Модуль не зависит от PyTorch.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RequestWorkspace:
+    """Каталог одного запроса: path — корень, file(name) — путь файла внутри."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def file(self, name: str) -> str:
+        """Путь файла name в каталоге запроса."""
+        return os.path.join(self.path, name)
+
+    def remove(self) -> None:
+        """Удаляет каталог со всем содержимым."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class WorkspaceManager:
+    """Создает каталоги запросов в root и удаляет освобожденные спустя ttl_seconds.
+
+    create() вызывается в начале запроса, release() — после отдачи всех выходов
+    (в finally генератора). Просроченные каталоги удаляются при create() и release(),
+    поэтому срок хранения не зависит от числа запросов в работе. ttl_seconds=0
+    удаляет каталог сразу при освобождении. Метрики — в stats (created, removed, active, retained).
+    """
+
+    def __init__(self, root: Optional[str] = None, ttl_seconds: float = 600.0, prefix: str = "request_",
+                 clock: Callable[[], float] = time.monotonic):
+        self.root = root
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.prefix = prefix
+        self.clock = clock
+        if root:
+            os.makedirs(root, exist_ok=True)
+        self._released: Deque[Tuple[float, RequestWorkspace]] = deque()
+        self._lock = threading.Lock()
+        self.stats = {"created": 0, "removed": 0, "active": 0, "retained": 0}
+
+    def create(self) -> RequestWorkspace:
+        """Новый пустой каталог запроса с уникальным именем."""
+        workspace = RequestWorkspace(tempfile.mkdtemp(prefix=self.prefix, dir=self.root))
+        with self._lock:
+            self.stats["created"] += 1
+            self.stats["active"] += 1
+        self._remove_expired()
+        return workspace
+
+    def release(self, workspace: RequestWorkspace) -> None:
+        """Запрос отдал выходы: каталог ждет ttl_seconds (загрузку файлов сервером) и удаляется."""
+        with self._lock:
+            self.stats["active"] -= 1
+            self._released.append((self.clock(), workspace))
+        self._remove_expired()
+
+    def _remove_expired(self) -> None:
+        """Удаляет освобожденные каталоги, чей срок хранения истек."""
+        now = self.clock()
+        with self._lock:
+            expired = []
+            while self._released and now - self._released[0][0] >= self.ttl_seconds:
+                expired.append(self._released.popleft()[1])
+            self.stats["removed"] += len(expired)
+            self.stats["retained"] = len(self._released)
+        for old_workspace in expired:
+            old_workspace.remove()
+        if expired:
+            logger.debug(f"🧹 Удалено каталогов запросов: {len(expired)}")
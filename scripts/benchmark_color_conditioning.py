@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Сравнение цветового кондиционирования: ControlNet против latent_init (img2img от colormap)
+по числу цветов — время генерации и цветовая точность финального изображения.
+Результаты копятся в Predictor.get_color_grid_stats()["conditioning"] и пишутся в JSON.
+
+Запуск из корня проекта на машине с GPU:
+    python scripts/benchmark_color_conditioning.py [--repeats 2] [--strength 0.75] [--output conditioning.json]
+"""
+
+import argparse
+import inspect
+import json
+import sys
+
+sys.path.append('.')
+from predict import Predictor
+
+PROMPTS = {
+    1: "100% red",
+    2: "60% red, 40% white",
+    3: "50% red, 30% white, 20% blue",
+    4: "40% red, 30% white, 20% blue, 10% yellow",
+}
+
+
+def predict_defaults(predictor):
+    """Значения по умолчанию Input(...) из сигнатуры predict (без сервера cog)"""
+    return {
+        name: getattr(parameter.default, "default", parameter.default)
+        for name, parameter in inspect.signature(predictor.predict).parameters.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение ControlNet и latent_init по числу цветов")
+    parser.add_argument("--repeats", type=int, default=2, help="Запусков на режим и число цветов")
+    parser.add_argument("--strength", type=float, default=0.75, help="Сила img2img для latent_init")
+    parser.add_argument("--seed", type=int, default=12345, help="Seed первого запуска (далее seed+1, ...)")
+    parser.add_argument("--output", default="conditioning_comparison.json", help="Файл результатов")
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    defaults = predict_defaults(predictor)
+
+    for color_count, prompt in PROMPTS.items():
+        for mode in ("controlnet", "latent_init"):
+            for repeat in range(args.repeats):
+                kwargs = dict(defaults, prompt=prompt, seed=args.seed + repeat, preview_every_n_steps=0,
+                              color_conditioning=mode, color_strength=args.strength)
+                # ControlNet включаем явно и для одного цвета, чтобы сравнение шло по всем числам цветов
+                kwargs["use_controlnet"] = mode == "controlnet"
+                for _ in predictor.predict(**kwargs):
+                    pass
+                print(f"✅ {mode}, {color_count} цв., запуск {repeat + 1}/{args.repeats}")
+
+    comparison = predictor.get_color_grid_stats()["conditioning"]
+    print(f"{'цветов':>6} | {'режим':<11} | {'время, с':>8} | {'точность':>8}")
+    for color_count in PROMPTS:
+        for mode in ("controlnet", "latent_init"):
+            entry = comparison.get(mode, {}).get(str(color_count))
+            if entry:
+                print(f"{color_count:>6} | {mode:<11} | {entry['mean_seconds']:>8.2f} | {entry['mean_fidelity']!s:>8}")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"strength": args.strength, "repeats": args.repeats, "conditioning": comparison},
+                  f, ensure_ascii=False, indent=2)
+    print(f"📄 Результаты: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк генерации гранулярного colormap: попиксельная PIL-реализация против NumPy-движка
+Запуск из корня проекта: python scripts/benchmark_colormap.py [--size 1024] [--repeats 3]
+"""
+
+import argparse
+import math
+import random
+import statistics
+import sys
+import time
+
+sys.path.append('.')
+from PIL import Image
+
+from predict import ColorGridControlNet
+
+BENCHMARK_COLORS = ["RED", "WHITE", "BLUE", "YELLOW", "BLACK"]
+
+
+def build_colors(color_count):
+    """Равные доли для первых color_count цветов"""
+    return [{"name": name, "proportion": 1.0 / color_count} for name in BENCHMARK_COLORS[:color_count]]
+
+
+def measure(func, repeats):
+    """Медианное время выполнения func() в секундах"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def legacy_granular_pattern_with_hint(adapter, colors, size, granule_size="medium"):
+    """Эталонная попиксельная реализация гранулярного паттерна (PIL PixelAccess).
+    Параметры гранул берутся из adapter (ColorGridControlNet), чтобы сравнение шло на одной калибровке."""
+    width, height = size
+    canvas = Image.new('RGBA', size, (255, 255, 255, 0))
+    hint = Image.new('L', size, 0)
+    pixels = canvas.load()
+    hp = hint.load()
+
+    margin_x = int(width * 0.025)
+    margin_y = int(height * 0.025)
+    work_width = width - 2 * margin_x
+    work_height = height - 2 * margin_y
+
+    granule_params = adapter.granule_sizes[granule_size]
+    min_size = granule_params["min_size"]
+    max_size = granule_params["max_size"]
+    variation = granule_params["variation"]
+    calibration = adapter.granule_calibration
+
+    total_proportion = sum(color.get("proportion", 0) for color in colors)
+    normalized_colors = []
+    for color in colors:
+        proportion = color.get("proportion", 0) / max(1e-8, total_proportion)
+        color_rgb = adapter._name_to_rgb(color.get("name", "white"))
+        normalized_colors.append({
+            "color": color_rgb,
+            "proportion": proportion,
+            "pixels_needed": int(proportion * work_width * work_height * adapter.granule_sizes[granule_size]["density"])  # type: ignore
+        })
+
+    all_positions = [(x + margin_x, y + margin_y) for x in range(work_width) for y in range(work_height)]
+    random.shuffle(all_positions)
+
+    def luma(rgb):
+        r, g, b = rgb
+        return int(0.299 * r + 0.587 * g + 0.114 * b)
+
+    pos_idx = 0
+    for _, color_info in enumerate(normalized_colors):
+        pixels_to_place = color_info["pixels_needed"]
+        placed = 0
+        while placed < pixels_to_place and pos_idx < len(all_positions):
+            x, y = all_positions[pos_idx]
+            pos_idx += 1
+            if pixels[x, y] == (255, 255, 255, 0):
+                gsize = _generate_variable_granule_size(min_size, max_size, variation, calibration)
+                actual = _draw_organic_granule(pixels, x, y, gsize, color_info["color"], work_width, work_height, margin_x, margin_y, calibration)
+                # Заполняем hint там, где поставили цветные пиксели (пробегаем локально)
+                half = max(1, gsize // 2)
+                for dx in range(-half, half + 1):
+                    for dy in range(-half, half + 1):
+                        xx, yy = x + dx, y + dy
+                        if margin_x <= xx < margin_x + work_width and margin_y <= yy < margin_y + work_height:
+                            if pixels[xx, yy] != (255, 255, 255, 0):
+                                hp[xx, yy] = luma(color_info["color"])  # фон остаётся 0
+                placed += actual
+    return canvas, hint
+
+
+def _generate_variable_granule_size(min_size: int, max_size: int, variation: float, calibration: dict) -> int:
+    """Генерирует вариативный размер гранулы на основе калиброванных параметров"""
+
+    # Базовый размер с вариацией
+    base_size = random.randint(min_size, max_size)
+
+    # Применяем вариацию для создания неоднородности
+    variation_factor = 1.0 + (random.random() - 0.5) * variation * 2
+    variable_size = int(base_size * variation_factor)
+
+    # Ограничиваем размер калиброванными параметрами
+    variable_size = max(calibration["min_granule_size"],
+                       min(calibration["max_granule_size"], variable_size))
+
+    return variable_size
+
+
+def _draw_organic_granule(pixels, center_x: int, center_y: int, size: int, color: tuple,
+                         work_width: int, work_height: int, margin_x: int, margin_y: int, calibration: dict) -> int:
+    """Рисует органическую гранулу с неправильной формой и возвращает количество размещенных пикселей"""
+
+    # Параметры органичности
+    organic_factor = calibration["organic_factor"]
+    form_complexity = calibration["form_complexity"]
+
+    # Определяем форму гранулы на основе сложности
+    if random.random() < form_complexity:
+        # Сложная органическая форма
+        return _draw_complex_organic_granule(pixels, center_x, center_y, size, color,
+                                                work_width, work_height, margin_x, margin_y, organic_factor)
+    else:
+        # Простая форма с небольшими искажениями
+        return _draw_simple_organic_granule(pixels, center_x, center_y, size, color,
+                                               work_width, work_height, margin_x, margin_y, organic_factor)
+
+
+def _draw_simple_organic_granule(pixels, center_x: int, center_y: int, size: int, color: tuple,
+                               work_width: int, work_height: int, margin_x: int, margin_y: int, organic_factor: float) -> int:
+    """Рисует простую органическую гранулу с небольшими искажениями и возвращает количество размещенных пикселей"""
+
+    # Базовый радиус с небольшими вариациями
+    base_radius = size // 2
+    pixels_placed = 0
+
+    for dx in range(-base_radius, base_radius + 1):
+        for dy in range(-base_radius, base_radius + 1):
+            x, y = center_x + dx, center_y + dy
+
+            # Проверяем границы
+            if (margin_x <= x < work_width + margin_x and
+                margin_y <= y < work_height + margin_y):
+
+                # Вычисляем расстояние от центра
+                distance = math.sqrt(dx*dx + dy*dy)
+
+                # Добавляем органические искажения
+                organic_distortion = 1.0 + (random.random() - 0.5) * organic_factor * 0.3
+                effective_radius = base_radius * organic_distortion
+
+                # Рисуем пиксель, если он внутри искаженного круга
+                if distance <= effective_radius:
+                    pixels[x, y] = color
+                    pixels_placed += 1
+
+    return pixels_placed
+
+
+def _draw_complex_organic_granule(pixels, center_x: int, center_y: int, size: int, color: tuple,
+                                work_width: int, work_height: int, margin_x: int, margin_y: int, organic_factor: float) -> int:
+    """Рисует сложную органическую гранулу с неправильной формой и возвращает количество размещенных пикселей"""
+
+    # Создаем несколько точек для сложной формы
+    num_points = max(3, size // 2)
+    points = []
+
+    for i in range(num_points):
+        angle = (2 * math.pi * i) / num_points
+        # Добавляем случайные отклонения для органичности
+        radius_variation = 1.0 + (random.random() - 0.5) * organic_factor
+        point_radius = (size // 2) * radius_variation
+
+        px = center_x + int(point_radius * math.cos(angle))
+        py = center_y + int(point_radius * math.sin(angle))
+        points.append((px, py))
+
+    # Рисуем гранулу, используя точки как основу для формы
+    pixels_placed = 0
+    for dx in range(-size, size + 1):
+        for dy in range(-size, size + 1):
+            x, y = center_x + dx, center_y + dy
+
+            # Проверяем границы
+            if (margin_x <= x < work_width + margin_x and
+                margin_y <= y < work_height + margin_y):
+
+                # Проверяем, находится ли точка внутри сложной формы
+                if _point_in_complex_shape(x, y, points, organic_factor):
+                    pixels[x, y] = color
+                    pixels_placed += 1
+
+    return pixels_placed
+
+
+def _point_in_complex_shape(x: int, y: int, points: list, organic_factor: float) -> bool:
+    """Проверяет, находится ли точка внутри сложной органической формы"""
+
+    # Используем алгоритм ray casting для проверки принадлежности к многоугольнику
+    n = len(points)
+    inside = False
+
+    p1x, p1y = points[0]
+    for i in range(1, n + 1):
+        p2x, p2y = points[i % n]
+        if y > min(p1y, p2y):
+            if y <= max(p1y, p2y):
+                if x <= max(p1x, p2x):
+                    if p1y != p2y:
+                        xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                    if p1x == p2x or x <= xinters:
+                        inside = not inside
+        p1x, p1y = p2x, p2y
+
+    # Добавляем органические искажения
+    if inside and random.random() < organic_factor * 0.2:
+        inside = not inside  # Случайно исключаем некоторые пиксели
+
+    return inside
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк гранулярного colormap")
+    parser.add_argument("--size", type=int, default=1024, help="Размер colormap (квадрат)")
+    parser.add_argument("--repeats", type=int, default=3, help="Повторов на замер")
+    parser.add_argument("--granule-size", default="medium", choices=["small", "medium", "large"])
+    parser.add_argument("--atlas-variants", type=int, default=None,
+                        help="Вариантов маски в атласе гранул (0 — без атласа)")
+    parser.add_argument("--skip-legacy", action="store_true", help="Не замерять попиксельную реализацию")
+    args = parser.parse_args()
+
+    adapter = ColorGridControlNet(atlas_variants=args.atlas_variants)
+    size = (args.size, args.size)
+
+    print(f"📊 Гранулярный colormap {args.size}x{args.size}, гранулы: {args.granule_size}, "
+          f"атлас: {adapter.atlas_variants} вариантов, повторов: {args.repeats}")
+    print(f"{'цветов':>7} | {'PIL, с':>8} | {'NumPy, с':>9} | {'ускорение':>9}")
+    for color_count in range(1, 6):
+        colors = build_colors(color_count)
+        engine_time = measure(
+            lambda: adapter.create_optimized_colormap_and_hint(colors, size, "granular", args.granule_size), args.repeats
+        )
+        if args.skip_legacy:
+            print(f"{color_count:>7} | {'-':>8} | {engine_time:>9.3f} | {'-':>9}")
+            continue
+        legacy_time = measure(
+            lambda: legacy_granular_pattern_with_hint(adapter, colors, size, args.granule_size), args.repeats
+        )
+        print(f"{color_count:>7} | {legacy_time:>8.3f} | {engine_time:>9.3f} | {legacy_time / engine_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
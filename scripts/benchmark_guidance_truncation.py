@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк усечения classifier-free guidance на поздних шагах: полный CFG против
+отключения безусловной ветки после доли шагов (cutoff) или по порогу разницы ветвей (delta)
+по числу цветов — время генерации и цветовая точность финального изображения.
+Результаты копятся в Predictor.get_color_grid_stats()["guidance"] и пишутся в JSON.
+
+Запуск из корня проекта на машине с GPU:
+    python scripts/benchmark_guidance_truncation.py [--repeats 2] [--schedules full cutoff:0.6] [--output guidance.json]
+"""
+
+import argparse
+import json
+import sys
+
+sys.path.append('.')
+from guidance_schedule import parse_guidance_schedule
+from predict import Predictor
+from benchmark_color_conditioning import PROMPTS, predict_defaults
+
+SCHEDULES = ["full", "cutoff:0.8", "cutoff:0.6", "cutoff:0.4", "delta:0.05"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение расписаний CFG по числу цветов")
+    parser.add_argument("--repeats", type=int, default=2, help="Запусков на расписание и число цветов")
+    parser.add_argument("--schedules", nargs="+", default=SCHEDULES, help="Расписания CFG (как во входе guidance_schedule)")
+    parser.add_argument("--seed", type=int, default=12345, help="Seed первого запуска (далее seed+1, ...)")
+    parser.add_argument("--output", default="guidance_truncation.json", help="Файл результатов")
+    args = parser.parse_args()
+
+    # Нормализуем подписи, чтобы они совпали с ключами статистики
+    schedules = [str(parse_guidance_schedule(spec)) for spec in args.schedules]
+
+    predictor = Predictor()
+    predictor.setup()
+    defaults = predict_defaults(predictor)
+
+    for color_count, prompt in PROMPTS.items():
+        for schedule in schedules:
+            for repeat in range(args.repeats):
+                kwargs = dict(defaults, prompt=prompt, seed=args.seed + repeat, preview_every_n_steps=0,
+                              guidance_schedule=schedule)
+                for _ in predictor.predict(**kwargs):
+                    pass
+                print(f"✅ {schedule}, {color_count} цв., запуск {repeat + 1}/{args.repeats}")
+
+    comparison = predictor.get_color_grid_stats()["guidance"]
+    print(f"{'цветов':>6} | {'расписание':<14} | {'время, с':>8} | {'ускорение':>9} | {'точность':>8}")
+    for color_count in PROMPTS:
+        baseline = comparison.get("full", {}).get(str(color_count))
+        for schedule in schedules:
+            entry = comparison.get(schedule, {}).get(str(color_count))
+            if entry:
+                speedup = (f"x{baseline['mean_seconds'] / max(entry['mean_seconds'], 1e-9):.2f}"
+                           if baseline else "—")
+                print(f"{color_count:>6} | {schedule:<14} | {entry['mean_seconds']:>8.2f} | {speedup:>9} | "
+                      f"{entry['mean_fidelity']!s:>8}")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"schedules": schedules, "repeats": args.repeats, "guidance": comparison},
+                  f, ensure_ascii=False, indent=2)
+    print(f"📄 Результаты: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк пути «декодированное изображение -> файлы» (финал + превью 512):
+постобработка diffusers (output_type="pil") и LANCZOS на CPU против
+постобработки на GPU (device_postprocess) с передачей uint8 через pinned-память.
+С --vae в замер входит и VAE decode случайных латентов (одинаковый для обоих путей).
+
+Запуск из корня проекта на машине с CUDA:
+    python scripts/benchmark_postprocess.py [--batch 1] [--size 1024] [--repeats 5] [--vae madebyollin/sdxl-vae-fp16-fix]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append('.')
+import torch
+from PIL import Image
+
+import device_postprocess
+from output_writer import OutputWriter
+
+PREVIEW_SIZE = 512
+
+
+def measure(func, repeats):
+    """Медианное время выполнения func() в секундах (после одного прогревочного прогона)"""
+    func()
+    timings = []
+    for _ in range(repeats):
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def pil_path(images, writer, output_dir):
+    """Как при output_type="pil": float на CPU, денормализация в NumPy, PIL, LANCZOS-превью"""
+    arrays = images.cpu().permute(0, 2, 3, 1).float().numpy()
+    arrays = (arrays * 255).round().astype("uint8")
+    for index, array in enumerate(arrays):
+        final = Image.fromarray(array)
+        preview = final.resize((PREVIEW_SIZE, PREVIEW_SIZE), Image.Resampling.LANCZOS)
+        writer.encode(final, os.path.join(output_dir, f"final_{index}"), "png")
+        writer.encode(preview, os.path.join(output_dir, f"preview_{index}"), "jpeg")
+
+
+def device_path(images, writer, output_dir):
+    """uint8 и превью на GPU, на хост — только байты uint8"""
+    for index, (final, preview) in enumerate(device_postprocess.postprocess(images, PREVIEW_SIZE)):
+        writer.encode(final, os.path.join(output_dir, f"final_{index}"), "png")
+        writer.encode(preview, os.path.join(output_dir, f"preview_{index}"), "jpeg")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк постобработки декодированных изображений")
+    parser.add_argument("--batch", type=int, default=1, help="Изображений в батче")
+    parser.add_argument("--size", type=int, default=1024, help="Сторона изображения")
+    parser.add_argument("--repeats", type=int, default=5, help="Повторов на замер")
+    parser.add_argument("--vae", default="", help="VAE SDXL (repo id): включить decode латентов в замер")
+    args = parser.parse_args()
+
+    if not torch.cuda.is_available():
+        print("❌ Нужна CUDA: постобработка на GPU сравнивается с CPU-путем diffusers")
+        sys.exit(1)
+
+    vae = None
+    if args.vae:
+        from diffusers import AutoencoderKL
+        vae = AutoencoderKL.from_pretrained(args.vae, torch_dtype=torch.float16).to("cuda")
+    latents = torch.randn(args.batch, 4, args.size // 8, args.size // 8, device="cuda", dtype=torch.float16)
+    # Без VAE: фиксированное «декодированное» изображение с шумом, как у текстур плитки
+    decoded = torch.rand(args.batch, 3, args.size, args.size, device="cuda", dtype=torch.float16)
+
+    def decode():
+        if vae is None:
+            return decoded
+        with torch.no_grad():
+            images = vae.decode(latents / vae.config.scaling_factor).sample
+        return (images / 2 + 0.5).clamp(0, 1)
+
+    pil_writer = OutputWriter(pool=None, png_compress_level=1)
+    device_writer = OutputWriter(pool=None, png_compress_level=1)
+    float_mb = args.batch * 3 * args.size * args.size * 4 / 1024 / 1024
+    print(f"📐 Батч {args.batch}×{args.size}², VAE decode: {'да' if vae is not None else 'нет'}")
+    print(f"📦 На хост: float32 {float_mb:.1f} MB против uint8 {float_mb / 4:.1f} MB (+ превью)")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        pil_seconds = measure(lambda: pil_path(decode(), pil_writer, output_dir), args.repeats)
+        device_seconds = measure(lambda: device_path(decode(), device_writer, output_dir), args.repeats)
+
+    print(f"⏱️ decode -> файлы, CPU (output_type=pil): {pil_seconds * 1000:.1f} мс")
+    print(f"⏱️ decode -> файлы, GPU-постобработка:     {device_seconds * 1000:.1f} мс")
+    print(f"🚀 Ускорение: x{pil_seconds / max(device_seconds, 1e-9):.2f}")
+    print(f"📊 Кодирование (CPU / GPU путь): {pil_writer.stats} / {device_writer.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Сборка слитого fp16-чекпоинта SDXL для быстрого холодного старта:
+LoRA вливается в UNet (fuse_lora), токены <s0>/<s1> Textual Inversion
+добавляются в оба токенизатора и эмбеддинги текстовых энкодеров, pipeline
+сохраняется в safetensors вместе с манифестом исходников (fused_checkpoint.py).
+Predictor.setup загружает его вместо базовой модели + LoRA + TI.
+
+Запуск из корня проекта при сборке образа (нужны diffusers и PyTorch):
+    python scripts/build_fused_checkpoint.py [--output /src/model_files/fused-sdxl]
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append('.')
+import torch
+from diffusers import StableDiffusionXLPipeline
+from safetensors.torch import load_file
+
+import fused_checkpoint
+from stage_timer import StageTimer
+
+BASE_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+LORA_PATH = "/src/model_files/rubber-tile-lora-v4_sdxl_lora.safetensors"
+TI_PATH = "/src/model_files/rubber-tile-lora-v4_sdxl_embeddings.safetensors"
+TI_TOKENS = ["<s0>", "<s1>"]
+
+
+def install_textual_inversion(pipe, ti_path):
+    """Токены TI в оба энкодера: clip_g -> text_encoder_2, clip_l -> text_encoder"""
+    state_dict = load_file(ti_path)
+    pipe.load_textual_inversion(state_dict["clip_g"], token=TI_TOKENS,
+                                text_encoder=pipe.text_encoder_2, tokenizer=pipe.tokenizer_2)
+    pipe.load_textual_inversion(state_dict["clip_l"], token=TI_TOKENS,
+                                text_encoder=pipe.text_encoder, tokenizer=pipe.tokenizer)
+    return {
+        "tokenizer": pipe.tokenizer.convert_tokens_to_ids(TI_TOKENS),
+        "tokenizer_2": pipe.tokenizer_2.convert_tokens_to_ids(TI_TOKENS)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка слитого чекпоинта SDXL + LoRA + TI")
+    parser.add_argument("--base", default=BASE_MODEL, help="Базовая модель SDXL (repo id или путь)")
+    parser.add_argument("--lora", default=LORA_PATH, help="Файл LoRA (.safetensors)")
+    parser.add_argument("--ti", default=TI_PATH, help="Файл Textual Inversion с clip_g/clip_l")
+    parser.add_argument("--lora-scale", type=float, default=fused_checkpoint.LORA_SCALE,
+                        help="Вес LoRA при вливании в UNet (другой вес setup сочтет чекпоинт устаревшим)")
+    parser.add_argument("--output", default=os.environ.get("FUSED_CHECKPOINT_DIR", "/src/model_files/fused-sdxl"),
+                        help="Каталог слитого чекпоинта")
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    print(f"📥 Базовая модель: {args.base}")
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        args.base, torch_dtype=torch.float16, use_safetensors=True, variant="fp16"
+    )
+    timer.lap("load_base")
+
+    print(f"🔧 Вливание LoRA (scale={args.lora_scale}): {args.lora}")
+    pipe.load_lora_weights(os.path.dirname(args.lora), weight_name=os.path.basename(args.lora))
+    pipe.fuse_lora(lora_scale=args.lora_scale)
+    pipe.unload_lora_weights()
+    timer.lap("fuse_lora")
+
+    print(f"🔤 Textual Inversion: {args.ti}")
+    token_ids = install_textual_inversion(pipe, args.ti)
+    timer.lap("textual_inversion")
+
+    os.makedirs(args.output, exist_ok=True)
+    pipe.save_pretrained(args.output, safe_serialization=True, variant="fp16")
+    fused_checkpoint.write_manifest(
+        args.output, {"lora": args.lora, "ti": args.ti},
+        base_model=args.base, lora_scale=args.lora_scale, tokens=TI_TOKENS, token_ids=token_ids
+    )
+    timer.lap("save")
+
+    print(f"✅ Слитый чекпоинт: {args.output} (токены {token_ids})")
+    print(f"⏱️ {timer.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Замер длительности фаз (setup, запрос): время между отметками или внутри блока
+with, сводка для логов и JSON. run_until_steady() повторяет прогон (прогрев),
+пока его время не перестанет меняться. StageProfiler — профиль запроса: время
+по часам и на устройстве (синхронизация или пары событий таймера), пиковая VRAM
+и RSS по стадиям и по шагам денойзинга. Модуль не зависит от PyTorch:
+синхронизация, события таймера и замер памяти передаются функциями.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+MB = 1024 * 1024
+
+
+class StageTimer:
+    """Длительности именованных фаз в секундах.
+
+    lap(name) записывает время от предыдущей отметки (или от создания),
+    stage(name) — время внутри блока with. Повторная фаза с тем же именем
+    суммируется. summary() — строка для логов, to_dict() — для JSON.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._last = self._start
+        self.stages: Dict[str, float] = {}
+
+    def _add(self, name: str, seconds: float) -> float:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        return seconds
+
+    def lap(self, name: str) -> float:
+        """Закрывает фазу name: время от предыдущей отметки."""
+        now = time.perf_counter()
+        seconds = now - self._last
+        self._last = now
+        return self._add(name, seconds)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Фаза name — время выполнения блока with (отметки lap не сдвигает)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, time.perf_counter() - start)
+
+    def total(self) -> float:
+        """Время с момента создания таймера."""
+        return time.perf_counter() - self._start
+
+    def to_dict(self) -> Dict[str, float]:
+        """Фазы и общее время, округленные до миллисекунд."""
+        result = {name: round(seconds, 3) for name, seconds in self.stages.items()}
+        result["total"] = round(self.total(), 3)
+        return result
+
+    def summary(self) -> str:
+        """Строка вида 'pipeline=12.40s, lora=0.00s, total=15.02s'."""
+        return ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.to_dict().items())
+
+
+def run_until_steady(run: Callable[[], None], max_runs: int = 3, tolerance: float = 0.1) -> List[float]:
+    """Выполняет run() до max_runs раз, пока время прогона не сравняется с предыдущим
+    (отличие не больше tolerance); возвращает длительности прогонов в секундах."""
+    durations: List[float] = []
+    for _ in range(max(1, max_runs)):
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+        if len(durations) >= 2 and abs(durations[-1] - durations[-2]) <= tolerance * durations[-2]:
+            break
+    return durations
+
+
+class StageProfiler:
+    """Профиль одного запроса по стадиям.
+
+    Для GPU-стадий wall_ms — время по часам (запуск ядер), cuda_ms — время на
+    устройстве: между синхронизациями synchronize() на границах стадии или, без
+    синхронизации, между событиями timing_event() (record() в начале и в конце,
+    elapsed_time() в мс — как torch.cuda.Event(enable_timing=True)); события
+    разрешаются в to_dict(), когда работа запроса уже выполнена, и хост не
+    простаивает. Без обоих способов cuda_ms — None. Пиковая VRAM стадии —
+    memory_probe()["vram_peak"] после reset_peak() в ее начале; без reset_peak
+    пики стадий не пишутся (счетчик общий для запроса), остается пик запроса.
+    Для CPU-стадий (gpu=False, в том числе из потоков пула) — только wall_ms и RSS.
+    memory_probe() возвращает байты: vram_peak, vram_reserved_peak, rss.
+
+    lap(name) закрывает стадию от предыдущей отметки основной линии запроса,
+    stage(name) — блок with, record_step() — шаг денойзинга. Повторы стадии
+    суммируются (count). to_dict() — для generation_data.json и лог-строки.
+    """
+
+    def __init__(self, synchronize: Optional[Callable[[], None]] = None,
+                 memory_probe: Optional[Callable[[], Dict[str, int]]] = None,
+                 reset_peak: Optional[Callable[[], None]] = None,
+                 timing_event: Optional[Callable[[], Any]] = None):
+        self.synchronize = synchronize
+        self.memory_probe = memory_probe
+        self.reset_peak = reset_peak
+        self.timing_event = timing_event if synchronize is None else None
+        # Неразрешенные пары событий: (стадия, индекс шага или None, начало, конец)
+        self._pending_events: List[tuple] = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._lap_begin = (self._start, self._start, None)
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.steps_ms: List[float] = []
+        self.vram_peak_bytes = 0
+        self.vram_reserved_peak_bytes = 0
+        self.rss_peak_bytes = 0
+
+    def begin(self, gpu: bool = True) -> tuple:
+        """Начало стадии: (время по часам, время после синхронизации, событие начала);
+        для GPU сбрасывает пики VRAM."""
+        wall_start = time.perf_counter()
+        if gpu and self.synchronize is not None:
+            self.synchronize()
+        synced_start = time.perf_counter()
+        if gpu and self.reset_peak is not None:
+            self.reset_peak()
+        start_event = None
+        if gpu and self.timing_event is not None:
+            start_event = self.timing_event()
+            start_event.record()
+        return wall_start, synced_start, start_event
+
+    def end(self, begin: tuple, gpu: bool = True) -> Dict[str, Any]:
+        """Конец стадии: длительности и память (для записи в один или несколько профилей)."""
+        wall_end = time.perf_counter()
+        if gpu and self.synchronize is not None:
+            self.synchronize()
+        synced_end = time.perf_counter()
+        events = None
+        if gpu and begin[2] is not None:
+            end_event = self.timing_event()
+            end_event.record()
+            events = (begin[2], end_event)
+        memory = self.memory_probe() if self.memory_probe is not None else {}
+        return {
+            "wall_ms": (wall_end - begin[0]) * 1000,
+            "cuda_ms": (synced_end - begin[1]) * 1000 if gpu and self.synchronize is not None else None,
+            "cuda_events": events,
+            "vram_peak": memory.get("vram_peak") if gpu else None,
+            "vram_reserved_peak": memory.get("vram_reserved_peak") if gpu else None,
+            "rss": memory.get("rss")
+        }
+
+    def record(self, name: str, measurement: Dict[str, Any], step: Optional[int] = None) -> None:
+        """Добавляет замер стадии name (повторы суммируются, пики памяти — максимум)."""
+        with self._lock:
+            if measurement.get("cuda_events") is not None:
+                self._pending_events.append((name, step, *measurement["cuda_events"]))
+            stage = self.stages.setdefault(name, {"count": 0, "wall_ms": 0.0, "cuda_ms": None,
+                                                  "vram_peak_mb": None, "rss_peak_mb": None})
+            stage["count"] += 1
+            stage["wall_ms"] = round(stage["wall_ms"] + measurement["wall_ms"], 3)
+            if measurement.get("cuda_ms") is not None:
+                stage["cuda_ms"] = round((stage["cuda_ms"] or 0.0) + measurement["cuda_ms"], 3)
+            if measurement.get("vram_peak") is not None:
+                self.vram_peak_bytes = max(self.vram_peak_bytes, measurement["vram_peak"])
+                if self.reset_peak is not None:
+                    stage["vram_peak_mb"] = max(stage["vram_peak_mb"] or 0.0, round(measurement["vram_peak"] / MB, 1))
+            if measurement.get("vram_reserved_peak") is not None:
+                self.vram_reserved_peak_bytes = max(self.vram_reserved_peak_bytes, measurement["vram_reserved_peak"])
+            if measurement.get("rss") is not None:
+                self.rss_peak_bytes = max(self.rss_peak_bytes, measurement["rss"])
+                stage["rss_peak_mb"] = max(stage["rss_peak_mb"] or 0.0, round(measurement["rss"] / MB, 1))
+
+    def record_step(self, measurement: Dict[str, Any]) -> None:
+        """Шаг денойзинга: отдельный список длительностей и сумма в стадии denoise.
+        С событиями таймера длительность шага заменяется временем на устройстве в to_dict()."""
+        with self._lock:
+            step = len(self.steps_ms)
+            self.steps_ms.append(round(measurement["cuda_ms"] if measurement.get("cuda_ms") is not None
+                                       else measurement["wall_ms"], 3))
+        self.record("denoise", measurement, step)
+
+    def _resolve_events(self) -> None:
+        """Время на устройстве по записанным парам событий (вызывается под self._lock)."""
+        for name, step, start_event, end_event in self._pending_events:
+            if hasattr(end_event, "synchronize"):
+                end_event.synchronize()
+            cuda_ms = start_event.elapsed_time(end_event)
+            stage = self.stages[name]
+            stage["cuda_ms"] = round((stage["cuda_ms"] or 0.0) + cuda_ms, 3)
+            if step is not None:
+                self.steps_ms[step] = round(cuda_ms, 3)
+        self._pending_events = []
+
+    @contextmanager
+    def stage(self, name: str, gpu: bool = True) -> Iterator[None]:
+        """Стадия name — блок with."""
+        with profile_stage([self], name, gpu):
+            yield
+
+    def lap(self, name: str, gpu: bool = True) -> None:
+        """Закрывает стадию name основной линии запроса от предыдущей отметки и начинает следующую."""
+        self.record(name, self.end(self._lap_begin, gpu))
+        self._lap_begin = self.begin(gpu)
+
+    def peaks(self) -> Dict[str, int]:
+        """Пики VRAM запроса в формате снимка MemoryGovernor."""
+        return {"peak_allocated": self.vram_peak_bytes, "peak_reserved": self.vram_reserved_peak_bytes}
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Стадии, шаги денойзинга и пики памяти запроса."""
+        with self._lock:
+            self._resolve_events()
+            return {
+                "total_ms": round((time.perf_counter() - self._start) * 1000, 3),
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "steps_ms": list(self.steps_ms),
+                "vram_peak_mb": round(self.vram_peak_bytes / MB, 1),
+                "rss_peak_mb": round(self.rss_peak_bytes / MB, 1)
+            }
+
+
+@contextmanager
+def profile_stage(profilers: Sequence[Optional[StageProfiler]], name: str, gpu: bool = True) -> Iterator[None]:
+    """Стадия, общая для нескольких запросов (например, один батч): замер один раз — запись в каждый профиль.
+    Пустой список (или только None) — без замера."""
+    active = [profiler for profiler in profilers if profiler is not None]
+    if not active:
+        yield
+        return
+    begin = active[0].begin(gpu)
+    try:
+        yield
+    finally:
+        measurement = active[0].end(begin, gpu)
+        for profiler in active:
+            profiler.record(name, measurement)
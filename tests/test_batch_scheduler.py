@@ -0,0 +1,96 @@
+"""
+Tests for the micro-batching request scheduler (batch_scheduler.py)
+"""
+
+import threading
+import time
+
+import pytest
+
+from batch_scheduler import MicroBatchScheduler
+
+
+class StubPipeline:
+    """Stands in for the diffusion pipeline: one 'image' per prompt, records batch sizes"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, prompts, steps):
+        self.calls.append((list(prompts), steps))
+        time.sleep(self.delay)
+        return [f"{prompt}@{steps}" for prompt in prompts]
+
+
+def _run_with_stub(pipeline):
+    def run_batch(key, payloads):
+        steps = key
+        images = pipeline([prompt for prompts in payloads for prompt in prompts], steps)
+        results, offset = [], 0
+        for prompts in payloads:
+            results.append(images[offset:offset + len(prompts)])
+            offset += len(prompts)
+        return results
+    return run_batch
+
+
+def _submit_concurrently(scheduler, submissions):
+    futures = [None] * len(submissions)
+
+    def submit(index, key, prompts):
+        futures[index] = scheduler.submit(key, prompts, len(prompts))
+
+    threads = [threading.Thread(target=submit, args=(i, key, prompts)) for i, (key, prompts) in enumerate(submissions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [future.result(timeout=5) for future in futures]
+
+
+class TestMicroBatchScheduler:
+    """Test grouping, limits, fan-out and metrics of the scheduler"""
+
+    @pytest.mark.unit
+    def test_groups_compatible_requests_and_fans_out(self):
+        pipeline = StubPipeline()
+        scheduler = MicroBatchScheduler(_run_with_stub(pipeline), max_batch_size=4, max_wait_ms=200)
+        results = _submit_concurrently(scheduler, [(25, ["a"]), (25, ["b"]), (30, ["c"]), (25, ["d"])])
+        scheduler.shutdown()
+        assert results == [["a@25"], ["b@25"], ["c@30"], ["d@25"]]
+        assert sorted(len(prompts) for prompts, _ in pipeline.calls) == [1, 3]
+        assert all(len(set(prompt.split("@")[0] for prompt in prompts)) == len(prompts) for prompts, _ in pipeline.calls)
+        assert scheduler.stats["batches"] == 2 and scheduler.stats["requests"] == 4
+
+    @pytest.mark.unit
+    def test_batch_size_limit_and_fill_rate(self):
+        pipeline = StubPipeline()
+        scheduler = MicroBatchScheduler(_run_with_stub(pipeline), max_batch_size=2, max_wait_ms=200)
+        results = _submit_concurrently(scheduler, [(25, ["a"]), (25, ["b"]), (25, ["c"]), (25, ["d"])])
+        scheduler.shutdown()
+        assert sorted(result[0] for result in results) == ["a@25", "b@25", "c@25", "d@25"]
+        assert [len(prompts) for prompts, _ in pipeline.calls] == [2, 2]
+        assert scheduler.stats["mean_fill_rate"] == pytest.approx(1.0)
+
+    @pytest.mark.unit
+    def test_no_window_when_should_wait_is_false(self):
+        scheduler = MicroBatchScheduler(_run_with_stub(StubPipeline()), max_batch_size=4, max_wait_ms=5000,
+                                        should_wait=lambda: False)
+        start = time.perf_counter()
+        assert scheduler.submit(25, ["solo"]).result(timeout=5) == ["solo@25"]
+        scheduler.shutdown()
+        assert time.perf_counter() - start < 1.0
+        assert scheduler.stats["mean_fill_rate"] == pytest.approx(0.25)
+
+    @pytest.mark.unit
+    def test_errors_propagate_to_every_caller(self):
+        def failing(key, payloads):
+            raise ValueError("boom")
+
+        scheduler = MicroBatchScheduler(failing, max_batch_size=2, max_wait_ms=200)
+        first, second = scheduler.submit(1, "a"), scheduler.submit(1, "b")
+        for future in (first, second):
+            with pytest.raises(ValueError):
+                future.result(timeout=5)
+        scheduler.shutdown()
@@ -0,0 +1,423 @@
+"""
+Tests for the vectorized NumPy colormap engine (colormap_engine.py)
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import colormap_engine
+
+GRANULE_PARAMS = {"min_size": 3, "max_size": 6, "density": 0.8, "variation": 0.4}
+CALIBRATION = {
+    "min_granule_size": 2,
+    "max_granule_size": 8,
+    "size_variation": 0.4,
+    "form_complexity": 0.6,
+    "organic_factor": 0.7
+}
+RGB_COLORS = [(255, 0, 0), (0, 0, 255), (255, 255, 255)]
+
+
+class TestGranularLabelMap:
+    """Test the batched granular label map builder"""
+
+    @pytest.mark.unit
+    def test_margins_stay_transparent(self):
+        size = (256, 256)
+        margin_x, margin_y, work_width, work_height = colormap_engine.compute_work_area(size)
+        quotas = [int(work_width * work_height * 0.8 / 3)] * 3
+        labels = colormap_engine.build_granular_label_map(
+            quotas, size, GRANULE_PARAMS, CALIBRATION, np.random.default_rng(0)
+        )
+        assert labels.shape == (256, 256)
+        assert not labels[:margin_y].any() and not labels[margin_y + work_height:].any()
+        assert not labels[:, :margin_x].any() and not labels[:, margin_x + work_width:].any()
+
+    @pytest.mark.unit
+    def test_every_color_is_placed(self):
+        size = (256, 256)
+        _, _, work_width, work_height = colormap_engine.compute_work_area(size)
+        quotas = [int(work_width * work_height * 0.8 * p) for p in (0.6, 0.3, 0.1)]
+        labels = colormap_engine.build_granular_label_map(
+            quotas, size, GRANULE_PARAMS, CALIBRATION, np.random.default_rng(1)
+        )
+        counts = np.bincount(labels.ravel(), minlength=4)[1:]
+        assert (counts > 0).all()
+        assert counts[0] > counts[2]
+
+    @pytest.mark.unit
+    def test_same_seed_is_reproducible(self):
+        size = (128, 128)
+        quotas = [4000, 4000]
+        first = colormap_engine.build_granular_label_map(
+            quotas, size, GRANULE_PARAMS, CALIBRATION, np.random.default_rng(42)
+        )
+        second = colormap_engine.build_granular_label_map(
+            quotas, size, GRANULE_PARAMS, CALIBRATION, np.random.default_rng(42)
+        )
+        assert np.array_equal(first, second)
+
+
+class TestRenderLabelMap:
+    """Test palette rendering of label maps into RGBA colormap and L hint"""
+
+    @pytest.mark.unit
+    def test_rgba_and_hint_match_palette(self):
+        labels = np.array([[0, 1], [2, 3]], dtype=np.uint8)
+        colormap, hint = colormap_engine.render_label_map(labels, RGB_COLORS)
+        assert colormap.mode == "RGBA" and hint.mode == "L"
+        rgba = np.array(colormap)
+        assert tuple(rgba[0, 0]) == colormap_engine.TRANSPARENT_RGBA
+        assert tuple(rgba[0, 1]) == (255, 0, 0, 255)
+        assert np.array(hint).tolist() == [[0, colormap_engine.luma((255, 0, 0))],
+                                           [colormap_engine.luma((0, 0, 255)), 255]]
+
+
+class TestRandomLabelMap:
+    """Test the exact-quota random pattern"""
+
+    @pytest.mark.unit
+    def test_largest_remainder_quotas_sum_exactly(self):
+        quotas = colormap_engine.allocate_quotas([1, 1, 1], 100)
+        assert quotas.tolist() == [34, 33, 33]
+        assert colormap_engine.allocate_quotas([0.6, 0.4], 0).tolist() == [0, 0]
+        assert colormap_engine.allocate_quotas([0, 0], 10).tolist() == [0, 0]
+
+    @pytest.mark.unit
+    def test_pixel_counts_match_quotas(self):
+        size = (300, 200)
+        _, _, work_width, work_height = colormap_engine.compute_work_area(size)
+        proportions = [0.5, 0.3, 0.2]
+        labels = colormap_engine.build_random_label_map(proportions, size, np.random.default_rng(3))
+        counts = np.bincount(labels.ravel(), minlength=4)[1:]
+        expected = colormap_engine.allocate_quotas(proportions, work_width * work_height)
+        assert counts.tolist() == expected.tolist()
+        assert counts.sum() == work_width * work_height
+
+
+class TestGranuleAtlas:
+    """Test the pre-rasterized granule atlas"""
+
+    @pytest.mark.unit
+    def test_atlas_covers_calibrated_sizes(self):
+        atlas = colormap_engine.GranuleAtlas.build(CALIBRATION, variants=8)
+        for size in range(2, 9):
+            for complex_shape in (False, True):
+                assert atlas.masks[(complex_shape, size)].shape == (8, 2 * size + 1, 2 * size + 1)
+        assert atlas.masks[(False, 4)][:, 4, 4].all()
+
+    @pytest.mark.unit
+    def test_disk_cache_roundtrip(self, tmp_path):
+        built = colormap_engine.GranuleAtlas.load_or_build(CALIBRATION, 4, str(tmp_path))
+        cached = list(tmp_path.glob("granule_atlas_*.npz"))
+        assert len(cached) == 1
+        loaded = colormap_engine.GranuleAtlas.load_or_build(CALIBRATION, 4, str(tmp_path))
+        assert loaded.variants == 4
+        for key, masks in built.masks.items():
+            assert np.array_equal(loaded.masks[key], masks)
+
+    @pytest.mark.unit
+    def test_label_map_with_atlas(self):
+        atlas = colormap_engine.GranuleAtlas.build(CALIBRATION, variants=16)
+        labels = colormap_engine.build_granular_label_map(
+            [3000, 2000], (128, 128), GRANULE_PARAMS, CALIBRATION, np.random.default_rng(5), atlas
+        )
+        counts = np.bincount(labels.ravel(), minlength=3)
+        assert counts[1] > 0 and counts[2] > 0
+
+
+class TestGridAndRadialLabelMaps:
+    """Test the rejection-free grid and radial samplers"""
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize("builder", [colormap_engine.build_grid_label_map,
+                                         colormap_engine.build_radial_label_map])
+    def test_quotas_are_met_exactly(self, builder):
+        size = (200, 160)
+        _, _, work_width, work_height = colormap_engine.compute_work_area(size)
+        proportions = [0.7, 0.2, 0.1]
+        labels = builder(proportions, size, np.random.default_rng(11))
+        counts = np.bincount(labels.ravel(), minlength=4)[1:]
+        expected = colormap_engine.allocate_quotas(proportions, work_width * work_height)
+        assert counts.tolist() == expected.tolist()
+
+    @pytest.mark.unit
+    def test_radial_first_color_gravitates_to_center(self):
+        size = (200, 200)
+        labels = colormap_engine.build_radial_label_map([0.2, 0.8], size, np.random.default_rng(2))
+        ys, xs = np.nonzero(labels == 1)
+        first_radius = np.hypot(xs - 100, ys - 100).mean()
+        ys, xs = np.nonzero(labels == 2)
+        second_radius = np.hypot(xs - 100, ys - 100).mean()
+        assert first_radius < second_radius
+
+
+class TestLabelMap:
+    """Test the palette-indexed label-map representation"""
+
+    @staticmethod
+    def _label_map():
+        labels = np.zeros((32, 48), dtype=np.uint8)
+        labels[4:20, 6:30] = 1
+        labels[20:28, 10:40] = 2
+        return colormap_engine.LabelMap(labels, [(255, 0, 0), (0, 0, 255)])
+
+    @pytest.mark.unit
+    def test_indexed_png_round_trip(self, tmp_path):
+        label_map = self._label_map()
+        path = tmp_path / "colormap.png"
+        label_map.save(str(path))
+        with Image.open(path) as saved:
+            assert saved.mode == "P"
+            restored = np.asarray(saved.convert("RGBA"))
+        assert np.array_equal(restored, np.asarray(label_map.rgba))
+
+    @pytest.mark.unit
+    def test_one_byte_per_pixel_and_lazy_views(self):
+        label_map = self._label_map()
+        assert label_map.size == (48, 32)
+        assert label_map.nbytes < 48 * 32 * 4 / 3
+        assert label_map.rgba is label_map.rgba
+        assert label_map.hint.getpixel((6, 4)) == colormap_engine.luma((255, 0, 0))
+        assert label_map.pixel_counts().tolist() == [48 * 32 - 16 * 24 - 8 * 30, 16 * 24, 8 * 30]
+
+    @pytest.mark.unit
+    def test_rgb_fills_background(self):
+        rgb = self._label_map().rgb(background=(10, 20, 30))
+        assert rgb.mode == "RGB" and rgb.size == (48, 32)
+        assert rgb.getpixel((0, 0)) == (10, 20, 30)
+        assert rgb.getpixel((6, 4)) == (255, 0, 0)
+        assert rgb.getpixel((10, 20)) == (0, 0, 255)
+
+    @pytest.mark.unit
+    def test_resized_keeps_palette(self):
+        resized = self._label_map().resized((24, 16))
+        assert resized.size == (24, 16)
+        assert set(np.unique(resized.labels)) <= {0, 1, 2}
+        assert resized.rgb_colors == [(255, 0, 0), (0, 0, 255)]
+
+
+class TestLabelPyramid:
+    """Test the proportion-preserving colormap pyramid"""
+
+    @pytest.mark.unit
+    def test_levels_keep_exact_proportions(self):
+        rng = np.random.default_rng(0)
+        labels = colormap_engine.build_random_label_map([0.5, 0.3, 0.15, 0.05], (256, 256), rng)
+        label_map = colormap_engine.LabelMap(labels, [(255, 0, 0), (255, 255, 255), (0, 0, 255), (0, 255, 0)])
+        pyramid = colormap_engine.build_label_pyramid(label_map, (256, 128, 64, 32))
+        assert sorted(pyramid) == [32, 64, 128, 256]
+        assert pyramid[256] is label_map
+        for width, level in pyramid.items():
+            assert level.size == (width, width)
+            expected = colormap_engine.allocate_quotas(label_map.pixel_counts(), width * width)
+            assert level.pixel_counts().tolist() == expected.tolist()
+
+    @pytest.mark.unit
+    def test_uniform_blocks_are_unchanged(self):
+        labels = colormap_engine.build_stripe_label_map([0.5, 0.25, 0.25], (64, 16))
+        assert labels[0].tolist() == [1] * 32 + [2] * 16 + [3] * 16
+        level = colormap_engine.downsample_label_map(
+            colormap_engine.LabelMap(labels, [(1, 1, 1), (2, 2, 2), (3, 3, 3)]), (16, 4), np.random.default_rng(1)
+        )
+        assert level.labels[0].tolist() == [1] * 8 + [2] * 4 + [3] * 4
+
+    @pytest.mark.unit
+    def test_artifact_legend_is_pyramid_level(self):
+        labels = colormap_engine.build_random_label_map([0.7, 0.3], (1024, 1024), np.random.default_rng(2))
+        label_map = colormap_engine.LabelMap(labels, [(255, 0, 0), (0, 0, 255)])
+        artifact = colormap_engine.ColormapArtifact([], label_map, 3, "random", "medium", 0.0)
+        assert sorted(artifact.pyramid) == [128, 256, 512, 1024]
+        assert artifact.legend is artifact.pyramid[256]
+        assert artifact.level(128).size == (128, 128)
+
+    @pytest.mark.unit
+    def test_legend_builds_only_its_level(self):
+        labels = colormap_engine.build_random_label_map([0.7, 0.3], (1024, 1024), np.random.default_rng(2))
+        artifact = colormap_engine.ColormapArtifact(
+            [], colormap_engine.LabelMap(labels, [(255, 0, 0), (0, 0, 255)]), 3, "random", "medium", 0.0
+        )
+        assert artifact.legend.size == (256, 256)
+        assert sorted(artifact._levels) == [256]
+
+
+class TestColormapCache:
+    """Test the cross-request LRU colormap cache"""
+
+    @staticmethod
+    def _label_map(value=0):
+        return colormap_engine.LabelMap(np.ones((16, 16), dtype=np.uint8), [(value, 0, 0)])
+
+    @pytest.mark.unit
+    def test_key_normalizes_proportions(self):
+        first = colormap_engine.colormap_cache_key(
+            [{"name": "red", "proportion": 60}, {"name": "WHITE", "proportion": 40}], (1024, 1024), "granular", "medium", 0
+        )
+        second = colormap_engine.colormap_cache_key(
+            [{"name": "RED", "proportion": 0.6}, {"name": "WHITE", "proportion": 0.4}], (1024, 1024), "granular", "medium", 0
+        )
+        other_seed = colormap_engine.colormap_cache_key(
+            [{"name": "RED", "proportion": 0.6}, {"name": "WHITE", "proportion": 0.4}], (1024, 1024), "granular", "medium", 1
+        )
+        assert first == second
+        assert first != other_seed
+
+    @pytest.mark.unit
+    def test_key_includes_engine_parameters(self):
+        colors = [{"name": "RED", "proportion": 1.0}]
+        base = colormap_engine.colormap_cache_key(colors, (64, 64), "granular", "medium", 0)
+        atlas = colormap_engine.colormap_cache_key(colors, (64, 64), "granular", "medium", 0, {"atlas": "a"})
+        other_atlas = colormap_engine.colormap_cache_key(colors, (64, 64), "granular", "medium", 0, {"atlas": "b"})
+        assert len({base, atlas, other_atlas}) == 3
+
+    @pytest.mark.unit
+    def test_hits_return_fresh_maps_without_rendered_images(self):
+        cache = colormap_engine.ColormapCache(max_bytes=10 ** 6)
+        label_map = self._label_map(5)
+        label_map.rgba
+        cache.put("key", label_map)
+        first = cache.get("key")
+        first.rgba, first.hint
+        second = cache.get("key")
+        assert first is not second and second is not label_map
+        assert second._rgba is None and second._hint is None
+        assert second.labels is label_map.labels
+        assert cache.stats["bytes"] == label_map.nbytes
+
+    @pytest.mark.unit
+    def test_lru_eviction_by_byte_budget(self):
+        entry_bytes = self._label_map().nbytes
+        cache = colormap_engine.ColormapCache(max_bytes=2 * entry_bytes)
+        cache.put("a", self._label_map(1))
+        cache.put("b", self._label_map(2))
+        assert cache.get("a") is not None
+        cache.put("c", self._label_map(3))
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+        assert cache.stats["evictions"] == 1
+        assert cache.stats["hits"] == 3 and cache.stats["misses"] == 1
+        assert cache.stats["bytes"] == 2 * entry_bytes
+
+    @pytest.mark.unit
+    def test_disk_tier_survives_new_process_cache(self, tmp_path):
+        cache = colormap_engine.ColormapCache(max_bytes=10 ** 6, disk_dir=str(tmp_path))
+        cache.put("key", self._label_map(7))
+        fresh = colormap_engine.ColormapCache(max_bytes=10 ** 6, disk_dir=str(tmp_path))
+        label_map = fresh.get("key")
+        assert label_map.rgba.getpixel((0, 0)) == (7, 0, 0, 255)
+        assert label_map.hint.getpixel((3, 3)) == colormap_engine.luma((7, 0, 0))
+        assert fresh.stats["disk_hits"] == 1
+
+
+class TestColormapArtifact:
+    """Test the per-request colormap artifact"""
+
+    @pytest.mark.unit
+    def test_legend_and_rebuild_bookkeeping(self):
+        label_map = colormap_engine.LabelMap(np.ones((64, 64), dtype=np.uint8), [(255, 0, 0)])
+        artifact = colormap_engine.ColormapArtifact(
+            [{"name": "RED", "proportion": 1.0}], label_map, 7, "random", "medium", 0.01
+        )
+        assert artifact.legend.size == (256, 256)
+        assert artifact.legend is artifact.legend
+        artifact.replace(colormap_engine.LabelMap(np.ones((64, 64), dtype=np.uint8), [(0, 0, 255)]), 0.02)
+        assert artifact.legend.rgba.getpixel((0, 0)) == (0, 0, 255, 255)
+        data = artifact.to_dict()
+        assert data["generations"] == 2 and data["rebuilt"] is True and data["seed"] == 7
+        assert data["pixel_counts"] == [64 * 64] and data["transparent_pixels"] == 0
+
+
+class TestColorAnalysis:
+    """Test the vectorized colormap color analysis"""
+
+    @staticmethod
+    def _naive_unique(pixels, tolerance=10):
+        unique_colors = []
+        for pixel in pixels:
+            if not any(np.allclose(pixel, existing, atol=tolerance) for existing in unique_colors):
+                unique_colors.append(pixel)
+        return len(unique_colors)
+
+    @pytest.mark.unit
+    def test_clusters_match_per_pixel_loop(self):
+        rng = np.random.default_rng(0)
+        base = np.array([[200, 30, 30], [30, 30, 200], [100, 100, 100]])
+        pixels = (base[rng.integers(0, 3, 600)] + rng.integers(-12, 13, (600, 3))).clip(0, 255).astype(np.uint8)
+        image = Image.fromarray(pixels.reshape(20, 30, 3), "RGB")
+        rgb, counts, total = colormap_engine.count_opaque_colors(image)
+        _, cluster_counts = colormap_engine.cluster_colors(rgb, counts, tolerance=10)
+        assert total == 600 and counts.sum() == 600
+        assert cluster_counts.size == self._naive_unique(pixels.astype(np.int64))
+        assert cluster_counts.sum() == 600
+
+    @pytest.mark.unit
+    def test_report_shares_for_label_map_and_rgba(self):
+        labels = np.zeros((10, 10), dtype=np.uint8)
+        labels[:6] = 1
+        labels[6:9] = 2
+        label_map = colormap_engine.LabelMap(labels, [(255, 0, 0), (255, 255, 255)])
+        targets = [{"name": "RED", "rgb": (255, 0, 0), "proportion": 0.6},
+                   {"name": "WHITE", "rgb": (255, 255, 255), "proportion": 0.4}]
+        for colormap in (label_map, label_map.rgba):
+            report = colormap_engine.analyze_colormap_colors(colormap, targets)
+            assert report["valid"] and report["found_count"] == 2
+            assert report["opaque_pixels"] == 90 and report["total_pixels"] == 100
+            assert report["colors"][0]["share"] == pytest.approx(60 / 90, abs=1e-4)
+            assert report["colors"][1]["target"] == pytest.approx(0.4)
+
+    @pytest.mark.unit
+    def test_transparent_and_too_many_colors(self):
+        targets = [{"name": "RED", "rgb": (255, 0, 0), "proportion": 1.0}]
+        transparent = Image.new("RGBA", (8, 8), colormap_engine.TRANSPARENT_RGBA)
+        assert colormap_engine.analyze_colormap_colors(transparent, targets)["reason"] == "transparent"
+        stripes = np.repeat(np.arange(0, 256, 40, dtype=np.uint8), 3).reshape(1, -1, 3)
+        report = colormap_engine.analyze_colormap_colors(Image.fromarray(stripes, "RGB"), targets)
+        assert report["reason"] == "too_many_colors" and not report["valid"]
+
+
+class TestColorFidelity:
+    """Test color fidelity of generated images against the prompt colors"""
+
+    TARGETS = [{"name": "RED", "rgb": (255, 0, 0), "proportion": 60},
+               {"name": "WHITE", "rgb": (255, 255, 255), "proportion": 40}]
+
+    @pytest.mark.unit
+    def test_exact_proportions_give_full_fidelity(self):
+        pixels = np.full((100, 100, 3), 255, dtype=np.uint8)
+        pixels[:60, :, 1:] = 0
+        report = colormap_engine.measure_color_fidelity(Image.fromarray(pixels, "RGB"), self.TARGETS, sample_size=100)
+        assert report["fidelity"] == pytest.approx(1.0)
+        assert report["mean_color_error"] == 0.0
+        assert [color["share"] for color in report["colors"]] == [0.6, 0.4]
+
+    @pytest.mark.unit
+    def test_shifted_colors_assigned_to_nearest_target(self):
+        pixels = np.zeros((100, 100, 3), dtype=np.uint8)
+        pixels[:] = (200, 40, 30)  # Muted red: everything is nearest to RED
+        report = colormap_engine.measure_color_fidelity(Image.fromarray(pixels, "RGB"), self.TARGETS, sample_size=50)
+        assert report["colors"][0]["share"] == 1.0
+        assert report["colors"][0]["delta"] == pytest.approx(0.4)
+        assert report["fidelity"] == pytest.approx(0.6)
+        assert report["mean_color_error"] > 0
+
+    @pytest.mark.unit
+    def test_wrong_color_scores_zero(self):
+        blue = Image.new("RGB", (64, 64), (0, 0, 255))
+        report = colormap_engine.measure_color_fidelity(blue, [{"name": "RED", "rgb": (255, 0, 0), "proportion": 100}])
+        assert report["off_target"] == 1.0
+        assert report["fidelity"] == pytest.approx(0.0)
+
+    @pytest.mark.unit
+    def test_off_target_pixels_count_against_fidelity(self):
+        pixels = np.zeros((100, 100, 3), dtype=np.uint8)  # Black instead of RED
+        pixels[60:] = 255  # WHITE where expected
+        report = colormap_engine.measure_color_fidelity(Image.fromarray(pixels, "RGB"), self.TARGETS, sample_size=100)
+        assert report["off_target"] == pytest.approx(0.6)
+        assert report["colors"][0]["share"] == 0.0 and report["colors"][1]["share"] == pytest.approx(0.4)
+        assert report["fidelity"] == pytest.approx(0.4)
+
+    @pytest.mark.unit
+    def test_no_targets(self):
+        report = colormap_engine.measure_color_fidelity(Image.new("RGB", (8, 8)), [])
+        assert report["fidelity"] is None and report["colors"] == []
@@ -0,0 +1,66 @@
+"""
+Tests for the preloaded ControlNet pool (controlnet_pool.py)
+"""
+
+import threading
+
+import pytest
+
+from controlnet_pool import ControlNetPool, parse_controlnet_specs
+
+
+class StubLoader:
+    """Records loads; an optional gate blocks loading until released"""
+
+    def __init__(self, gate=None, failing=()):
+        self.gate = gate
+        self.failing = set(failing)
+        self.loaded = []
+
+    def __call__(self, source):
+        if self.gate is not None:
+            self.gate.wait(timeout=5)
+        if source in self.failing:
+            raise OSError(f"missing {source}")
+        self.loaded.append(source)
+        return f"model:{source}"
+
+
+class TestControlNetPool:
+    """Test preloading, readiness and shared pipeline variants"""
+
+    @pytest.mark.unit
+    def test_parse_specs(self):
+        specs = parse_controlnet_specs("color = repo/color-sdxl, shuffle=/models/shuffle,broken")
+        assert specs == {"color": "repo/color-sdxl", "shuffle": "/models/shuffle"}
+
+    @pytest.mark.unit
+    def test_preload_in_setup_builds_each_variant_once(self):
+        loader = StubLoader()
+        built = []
+        pool = ControlNetPool({"color": "c", "shuffle": "s"}, loader, lambda cn: built.append(cn) or f"pipe:{cn}")
+        pool.preload(pipelines=[["color"]])
+        assert pool.is_ready() and sorted(loader.loaded) == ["c", "s"]
+        assert pool.pipeline(["color"]) == "pipe:model:c"
+        assert pool.pipeline(["color", "shuffle"]) == "pipe:['model:c', 'model:s']"
+        pool.pipeline(["color", "shuffle"])
+        assert built == ["model:c", ["model:c", "model:s"]]
+        assert pool.status()["pipelines"] == ["color", "color+shuffle"]
+
+    @pytest.mark.unit
+    def test_background_preload_reports_readiness(self):
+        gate = threading.Event()
+        pool = ControlNetPool({"color": "c"}, StubLoader(gate), lambda cn: cn)
+        thread = pool.preload(background=True)
+        assert not pool.is_ready() and pool.status()["models"]["color"] in ("pending", "loading")
+        gate.set()
+        assert pool.model("color") == "model:c"
+        thread.join(timeout=5)
+        assert pool.is_ready() and pool.status()["ready"]
+
+    @pytest.mark.unit
+    def test_failed_model_yields_no_pipeline(self):
+        pool = ControlNetPool({"color": "c"}, StubLoader(failing={"c"}), lambda cn: cn)
+        pool.preload()
+        assert pool.pipeline("color") is None
+        assert pool.status()["models"]["color"] == "failed" and "missing c" in pool.status()["errors"]["color"]
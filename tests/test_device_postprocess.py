@@ -0,0 +1,50 @@
+"""
+Tests for on-device image postprocessing (device_postprocess.py); skipped without PyTorch
+"""
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import device_postprocess  # noqa: E402
+
+
+@pytest.mark.unit
+class TestPostprocess:
+    """uint8 conversion, preview downsampling and host transfer (CPU tensors)"""
+
+    def test_matches_numpy_to_pil_rounding(self):
+        images = torch.rand(2, 3, 16, 16)
+        expected = (images.permute(0, 2, 3, 1).numpy() * 255).round().astype("uint8")
+
+        outputs = device_postprocess.postprocess(images)
+
+        assert [preview for _, preview in outputs] == [None, None]
+        for (final, _), array in zip(outputs, expected):
+            assert np.array_equal(np.asarray(final), array)
+
+    def test_clamps_out_of_range_values(self):
+        images = torch.full((1, 3, 4, 4), 1.5)
+        images[..., 0, 0] = -0.5
+
+        final, _ = device_postprocess.postprocess(images)[0]
+
+        assert np.asarray(final)[0, 0].tolist() == [0, 0, 0]
+        assert np.asarray(final)[1, 1].tolist() == [255, 255, 255]
+
+    def test_builds_downsampled_preview(self):
+        images = torch.rand(1, 3, 64, 64, dtype=torch.float16)
+
+        final, preview = device_postprocess.postprocess(images, preview_size=16)[0]
+
+        assert final.size == (64, 64)
+        assert preview.size == (16, 16)
+        assert preview.mode == "RGB"
+
+    def test_preview_of_flat_image_keeps_color(self):
+        images = torch.full((1, 3, 32, 32), 0.5)
+
+        _, preview = device_postprocess.postprocess(images, preview_size=8)[0]
+
+        assert np.all(np.asarray(preview) == 128)
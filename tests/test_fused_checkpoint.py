@@ -0,0 +1,49 @@
+"""
+Tests for the fused checkpoint manifest (fused_checkpoint.py)
+"""
+
+import json
+
+import pytest
+
+import fused_checkpoint
+
+
+class TestFusedCheckpointManifest:
+    """Test source fingerprints and stale detection"""
+
+    @pytest.mark.unit
+    def test_manifest_roundtrip_and_fresh_sources(self, tmp_path):
+        lora = tmp_path / "lora.safetensors"
+        lora.write_bytes(b"lora" * 1000)
+        fused_checkpoint.write_manifest(str(tmp_path), {"lora": str(lora)}, lora_scale=1.0)
+        manifest = fused_checkpoint.read_manifest(str(tmp_path))
+        assert manifest["lora_scale"] == 1.0
+        assert fused_checkpoint.stale_sources(manifest, {"lora": str(lora)}) == []
+
+    @pytest.mark.unit
+    def test_changed_or_unknown_source_is_stale(self, tmp_path):
+        lora = tmp_path / "lora.safetensors"
+        lora.write_bytes(b"a" * 3 * fused_checkpoint.FINGERPRINT_CHUNK_BYTES)
+        manifest = fused_checkpoint.write_manifest(str(tmp_path), {"lora": str(lora)})
+        lora.write_bytes(b"a" * 3 * fused_checkpoint.FINGERPRINT_CHUNK_BYTES + b"b")
+        assert fused_checkpoint.stale_sources(manifest, {"lora": str(lora), "ti": str(tmp_path / "ti")}) == ["lora", "ti"]
+
+    @pytest.mark.unit
+    def test_missing_source_file_is_not_stale(self, tmp_path):
+        manifest = fused_checkpoint.write_manifest(str(tmp_path), {"ti": str(tmp_path / "absent.safetensors")})
+        assert fused_checkpoint.stale_sources(manifest, {"ti": str(tmp_path / "absent.safetensors")}) == []
+
+    @pytest.mark.unit
+    def test_missing_or_foreign_manifest(self, tmp_path):
+        assert fused_checkpoint.read_manifest(str(tmp_path)) is None
+        (tmp_path / fused_checkpoint.MANIFEST_NAME).write_text(json.dumps({"version": 999}))
+        assert fused_checkpoint.read_manifest(str(tmp_path)) is None
+
+    @pytest.mark.unit
+    def test_other_lora_scale_is_stale(self, tmp_path):
+        manifest = fused_checkpoint.write_manifest(str(tmp_path), {}, lora_scale=fused_checkpoint.LORA_SCALE / 2)
+        assert fused_checkpoint.stale_parameters(manifest, lora_scale=fused_checkpoint.LORA_SCALE) == ["lora_scale"]
+        manifest = fused_checkpoint.write_manifest(str(tmp_path), {}, lora_scale=fused_checkpoint.LORA_SCALE)
+        assert fused_checkpoint.stale_parameters(manifest, lora_scale=fused_checkpoint.LORA_SCALE) == []
+        assert fused_checkpoint.stale_parameters({}, lora_scale=fused_checkpoint.LORA_SCALE) == ["lora_scale"]
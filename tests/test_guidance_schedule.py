@@ -0,0 +1,69 @@
+"""
+Tests for the classifier-free guidance truncation schedule (guidance_schedule.py)
+"""
+
+import pytest
+
+from guidance_schedule import DELTA_MIN_FRACTION, GuidanceSchedule, parse_guidance_schedule
+
+
+@pytest.mark.unit
+class TestGuidanceSchedule:
+    """When the unconditional branch is dropped"""
+
+    def test_full_schedule_never_truncates(self):
+        schedule = GuidanceSchedule()
+        assert not schedule.enabled
+        assert not any(schedule.should_truncate(step, 25, delta=0.0) for step in range(1, 26))
+
+    def test_cutoff_fraction(self):
+        schedule = GuidanceSchedule(cutoff_fraction=0.6)
+        truncated = [step for step in range(1, 26) if schedule.should_truncate(step, 25)]
+        assert schedule.cutoff_step(25) == 15
+        assert truncated[0] == 15
+
+    def test_never_truncates_after_last_step(self):
+        assert not GuidanceSchedule(cutoff_fraction=1.0).should_truncate(20, 20)
+        assert GuidanceSchedule(cutoff_fraction=1.0).cutoff_step(20) == 20
+
+    def test_delta_threshold_waits_for_min_fraction(self):
+        schedule = GuidanceSchedule(delta_threshold=0.05)
+        early_step = int(DELTA_MIN_FRACTION * 20) - 1
+        assert schedule.needs_delta
+        assert not schedule.should_truncate(early_step, 20, delta=0.01)
+        assert schedule.should_truncate(10, 20, delta=0.01)
+        assert not schedule.should_truncate(10, 20, delta=0.2)
+        assert not schedule.should_truncate(10, 20, delta=None)
+
+    def test_either_condition_truncates(self):
+        schedule = GuidanceSchedule(cutoff_fraction=0.8, delta_threshold=0.05)
+        assert schedule.should_truncate(16, 20, delta=0.5)
+        assert schedule.should_truncate(8, 20, delta=0.01)
+
+    @pytest.mark.parametrize("cutoff, delta", [(0.0, None), (1.5, None), (None, 0.0), (None, -1.0)])
+    def test_invalid_parameters(self, cutoff, delta):
+        with pytest.raises(ValueError):
+            GuidanceSchedule(cutoff, delta)
+
+
+@pytest.mark.unit
+class TestParseGuidanceSchedule:
+    """Request-input specs"""
+
+    @pytest.mark.parametrize("spec, cutoff, delta", [
+        ("full", None, None), ("", None, None), ("cutoff:0.6", 0.6, None),
+        ("delta:0.05", None, 0.05), (" Cutoff:0.7, delta:0.1 ", 0.7, 0.1)
+    ])
+    def test_specs(self, spec, cutoff, delta):
+        schedule = parse_guidance_schedule(spec)
+        assert schedule.cutoff_fraction == cutoff
+        assert schedule.delta_threshold == delta
+
+    @pytest.mark.parametrize("spec", ["full", "cutoff:0.6", "delta:0.05", "cutoff:0.7,delta:0.1"])
+    def test_label_round_trip(self, spec):
+        assert str(parse_guidance_schedule(spec)) == spec
+
+    @pytest.mark.parametrize("spec", ["auto", "cutoff", "cutoff:abc", "steps:10", "cutoff:2"])
+    def test_invalid_specs(self, spec):
+        with pytest.raises(ValueError):
+            parse_guidance_schedule(spec)
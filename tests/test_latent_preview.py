@@ -0,0 +1,51 @@
+"""
+Tests for latent-space step previews (latent_preview.py)
+"""
+
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import latent_preview
+
+
+class TestLatentPreview:
+    """Test the linear latent projection and the preview queue"""
+
+    @pytest.mark.unit
+    def test_latents_to_rgb_projects_channels(self):
+        latents = np.zeros((4, 16, 24), dtype=np.float32)
+        latents[0] = 1.0
+        image = latent_preview.latents_to_rgb(latents)
+        assert image.size == (24, 16) and image.mode == "RGB"
+        expected = np.clip((latent_preview.SDXL_LATENT_RGB_FACTORS[0] + latent_preview.SDXL_LATENT_RGB_BIAS + 1) * 127.5, 0, 255)
+        np.testing.assert_allclose(np.asarray(image)[0, 0], expected, atol=1)
+
+    @pytest.mark.unit
+    def test_should_preview_skips_final_step(self):
+        previewer = latent_preview.LatentPreviewer(5, "/tmp")
+        assert [step for step in range(1, 21) if previewer.should_preview(step, 20)] == [5, 10, 15]
+        assert not latent_preview.LatentPreviewer(0, "/tmp").should_preview(5, 20)
+
+    @pytest.mark.unit
+    def test_add_writes_jpeg_and_stream_drains(self, tmp_path):
+        previewer = latent_preview.LatentPreviewer(1, str(tmp_path), max_size=32)
+        previewer.add(1, np.zeros((4, 128, 128), dtype=np.float32), variant=0)
+        previewer.add(2, np.zeros((4, 128, 128), dtype=np.float32), variant=1)
+        future = Future()
+        future.set_result([])
+        paths = list(previewer.stream(future))
+        assert [p.rsplit("/", 1)[-1] for p in paths] == ["step_001_0.jpg", "step_002_1.jpg"]
+        with Image.open(paths[0]) as image:
+            assert image.format == "JPEG" and image.size == (32, 32)
+        assert previewer.stats["previews"] == 2
+
+    @pytest.mark.unit
+    def test_decode_errors_do_not_break_generation(self, tmp_path):
+        def broken_decode(latent):
+            raise RuntimeError("decoder failed")
+
+        previewer = latent_preview.LatentPreviewer(1, str(tmp_path), decode=broken_decode)
+        assert previewer.add(1, None) is None and previewer.stats["previews"] == 0
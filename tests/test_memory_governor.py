@@ -0,0 +1,101 @@
+"""
+Tests for the GPU memory governor (memory_governor.py)
+"""
+
+import pytest
+
+from memory_governor import MB, MemoryGovernor
+
+
+class FakeDevice:
+    """Memory counters of a fake 10 GB device"""
+
+    def __init__(self, reserved_mb=0):
+        self.reserved = reserved_mb * MB
+        self.peak = reserved_mb * MB
+        self.reclaims = 0
+
+    def stats(self):
+        return {"allocated": self.reserved, "reserved": self.reserved,
+                "peak_allocated": self.peak, "peak_reserved": self.peak, "total": 10240 * MB}
+
+    def reclaim(self):
+        self.reclaims += 1
+        self.reserved = 0
+
+
+class TestMemoryGovernor:
+    """Test pressure-only reclaim, OOM retry and peak metrics"""
+
+    @pytest.mark.unit
+    def test_no_reclaim_with_headroom(self):
+        device = FakeDevice(reserved_mb=4096)
+        governor = MemoryGovernor(2048 * MB, device.stats, device.reclaim)
+        metrics = governor.end_request()
+        assert device.reclaims == 0 and not metrics["reclaimed"]
+        assert metrics["peak_reserved_mb"] == 4096 and metrics["headroom_mb"] == 6144
+        assert governor.stats["skipped_reclaims"] == 1
+
+    @pytest.mark.unit
+    def test_reclaim_under_pressure(self):
+        device = FakeDevice(reserved_mb=9000)
+        governor = MemoryGovernor(2048 * MB, device.stats, device.reclaim)
+        assert governor.end_request()["reclaimed"]
+        assert device.reclaims == 1 and governor.stats["reclaims"] == 1
+        assert governor.stats["min_headroom_mb"] == 1240
+
+    @pytest.mark.unit
+    def test_oom_retried_once_after_reclaim(self):
+        device = FakeDevice()
+        governor = MemoryGovernor(0, device.stats, device.reclaim)
+        attempts = []
+
+        def generate():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+            return "image"
+
+        assert governor.run(generate) == "image"
+        assert len(attempts) == 2 and device.reclaims == 1 and governor.stats["oom_retries"] == 1
+
+    @pytest.mark.unit
+    def test_other_errors_propagate(self):
+        device = FakeDevice()
+        governor = MemoryGovernor(0, device.stats, device.reclaim)
+        with pytest.raises(ValueError):
+            governor.run(lambda: (_ for _ in ()).throw(ValueError("bad input")))
+        assert device.reclaims == 0
+
+    @pytest.mark.unit
+    def test_cpu_device_never_under_pressure(self):
+        governor = MemoryGovernor(2048 * MB, dict, lambda: None)
+        metrics = governor.end_request()
+        assert not metrics["reclaimed"] and metrics["headroom_mb"] is None
+
+    @pytest.mark.unit
+    def test_profiler_peaks_override_snapshot(self):
+        device = FakeDevice(reserved_mb=1024)
+        governor = MemoryGovernor(2048 * MB, device.stats, device.reclaim)
+        metrics = governor.end_request({"peak_allocated": 3072 * MB, "peak_reserved": 4096 * MB})
+        assert metrics["peak_allocated_mb"] == 3072 and metrics["headroom_mb"] == 6144
+
+    @pytest.mark.unit
+    def test_peaks_reset_only_on_idle_device(self):
+        device = FakeDevice(reserved_mb=1024)
+        resets = []
+        governor = MemoryGovernor(2048 * MB, device.stats, device.reclaim, reset_peak=lambda: resets.append(1))
+
+        first = governor.begin_request()
+        second = governor.begin_request()
+        # The second request must not wipe the peaks the first one is still accumulating
+        assert len(resets) == 1
+        assert governor.end_request(ticket=first)["exclusive_peak"] is False
+        governor.finish_request(first)
+        assert governor.end_request(ticket=second)["exclusive_peak"] is False
+        governor.finish_request(second)
+
+        third = governor.begin_request()
+        assert len(resets) == 2
+        assert governor.end_request(ticket=third)["exclusive_peak"] is True
+        governor.finish_request(third)
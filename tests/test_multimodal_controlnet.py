@@ -0,0 +1,34 @@
+"""
+Tests for multi-ControlNet parameters (predict_multimodal_controlnet.py)
+"""
+
+import pytest
+from PIL import Image
+
+import predict_multimodal_controlnet as mcn
+
+
+class TestMultiControlNetKwargs:
+    """Test per-net images, scales and guidance windows"""
+
+    @pytest.mark.unit
+    def test_lists_per_controlnet(self):
+        images = [Image.new("RGB", (8, 8), color) for color in ("red", "green", "blue")]
+        kwargs = mcn.build_multi_controlnet_kwargs(["t2i_color", "color_grid", "shuffle"], images)
+        assert kwargs["image"] == images
+        assert kwargs["controlnet_conditioning_scale"] == [1.0, 1.1, 0.9]
+        assert kwargs["control_guidance_start"] == [0.0, 0.0, 0.0]
+        assert kwargs["control_guidance_end"] == [0.6, 0.5, 0.35]
+
+    @pytest.mark.unit
+    def test_single_controlnet_uses_scalars(self):
+        image = Image.new("RGB", (8, 8))
+        kwargs = mcn.build_multi_controlnet_kwargs(["unknown"], [image])
+        assert kwargs == {"image": image, "controlnet_conditioning_scale": 1.0,
+                          "control_guidance_start": 0.0, "control_guidance_end": 1.0}
+
+    @pytest.mark.unit
+    def test_active_fraction_reflects_windows(self):
+        assert mcn.active_controlnet_fraction([]) == 0.0
+        assert mcn.active_controlnet_fraction(["unknown"]) == 1.0
+        assert mcn.active_controlnet_fraction(["t2i_color", "color_grid", "shuffle"]) == pytest.approx(1.45 / 3)
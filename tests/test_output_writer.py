@@ -0,0 +1,155 @@
+"""
+Tests for the asynchronous output encoding stage (output_writer.py)
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from output_writer import GROUP_COLORMAP, GROUP_FINAL, GROUP_PREVIEW, OutputWriter
+from stage_timer import StageProfiler
+
+
+def _noise_image(size=64, mode="RGB"):
+    rng = np.random.default_rng(0)
+    channels = 4 if mode == "RGBA" else 3
+    return Image.fromarray(rng.integers(0, 256, (size, size, channels), dtype=np.uint8), mode)
+
+
+@pytest.fixture
+def pool():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+
+@pytest.mark.unit
+class TestEncode:
+    """Per-format encoding"""
+
+    @pytest.mark.parametrize("output_format, extension, pil_format", [
+        ("png", ".png", "PNG"), ("webp", ".webp", "WEBP"), ("jpeg", ".jpg", "JPEG")
+    ])
+    def test_writes_file_with_format_extension(self, pool, tmp_path, output_format, extension, pil_format):
+        writer = OutputWriter(pool)
+        path = writer.encode(_noise_image(), str(tmp_path / "final"), output_format)
+
+        assert path == str(tmp_path / "final") + extension
+        with Image.open(path) as image:
+            assert image.format == pil_format
+
+    @pytest.mark.parametrize("output_format", ["png", "webp"])
+    def test_png_and_webp_are_lossless(self, pool, tmp_path, output_format):
+        image = _noise_image()
+        path = OutputWriter(pool).encode(image, str(tmp_path / "final"), output_format)
+
+        with Image.open(path) as decoded:
+            assert np.array_equal(np.asarray(decoded.convert("RGB")), np.asarray(image))
+
+    def test_jpeg_converts_rgba(self, pool, tmp_path):
+        path = OutputWriter(pool).encode(_noise_image(mode="RGBA"), str(tmp_path / "preview"), "jpeg")
+
+        with Image.open(path) as image:
+            assert image.mode == "RGB"
+
+    def test_png_compress_level_is_applied(self, pool):
+        assert OutputWriter(pool, png_compress_level=9).save_params("png") == {"compress_level": 9}
+        assert OutputWriter(pool, png_compress_level=42).save_params("png") == {"compress_level": 9}
+
+    def test_unknown_format_rejected(self, pool, tmp_path):
+        with pytest.raises(ValueError):
+            OutputWriter(pool).encode(_noise_image(), str(tmp_path / "final"), "tiff")
+
+    def test_encode_time_reported_per_format(self, pool, tmp_path):
+        profiler = StageProfiler()
+        writer = OutputWriter(pool, profiler)
+        writer.encode(_noise_image(), str(tmp_path / "a"), "png")
+        writer.encode(_noise_image(), str(tmp_path / "b"), "png")
+        writer.encode(_noise_image(), str(tmp_path / "c"), "jpeg")
+
+        assert profiler.stages["encode/png"]["count"] == 2
+        assert profiler.stages["encode/jpeg"]["count"] == 1
+        assert writer.stats["png"]["files"] == 2
+        assert writer.stats["jpeg"]["seconds"] >= 0.0
+
+
+@pytest.mark.unit
+class TestPaths:
+    """Priority groups and as-soon-as-done delivery"""
+
+    def test_groups_are_yielded_in_priority_order(self, pool, tmp_path):
+        writer = OutputWriter(pool)
+        # Submitted in reverse priority: colormap first, as predict() does during denoising
+        writer.submit(GROUP_COLORMAP, writer.encode, _noise_image(), str(tmp_path / "colormap"), "png")
+        writer.submit(GROUP_PREVIEW, writer.encode, _noise_image(), str(tmp_path / "preview"), "jpeg")
+        writer.submit(GROUP_FINAL, writer.encode, _noise_image(), str(tmp_path / "final"), "png")
+
+        names = [path.rsplit("/", 1)[1] for path in writer.paths()]
+
+        assert names == ["final.png", "preview.jpg", "colormap.png"]
+
+    def test_group_keeps_submission_order(self, pool, tmp_path):
+        writer = OutputWriter(pool)
+        release = threading.Event()
+        fast_done = threading.Event()
+
+        def slow_task():
+            release.wait(timeout=5)
+            return "final_0"
+
+        def fast_task():
+            fast_done.set()
+            return "final_1"
+
+        writer.submit(GROUP_FINAL, slow_task)
+        writer.submit(GROUP_FINAL, fast_task)
+        # The second file is encoded in parallel, but output i must still match seed i
+        assert fast_done.wait(timeout=5)
+        paths = writer.paths()
+        release.set()
+
+        assert list(paths) == ["final_0", "final_1"]
+
+    def test_task_errors_propagate(self, pool):
+        writer = OutputWriter(pool)
+
+        def failing_task():
+            raise RuntimeError("disk full")
+
+        writer.submit(GROUP_FINAL, failing_task)
+
+        with pytest.raises(RuntimeError, match="disk full"):
+            list(writer.paths())
+
+
+@pytest.mark.unit
+class TestSubmitAfter:
+    """Tasks that depend on another pool job"""
+
+    def test_dependent_tasks_do_not_starve_the_pool(self):
+        # One worker: a task waiting for the dependency inside the pool would deadlock here
+        with ThreadPoolExecutor(max_workers=1) as single:
+            release = threading.Event()
+            single.submit(release.wait, 5)
+            dependency = single.submit(lambda: "artifact")
+            writer = OutputWriter(single)
+            for kind in ("colormap", "legend"):
+                writer.submit_after(GROUP_COLORMAP, dependency, lambda artifact, kind: f"{artifact}:{kind}", kind)
+            release.set()
+
+            assert sorted(writer.paths()) == ["artifact:colormap", "artifact:legend"]
+
+    def test_dependency_error_propagates(self, pool):
+        writer = OutputWriter(pool)
+
+        def failing_build():
+            raise RuntimeError("colormap failed")
+
+        calls = []
+        writer.submit_after(GROUP_COLORMAP, pool.submit(failing_build), calls.append)
+
+        with pytest.raises(RuntimeError, match="colormap failed"):
+            list(writer.paths())
+        assert calls == []
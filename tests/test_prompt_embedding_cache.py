@@ -0,0 +1,56 @@
+"""
+Tests for the prompt-embedding LRU cache (prompt_embedding_cache.py)
+"""
+
+import numpy as np
+import pytest
+
+import prompt_embedding_cache
+
+
+def _embeddings(value=0.0, tokens=77):
+    return {
+        "prompt_embeds": np.full((1, tokens, 8), value, dtype=np.float16),
+        "negative_prompt_embeds": np.zeros((1, tokens, 8), dtype=np.float16),
+        "pooled_prompt_embeds": np.full((1, 4), value, dtype=np.float16),
+        "negative_pooled_prompt_embeds": np.zeros((1, 4), dtype=np.float16),
+    }
+
+
+class TestPromptEmbeddingCache:
+    """Test the keyed LRU cache in front of the text encoders"""
+
+    @pytest.mark.unit
+    def test_key_depends_on_prompts_and_encoding_params(self):
+        key = prompt_embedding_cache.prompt_embedding_key("red tile", "", device="cuda", cfg=True)
+        assert key == prompt_embedding_cache.prompt_embedding_key("red tile", None, device="cuda", cfg=True)
+        assert key != prompt_embedding_cache.prompt_embedding_key("red tile", "blurry", device="cuda", cfg=True)
+        assert key != prompt_embedding_cache.prompt_embedding_key("red tile", "", device="cuda", cfg=False)
+
+    @pytest.mark.unit
+    def test_get_or_encode_runs_encoder_once(self):
+        cache = prompt_embedding_cache.PromptEmbeddingCache(max_bytes=10 ** 6)
+        calls = []
+
+        def encode():
+            calls.append(1)
+            return _embeddings(1.0)
+
+        first = cache.get_or_encode("key", encode)
+        second = cache.get_or_encode("key", encode)
+        assert first is second and len(calls) == 1
+        assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+        assert cache.stats["saved_seconds"] == pytest.approx(cache.stats["encode_seconds"])
+
+    @pytest.mark.unit
+    def test_lru_eviction_by_byte_budget(self):
+        entry_bytes = sum(prompt_embedding_cache.tensor_nbytes(t) for t in _embeddings().values())
+        cache = prompt_embedding_cache.PromptEmbeddingCache(max_bytes=2 * entry_bytes)
+        cache.put("a", _embeddings(1.0))
+        cache.put("b", _embeddings(2.0))
+        assert cache.get("a") is not None
+        cache.put("c", _embeddings(3.0))
+        assert cache.get("b") is None
+        assert cache.stats["evictions"] == 1 and cache.stats["bytes"] == 2 * entry_bytes
+        cache.put("huge", _embeddings(tokens=10 ** 4))
+        assert cache.get("huge") is None and cache.stats["entries"] == 2
@@ -0,0 +1,121 @@
+"""
+Tests for per-request output workspaces (request_workspace.py)
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from batch_scheduler import MicroBatchScheduler
+from request_workspace import WorkspaceManager
+
+
+@pytest.mark.unit
+class TestWorkspaceManager:
+    """Workspace creation, file paths and deferred cleanup"""
+
+    def test_each_request_gets_its_own_directory(self, tmp_path):
+        manager = WorkspaceManager(str(tmp_path), ttl_seconds=0)
+        first, second = manager.create(), manager.create()
+
+        assert first.path != second.path
+        assert os.path.isdir(first.path) and os.path.isdir(second.path)
+        assert first.file("final.png") == os.path.join(first.path, "final.png")
+        assert manager.stats["active"] == 2
+
+    def test_zero_ttl_removes_on_release(self, tmp_path):
+        manager = WorkspaceManager(str(tmp_path), ttl_seconds=0)
+        workspace = manager.create()
+        with open(workspace.file("final.png"), "wb") as f:
+            f.write(b"png")
+
+        manager.release(workspace)
+
+        assert not os.path.exists(workspace.path)
+        assert manager.stats == {"created": 1, "removed": 1, "active": 0, "retained": 0}
+
+    def test_released_workspaces_survive_until_ttl(self, tmp_path):
+        now = [0.0]
+        manager = WorkspaceManager(str(tmp_path), ttl_seconds=60, clock=lambda: now[0])
+        # More requests in flight than any fixed retention count: none may lose files before the TTL
+        workspaces = [manager.create() for _ in range(8)]
+        for workspace in workspaces:
+            manager.release(workspace)
+        assert all(os.path.exists(w.path) for w in workspaces)
+        assert manager.stats["retained"] == 8
+
+        now[0] = 30.0
+        late = manager.create()
+        manager.release(late)
+        now[0] = 61.0
+        manager.create()
+
+        assert [os.path.exists(w.path) for w in workspaces + [late]] == [False] * 8 + [True]
+        assert manager.stats["removed"] == 8
+        assert manager.stats["retained"] == 1
+
+    def test_creates_missing_root(self, tmp_path):
+        root = tmp_path / "outputs" / "requests"
+        workspace = WorkspaceManager(str(root)).create()
+
+        assert os.path.dirname(workspace.path) == str(root)
+
+
+def _fake_predict(manager, scheduler, request_id):
+    """Mirrors predict(): workspace per request, generation through the shared scheduler,
+    outputs written to fixed names inside the workspace and yielded one by one"""
+    workspace = manager.create()
+    try:
+        images = scheduler.submit("sdxl", request_id, 1).result()
+        for name, content in (("final.png", images[0]), ("colormap.png", f"colormap-{request_id}"),
+                              ("generation_data.json", f"seed={request_id}")):
+            path = workspace.file(name)
+            with open(path, "w") as f:
+                f.write(content)
+            yield path
+    finally:
+        manager.release(workspace)
+
+
+@pytest.mark.unit
+class TestConcurrentRequests:
+    """Stress test: concurrent requests never see each other's outputs"""
+
+    def test_no_output_cross_talk(self, tmp_path):
+        manager = WorkspaceManager(str(tmp_path), ttl_seconds=0)
+        gpu_calls = []
+        gpu_busy = threading.Lock()
+
+        def run_batch(key, request_ids):
+            # The GPU stage is serialized: a second batch must never overlap
+            assert gpu_busy.acquire(blocking=False)
+            try:
+                gpu_calls.append(list(request_ids))
+                return [[f"image-{request_id}"] for request_id in request_ids]
+            finally:
+                gpu_busy.release()
+
+        scheduler = MicroBatchScheduler(run_batch, max_batch_size=4, max_wait_ms=5)
+
+        def consume(request_id):
+            outputs = []
+            for path in _fake_predict(manager, scheduler, request_id):
+                # Read as soon as yielded, like the server uploading an output
+                with open(path) as f:
+                    outputs.append(f.read())
+            return outputs
+
+        try:
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                results = list(pool.map(consume, range(64)))
+        finally:
+            scheduler.shutdown()
+
+        for request_id, outputs in enumerate(results):
+            assert outputs == [f"image-{request_id}", f"colormap-{request_id}", f"seed={request_id}"]
+        assert sorted(r for batch in gpu_calls for r in batch) == list(range(64))
+        assert manager.stats["active"] == 0
+        assert manager.stats["removed"] == 64
+        assert os.listdir(tmp_path) == []
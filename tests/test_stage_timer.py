@@ -0,0 +1,123 @@
+"""
+Tests for phase timing (stage_timer.py)
+"""
+
+import time
+
+import pytest
+
+from stage_timer import MB, StageProfiler, StageTimer, profile_stage, run_until_steady
+
+
+class TestStageTimer:
+    """Test laps, with-blocks and summaries"""
+
+    @pytest.mark.unit
+    def test_laps_and_stages_accumulate(self):
+        timer = StageTimer()
+        time.sleep(0.01)
+        timer.lap("load")
+        with timer.stage("encode"):
+            time.sleep(0.01)
+        with timer.stage("encode"):
+            time.sleep(0.01)
+        assert timer.stages["load"] >= 0.01
+        assert timer.stages["encode"] >= 0.02
+        assert list(timer.to_dict()) == ["load", "encode", "total"]
+
+    @pytest.mark.unit
+    def test_summary_format(self):
+        timer = StageTimer()
+        timer.lap("device")
+        assert timer.summary().startswith("device=0.00s, total=")
+
+
+class TestRunUntilSteady:
+    """Test warm-up repetition until timings stabilise"""
+
+    @pytest.mark.unit
+    def test_stops_when_two_runs_match(self):
+        delays = iter([0.05, 0.01, 0.01, 0.01])
+        durations = run_until_steady(lambda: time.sleep(next(delays)), max_runs=4, tolerance=0.5)
+        assert len(durations) == 3
+
+    @pytest.mark.unit
+    def test_respects_max_runs(self):
+        calls = []
+        assert len(run_until_steady(lambda: calls.append(1), max_runs=1)) == 1 and calls == [1]
+
+
+class TestStageProfiler:
+    """Test per-stage wall/synchronised durations and memory peaks"""
+
+    @staticmethod
+    def _profiler(events):
+        peaks = iter([100 * MB, 300 * MB, 200 * MB])
+        return StageProfiler(
+            synchronize=lambda: events.append("sync"),
+            memory_probe=lambda: {"vram_peak": next(peaks), "vram_reserved_peak": 512 * MB, "rss": 64 * MB},
+            reset_peak=lambda: events.append("reset")
+        )
+
+    @pytest.mark.unit
+    def test_gpu_stage_syncs_and_records_memory(self):
+        events = []
+        profiler = self._profiler(events)
+        with profiler.stage("vae_decode"):
+            pass
+        stage = profiler.stages["vae_decode"]
+        assert events == ["sync", "reset", "sync"]
+        assert stage["count"] == 1 and stage["cuda_ms"] is not None
+        assert stage["vram_peak_mb"] == 100 and stage["rss_peak_mb"] == 64
+
+    @pytest.mark.unit
+    def test_cpu_stage_skips_sync_and_vram(self):
+        events = []
+        profiler = self._profiler(events)
+        with profiler.stage("png_save/final.png", gpu=False):
+            pass
+        stage = profiler.stages["png_save/final.png"]
+        assert events == [] and stage["cuda_ms"] is None and stage["vram_peak_mb"] is None
+
+    @pytest.mark.unit
+    def test_steps_and_shared_stage(self):
+        first, second = self._profiler([]), StageProfiler()
+        for _ in range(2):
+            first.record_step(first.end(first.begin()))
+        with profile_stage([first, None, second], "pil_convert"):
+            pass
+        assert len(first.steps_ms) == 2 and first.stages["denoise"]["count"] == 2
+        assert "pil_convert" in second.stages
+        result = first.to_dict()
+        assert result["vram_peak_mb"] == 300 and first.peaks()["peak_reserved"] == 512 * MB
+        assert set(result) == {"total_ms", "stages", "steps_ms", "vram_peak_mb", "rss_peak_mb"}
+
+    @pytest.mark.unit
+    def test_unsynchronized_gpu_stage_has_no_device_metrics(self):
+        profiler = StageProfiler(memory_probe=lambda: {"vram_peak": 100 * MB, "rss": 64 * MB})
+        with profiler.stage("vae_decode"):
+            pass
+        stage = profiler.to_dict()["stages"]["vae_decode"]
+        assert stage["cuda_ms"] is None and stage["vram_peak_mb"] is None
+        assert profiler.to_dict()["vram_peak_mb"] == 100
+
+    @pytest.mark.unit
+    def test_timing_events_resolved_without_sync(self):
+        class FakeEvent:
+            clock = iter([0.0, 7.5, 10.0, 12.0, 20.0, 23.0])
+
+            def record(self):
+                self.at = next(FakeEvent.clock)
+
+            def elapsed_time(self, end):
+                return end.at - self.at
+
+        profiler = StageProfiler(timing_event=FakeEvent)
+        with profiler.stage("vae_decode"):
+            pass
+        for _ in range(2):
+            profiler.record_step(profiler.end(profiler.begin()))
+        result = profiler.to_dict()
+        assert result["stages"]["vae_decode"]["cuda_ms"] == 7.5
+        assert result["steps_ms"] == [2.0, 3.0]
+        assert result["stages"]["denoise"]["cuda_ms"] == 5.0